@@ -0,0 +1,107 @@
+"""
+Measures how many documents' statuses can be written per second by
+concurrent fetches, with each write committed on its own, and with writes
+batched.
+
+    $ python benchmarks/document_writes.py --documents 5000 --concurrency 16
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from twisted.internet import task
+from twisted.internet.defer import gatherResults, inlineCallbacks
+
+from efolder_express.db import Document, DownloadDatabase
+from efolder_express.db_engine import DatabaseThreads
+from efolder_express.log import Logger
+
+
+class NullLog(object):
+    def msg(self, *args, **kwargs):
+        pass
+
+
+@inlineCallbacks
+def write_documents(logger, db, documents, concurrency):
+    """
+    Marks every one of ``documents`` as fetched, from ``concurrency``
+    concurrent fetches, each waiting for its write to finish before the
+    next.
+    """
+    @inlineCallbacks
+    def fetch(documents):
+        for doc in documents:
+            yield db.set_document_content_location(
+                logger, doc, "/tmp/{}".format(doc.id)
+            )
+    yield gatherResults([
+        fetch(documents[i::concurrency]) for i in xrange(concurrency)
+    ])
+
+
+@inlineCallbacks
+def measure(reactor, logger, path, name, documents, concurrency, **kwargs):
+    thread_pool = DatabaseThreads(reactor, 1)
+    thread_pool.start()
+    try:
+        db = DownloadDatabase(
+            reactor,
+            thread_pool,
+            "sqlite:///{}".format(os.path.join(path, "{}.db".format(name))),
+            **kwargs
+        )
+        yield db.create_database(logger)
+        yield db.create_download(logger, "request", "123")
+        docs = [
+            Document.from_json("request", {
+                "document_id": "{{{}}}".format(i),
+                "doc_type": "00356",
+                "filename": "file.pdf",
+                "received_at": "2015-03-04",
+                "source": "CUI",
+            })
+            for i in xrange(documents)
+        ]
+        yield db.create_documents(logger, docs)
+
+        start = time.time()
+        yield write_documents(logger, db, docs, concurrency)
+        duration = time.time() - start
+        print "{}: {:.2f}s ({:.0f} documents/s)".format(
+            name, duration, documents / duration
+        )
+    finally:
+        thread_pool.stop()
+
+
+@inlineCallbacks
+def main(reactor, args):
+    logger = Logger(NullLog())
+    path = tempfile.mkdtemp()
+    try:
+        yield measure(
+            reactor, logger, path, "unbatched", args.documents,
+            args.concurrency,
+        )
+        yield measure(
+            reactor, logger, path, "batched", args.documents,
+            args.concurrency,
+            write_batch_delay=args.max_delay,
+            write_batch_size=args.max_size,
+        )
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--documents", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--max-delay", type=float, default=0.005)
+    parser.add_argument("--max-size", type=int, default=100)
+    args = parser.parse_args()
+    task.react(main, [args])
@@ -0,0 +1,96 @@
+"""
+Measures how long loading the pending work of a synthetic database takes,
+compared with loading each download one at a time (as ``get_pending_work``
+used to).
+
+    $ python benchmarks/pending_work.py --documents 100000
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from twisted.internet import task
+from twisted.internet.defer import inlineCallbacks
+
+from efolder_express.db import Document, DownloadDatabase
+from efolder_express.db_engine import DatabaseThreads
+from efolder_express.log import Logger
+
+
+class NullLog(object):
+    def msg(self, *args, **kwargs):
+        pass
+
+
+@inlineCallbacks
+def populate(logger, db, started, downloads, documents):
+    for i in xrange(started):
+        yield db.create_download(logger, "started-{}".format(i), str(i))
+    per_download = documents // downloads
+    for i in xrange(downloads):
+        request_id = "listed-{}".format(i)
+        yield db.create_download(logger, request_id, str(i))
+        yield db.mark_download_manifest_downloaded(logger, request_id)
+        yield db.create_documents(logger, [
+            Document.from_json(request_id, {
+                "document_id": "{{{}-{}}}".format(i, j),
+                "doc_type": "00356",
+                "filename": "file.pdf",
+                "received_at": "2015-03-04",
+                "source": "CUI",
+            })
+            for j in xrange(per_download)
+        ])
+
+
+@inlineCallbacks
+def load_one_at_a_time(logger, db):
+    downloads, documents = yield db.get_pending_work(logger)
+    request_ids = {d.request_id for d in downloads}
+    request_ids.update(doc.download_id for doc in documents)
+    for request_id in request_ids:
+        yield db.get_download(logger, request_id)
+
+
+@inlineCallbacks
+def main(reactor, args):
+    thread_pool = DatabaseThreads(reactor, 1)
+    thread_pool.start()
+    reactor.addSystemEventTrigger("during", "shutdown", thread_pool.stop)
+
+    logger = Logger(NullLog())
+    path = tempfile.mkdtemp()
+    try:
+        db = DownloadDatabase(
+            reactor,
+            thread_pool,
+            "sqlite:///{}".format(os.path.join(path, "bench.db")),
+        )
+        yield db.create_database(logger)
+        yield populate(
+            logger, db, args.started, args.downloads, args.documents
+        )
+
+        start = time.time()
+        downloads, documents = yield db.get_pending_work(logger)
+        print "get_pending_work: {:.2f}s ({} downloads, {} documents)".format(
+            time.time() - start, len(downloads), len(documents)
+        )
+
+        start = time.time()
+        yield load_one_at_a_time(logger, db)
+        print "one download at a time: {:.2f}s".format(time.time() - start)
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--started", type=int, default=1000)
+    parser.add_argument("--downloads", type=int, default=2000)
+    parser.add_argument("--documents", type=int, default=100000)
+    args = parser.parse_args()
+    task.react(main, [args])
@@ -0,0 +1,117 @@
+"""
+Measures the latency of the status page's and ``get_pending_work``'s queries
+against a large synthetic database, before and after the ``create_indexes``
+migration.
+
+    $ python benchmarks/status_queries.py --downloads 20000 --documents 100
+"""
+
+import argparse
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+
+from twisted.internet import task
+from twisted.internet.defer import inlineCallbacks
+
+from efolder_express.db import DownloadDatabase
+from efolder_express.db_engine import DatabaseThreads
+from efolder_express.log import Logger
+from efolder_express.migrations import MIGRATIONS, create_indexes
+
+
+class NullLog(object):
+    def msg(self, *args, **kwargs):
+        pass
+
+
+def populate(path, downloads, documents, pending):
+    """
+    Inserts ``downloads`` completed downloads of ``documents`` documents
+    each, and one more with ``pending`` documents left to fetch.
+    """
+    conn = sqlite3.connect(path)
+    conn.executemany(
+        "INSERT INTO downloads (request_id, file_number, started_at, state) "
+        "VALUES (?, ?, '2016-01-01 00:00:00.000000', ?)",
+        [
+            ("request-{}".format(i), str(i), "MANIFEST_DOWNLOADED")
+            for i in xrange(downloads + 1)
+        ]
+    )
+    for i in xrange(downloads + 1):
+        conn.executemany(
+            "INSERT INTO documents (id, download_id, document_id, doc_type, "
+            "filename, content_location, errored) "
+            "VALUES (?, ?, ?, '00356', 'file.pdf', ?, 0)",
+            [
+                (
+                    "{}-{}".format(i, j),
+                    "request-{}".format(i),
+                    "{{{}-{}}}".format(i, j),
+                    None if i == downloads else "/tmp/{}-{}".format(i, j),
+                )
+                for j in xrange(pending if i == downloads else documents)
+            ]
+        )
+    conn.commit()
+    conn.close()
+
+
+@inlineCallbacks
+def measure(logger, db, downloads, repeat):
+    start = time.time()
+    for i in xrange(repeat):
+        yield db.get_download(
+            logger, "request-{}".format(i * downloads // repeat)
+        )
+    print "  get_download: {:.2f}ms".format(
+        (time.time() - start) * 1000 / repeat
+    )
+
+    start = time.time()
+    _, documents = yield db.get_pending_work(logger)
+    print "  get_pending_work: {:.2f}ms ({} documents)".format(
+        (time.time() - start) * 1000, len(documents)
+    )
+
+
+@inlineCallbacks
+def main(reactor, args):
+    thread_pool = DatabaseThreads(reactor, 1)
+    thread_pool.start()
+    reactor.addSystemEventTrigger("during", "shutdown", thread_pool.stop)
+
+    logger = Logger(NullLog())
+    path = tempfile.mkdtemp()
+    try:
+        db_path = os.path.join(path, "bench.db")
+        db = DownloadDatabase(
+            reactor, thread_pool, "sqlite:///{}".format(db_path)
+        )
+        yield db.migrate(logger, target=MIGRATIONS.index(create_indexes))
+        populate(db_path, args.downloads, args.documents, args.pending)
+
+        print "without indexes:"
+        yield measure(logger, db, args.downloads, args.repeat)
+
+        start = time.time()
+        yield db.migrate(logger)
+        print "create_indexes: {:.2f}s".format(time.time() - start)
+
+        print "with indexes:"
+        yield measure(logger, db, args.downloads, args.repeat)
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--downloads", type=int, default=20000)
+    parser.add_argument("--documents", type=int, default=100)
+    parser.add_argument("--pending", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    task.react(main, [args])
@@ -0,0 +1,71 @@
+import collections
+
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+
+START = "start"
+WAIT = "wait"
+REJECT = "reject"
+
+
+class AdmissionControl(object):
+    """
+    Decides whether a new download starts immediately, waits in line, or is
+    turned away.
+
+    A download starts while fewer than ``max_active_downloads`` downloads have
+    work queued or running, and fewer than ``max_queued_documents`` documents
+    are waiting to be fetched. Otherwise it waits (in the ``WAITING`` state)
+    until there is room, unless ``max_waiting`` downloads are already waiting,
+    in which case it's rejected, and the client is asked to retry after
+    ``retry_after`` seconds.
+    """
+
+    def __init__(self, clock, download_database, max_active_downloads,
+                 max_queued_documents, max_waiting, retry_after=60):
+        self._clock = clock
+        self._download_database = download_database
+        self._max_active_downloads = max_active_downloads
+        self._max_queued_documents = max_queued_documents
+        self._max_waiting = max_waiting
+        self.retry_after = retry_after
+
+        # When recent downloads started, for estimating how long the waiting
+        # ones have left.
+        self._starts = collections.deque(maxlen=20)
+
+    def capacity(self, active, queued):
+        """
+        Returns how many more downloads can be started now.
+        """
+        if queued >= self._max_queued_documents:
+            return 0
+        return max(0, self._max_active_downloads - active)
+
+    @inlineCallbacks
+    def check(self, logger):
+        active, queued, waiting = (
+            yield self._download_database.get_admission_counts(logger)
+        )
+        # Nothing jumps the line ahead of downloads which are waiting.
+        if not waiting and self.capacity(active, queued):
+            returnValue(START)
+        if waiting < self._max_waiting:
+            returnValue(WAIT)
+        returnValue(REJECT)
+
+    def record_start(self):
+        self._starts.append(self._clock.seconds())
+
+    def estimated_wait(self, position):
+        """
+        Returns roughly how many seconds the download at ``position`` in line
+        has to wait, from the rate at which recent downloads started, or
+        ``None`` if there's not enough history to tell.
+        """
+        if len(self._starts) < 2:
+            return None
+        interval = (self._starts[-1] - self._starts[0]) / (
+            len(self._starts) - 1
+        )
+        return interval * position
@@ -1,7 +1,9 @@
+import datetime
 import functools
 import json
 import os
 import uuid
+import weakref
 
 from cryptography import fernet
 
@@ -9,17 +11,40 @@ import jinja2
 
 import klein
 
-from twisted.internet.defer import inlineCallbacks, returnValue, succeed
+from sqlalchemy.engine.url import make_url
+
+from twisted.internet.defer import (
+    Deferred, gatherResults, inlineCallbacks, returnValue, succeed
+)
 from twisted.python.filepath import FilePath
-from twisted.python.threadpool import ThreadPool
 from twisted.web.static import File
 
 import yaml
 
-from efolder_express.db import Document, DownloadDatabase
+from efolder_express.admission import (
+    AdmissionControl, REJECT, START
+)
+from efolder_express.blob_store import blob_store_from_config
+from efolder_express.db import Document, DownloadDatabase, Job
+from efolder_express.db_engine import DatabaseThreads
 from efolder_express.demo import DemoMemoryDownloadDatabase
-from efolder_express.utils import DeferredValue
-from efolder_express.vbms import VBMSClient, VBMSError
+from efolder_express.jobs import FETCH_DOCUMENTS, JobQueue, LIST_DOCUMENTS
+from efolder_express.limiter import AdaptiveLimiter, FixedLimiter
+from efolder_express.retention import Retention
+from efolder_express.retry import (
+    CircuitBreaker, CircuitOpenError, RetryBudget, RetryPolicy, is_retryable
+)
+from efolder_express.scheduler import (
+    DOCUMENTS, MANIFEST, ROUND_ROBIN, Scheduler
+)
+from efolder_express.status_cache import StatusCache
+from efolder_express.storage import EncryptingWriter
+from efolder_express.utils import SingleFlight, log_failures
+from efolder_express.vbms import VBMSAbortedError, VBMSClient, VBMSError
+from efolder_express.vbms_worker import (
+    ConnectVBMSWorkerPool, connect_vbms_worker_command
+)
+from efolder_express.workers import WorkerPool
 
 
 def instrumented_route(func):
@@ -36,15 +61,34 @@ def instrumented_route(func):
 class DownloadEFolder(object):
     app = klein.Klein()
 
-    def __init__(self, logger, download_database, storage_path, fernet,
-                 vbms_client, queue, env_name):
+    def __init__(self, logger, download_database, blob_store, fernet,
+                 vbms_client, jobs, env_name, fetch_batch_size=1,
+                 min_retry_budget=10, retry_budget_ratio=0.1,
+                 document_types_ttl=24 * 60 * 60, manifest_cache_ttl=60 * 60,
+                 workers=None, admission=None, deprioritize_after=None,
+                 cancel_after=None, status_cache=None, retention=None):
         self.logger = logger
         self.download_database = download_database
-        self.storage_path = storage_path
+        self.blob_store = blob_store
         self.fernet = fernet
         self.vbms_client = vbms_client
-        self.queue = queue
+        self.jobs = jobs
+        self.workers = workers
+        self.admission = admission
+        self.status_cache = status_cache
+        self.retention = retention
         self.env_name = env_name
+        self.fetch_batch_size = fetch_batch_size
+        self.min_retry_budget = min_retry_budget
+        self.retry_budget_ratio = retry_budget_ratio
+        self.document_types_ttl = datetime.timedelta(
+            seconds=document_types_ttl
+        )
+        self.manifest_cache_ttl = datetime.timedelta(
+            seconds=manifest_cache_ttl
+        )
+        self.deprioritize_after = deprioritize_after
+        self.cancel_after = cancel_after
 
         self.jinja_env = jinja2.Environment(
             loader=jinja2.FileSystemLoader(
@@ -52,39 +96,231 @@ class DownloadEFolder(object):
             ),
             autoescape=True
         )
-        self.document_types = DeferredValue()
+        # The retry budget of each download with jobs in progress.
+        self._retry_budgets = weakref.WeakValueDictionary()
+        # In-flight document fetches, by ``document_id``.
+        self._document_fetches = SingleFlight()
+        # The writer of each document being fetched, by ``Document.id``.
+        self._writers = {}
+        # Until the types have been loaded, zips show the raw ``doc_type``.
+        self.document_types = {}
+        self.document_types_fetched_at = None
+        self._document_types_loaded = False
 
     @classmethod
-    def from_config(cls, reactor, logger, queue, config_path):
+    def from_config(cls, reactor, logger, config_path):
         with open(config_path) as f:
             config = yaml.safe_load(f)
 
-        # TODO: bump this once alchimia properly handles pinning
-        thread_pool = ThreadPool(minthreads=1, maxthreads=1)
+        db_config = config["db"]
+        # SQLite only allows one writer at a time anyway.
+        is_sqlite = make_url(db_config["uri"]).drivername.startswith("sqlite")
+        threads = db_config.get("threads", 1 if is_sqlite else 4)
+        thread_pool = DatabaseThreads(reactor, threads)
         thread_pool.start()
         reactor.addSystemEventTrigger('during', 'shutdown', thread_pool.stop)
+        read_thread_pool = None
+        if db_config.get("read_threads"):
+            read_thread_pool = DatabaseThreads(
+                reactor, db_config["read_threads"], name="db-read"
+            )
+            read_thread_pool.start()
+            reactor.addSystemEventTrigger(
+                'during', 'shutdown', read_thread_pool.stop
+            )
+
+        vbms_options = {
+            "connect_vbms_path": config["connect_vbms"]["path"],
+            "endpoint_url": config["vbms"]["endpoint_url"],
+            "keyfile": config["vbms"]["keyfile"],
+            "samlfile": config["vbms"]["samlfile"],
+            "key": config["vbms"].get("key"),
+            "keypass": config["vbms"]["keypass"],
+            "ca_cert": config["vbms"].get("ca_cert"),
+            "client_cert": config["vbms"].get("client_cert"),
+        }
+        worker_pool = None
+        if config["connect_vbms"].get("workers"):
+            worker_pool = ConnectVBMSWorkerPool(
+                reactor,
+                connect_vbms_worker_command(
+                    config["connect_vbms"]["bundle_path"]
+                ),
+                path=config["connect_vbms"]["path"],
+                config=vbms_options,
+                size=config["connect_vbms"]["workers"],
+                max_requests=config["connect_vbms"].get(
+                    "worker_max_requests", 500
+                ),
+                kill_grace_period=config["connect_vbms"].get(
+                    "kill_grace_period", 10
+                ),
+            )
+        limiter = FixedLimiter(
+            tokens=config["connect_vbms"].get("max_concurrency", 8)
+        )
+        concurrency = config["connect_vbms"].get("concurrency")
+        if concurrency:
+            limiter = AdaptiveLimiter(
+                reactor,
+                logger,
+                initial=concurrency.get("initial", 8),
+                minimum=concurrency.get("minimum", 2),
+                maximum=concurrency.get("maximum", 16),
+                latency_target=concurrency.get("latency_target", 60),
+                is_overload=is_retryable,
+            )
+        retry_config = config["vbms"].get("retry", {})
+        circuit_breaker_config = config["vbms"].get("circuit_breaker", {})
+        vbms_client = VBMSClient(
+            reactor,
+            bundle_path=config["connect_vbms"]["bundle_path"],
+            worker_pool=worker_pool,
+            limiter=limiter,
+            retry_policy=RetryPolicy(
+                reactor,
+                max_attempts=retry_config.get("max_attempts", 4),
+                base_delay=retry_config.get("base_delay", 2),
+                max_delay=retry_config.get("max_delay", 60),
+            ),
+            circuit_breaker=CircuitBreaker(
+                reactor,
+                logger,
+                failure_threshold=circuit_breaker_config.get(
+                    "failure_threshold", 5
+                ),
+                reset_timeout=circuit_breaker_config.get("reset_timeout", 30),
+            ),
+            timeouts=config["connect_vbms"].get("timeouts"),
+            kill_grace_period=config["connect_vbms"].get(
+                "kill_grace_period", 10
+            ),
+            **vbms_options
+        )
+        reactor.addSystemEventTrigger('during', 'shutdown', vbms_client.stop)
+
+        status_cache = None
+        status_cache_config = config.get("status_cache")
+        if status_cache_config:
+            status_cache = StatusCache(
+                reactor,
+                logger,
+                size=status_cache_config.get("size", 1000),
+                # Other processes' writes aren't seen, so by default entries
+                # are reloaded every few seconds. ``ttl: null`` turns this off
+                # for a single process.
+                ttl=status_cache_config.get("ttl", 5),
+            )
+        download_database = DownloadDatabase(
+            reactor,
+            thread_pool,
+            db_config["uri"],
+            read_thread_pool=read_thread_pool,
+            read_database_uri=db_config.get("read_uri"),
+            # A connection for every thread.
+            engine_options={} if is_sqlite else {
+                "pool_size": max(threads, db_config.get("read_threads", 0)),
+            },
+            write_batch_delay=db_config.get("write_batch", {}).get(
+                "max_delay", 0.005
+            ),
+            write_batch_size=db_config.get("write_batch", {}).get(
+                "max_size", 100
+            ),
+            status_cache=status_cache,
+        )
+        jobs_config = config.get("jobs", {})
+        jobs = JobQueue(
+            reactor,
+            logger,
+            download_database,
+            Scheduler(
+                reactor,
+                logger,
+                policy=config.get("scheduler", {}).get(
+                    "policy", ROUND_ROBIN
+                ),
+            ),
+            lease_duration=jobs_config.get("lease_duration", 300),
+            capacity=jobs_config.get("capacity", 100),
+            poll_interval=jobs_config.get("poll_interval", 5),
+            max_attempts=jobs_config.get("max_attempts", 5),
+        )
+        consumers_config = config.get("consumers", {})
+        autoscale = consumers_config.get("autoscale")
+        workers = WorkerPool(
+            reactor,
+            logger,
+            jobs.scheduler,
+            size=consumers_config.get("count", 8),
+            task_deadline=consumers_config.get("task_deadline", 60 * 60),
+        )
+        if autoscale:
+            workers.autoscale(
+                minimum=autoscale.get("minimum", 4),
+                maximum=autoscale.get("maximum", 32),
+                wait_target=autoscale.get("wait_target", 5),
+                interval=autoscale.get("interval", 10),
+            )
+
+        admission = None
+        admission_config = config.get("admission")
+        if admission_config:
+            admission = AdmissionControl(
+                reactor,
+                download_database,
+                max_active_downloads=admission_config.get(
+                    "max_active_downloads", 50
+                ),
+                max_queued_documents=admission_config.get(
+                    "max_queued_documents", 5000
+                ),
+                max_waiting=admission_config.get("max_waiting", 200),
+                retry_after=admission_config.get("retry_after", 60),
+            )
+
+        abandonment_config = config.get("abandonment", {})
+
+        blob_store = blob_store_from_config(reactor, config["storage"])
+        retention = None
+        retention_config = config.get("retention")
+        if retention_config:
+            retention = Retention(
+                reactor,
+                logger,
+                download_database,
+                blob_store,
+                max_age=retention_config["max_age"],
+                batch_size=retention_config.get("batch_size", 100),
+                batch_delay=retention_config.get("batch_delay", 1),
+                orphan_age=retention_config.get("orphan_age", 24 * 60 * 60),
+            )
 
         return cls(
             logger,
-            DownloadDatabase(reactor, thread_pool, config["db"]["uri"]),
-            FilePath(config["storage"]["filesystem"]),
+            download_database,
+            blob_store,
             fernet.MultiFernet([
                 fernet.Fernet(key) for key in config["encryption_keys"]
             ]),
-            VBMSClient(
-                reactor,
-                connect_vbms_path=config["connect_vbms"]["path"],
-                bundle_path=config["connect_vbms"]["bundle_path"],
-                endpoint_url=config["vbms"]["endpoint_url"],
-                keyfile=config["vbms"]["keyfile"],
-                samlfile=config["vbms"]["samlfile"],
-                key=config["vbms"].get("key"),
-                keypass=config["vbms"]["keypass"],
-                ca_cert=config["vbms"].get("ca_cert"),
-                client_cert=config["vbms"].get("client_cert"),
-            ),
-            queue,
+            vbms_client,
+            jobs,
             config["env"],
+            fetch_batch_size=config["connect_vbms"].get("fetch_batch_size", 1),
+            min_retry_budget=retry_config.get("min_budget", 10),
+            retry_budget_ratio=retry_config.get("budget_ratio", 0.1),
+            document_types_ttl=config.get("document_types", {}).get(
+                "ttl", 24 * 60 * 60
+            ),
+            manifest_cache_ttl=config.get("manifest_cache", {}).get(
+                "ttl", 60 * 60
+            ),
+            workers=workers,
+            admission=admission,
+            deprioritize_after=abandonment_config.get("deprioritize_after"),
+            cancel_after=abandonment_config.get("cancel_after"),
+            status_cache=status_cache,
+            retention=retention,
         )
 
     @classmethod
@@ -92,10 +328,10 @@ class DownloadEFolder(object):
         return cls(
             logger=logger,
             download_database=DemoMemoryDownloadDatabase(),
-            storage_path=None,
+            blob_store=None,
             fernet=None,
             vbms_client=None,
-            queue=None,
+            jobs=None,
             env_name="demo"
         )
 
@@ -103,16 +339,139 @@ class DownloadEFolder(object):
         t = self.jinja_env.get_template(template_name)
         return t.render(dict(data, env=self.env_name))
 
+    def run_job(self, job):
+        # Cancelling a job (because its download was cancelled, or its
+        # deadline passed) aborts the document fetches it has in flight.
+        d = Deferred(canceller=lambda _: self.vbms_client.abort([
+            self._writers[id]
+            for id in job.payload.get("document_ids", [])
+            if id in self._writers
+        ]))
+
+        def finished(result):
+            # Once the job is cancelled, its eventual result is ignored.
+            if not d.called:
+                d.callback(result)
+        self._run_job(job).addBoth(finished)
+        return d
+
+    @inlineCallbacks
+    def _run_job(self, job):
+        logger = self.logger.bind(
+            file_number=job.payload["file_number"], request_id=job.request_id
+        )
+        if job.kind == LIST_DOCUMENTS:
+            yield self.start_download(
+                job.payload["file_number"], job.request_id
+            )
+        elif job.kind == FETCH_DOCUMENTS:
+            documents = yield self.download_database.get_documents(
+                logger, job.payload["document_ids"]
+            )
+            yield self.start_documents_download(
+                logger,
+                [
+                    doc for doc in documents
+                    if doc.content_location is None and not doc.errored
+                ],
+                self.retry_budget(
+                    job.request_id, job.payload["document_count"]
+                ),
+            )
+        else:
+            raise ValueError("Unknown job kind: {}".format(job.kind))
+
+    def queue_download(self, logger, file_number, request_id):
+        return self.jobs.put(logger, [
+            self._list_documents_job(file_number, request_id)
+        ])
+
+    def _list_documents_job(self, file_number, request_id):
+        return Job.create(
+            LIST_DOCUMENTS, request_id, MANIFEST, {"file_number": file_number}
+        )
+
     @inlineCallbacks
     def start_download(self, file_number, request_id):
         logger = self.logger.bind(
             file_number=file_number, request_id=request_id
         )
 
+        download = yield self.download_database.get_download(
+            logger, request_id
+        )
+        if download.state != "STARTED":
+            # An earlier attempt at this job already finished listing.
+            return
+        if download.documents:
+            # An earlier attempt created the documents, but may not have
+            # queued them.
+            documents = download.documents
+        else:
+            documents = yield self._list_documents(logger, file_number)
+            if documents is None:
+                yield self.download_database.mark_download_errored(
+                    logger, request_id
+                )
+                return
+            # Listing can take a while, and the download may have been
+            # cancelled meanwhile.
+            download = yield self.download_database.get_download_progress(
+                logger, request_id
+            )
+            if download.state != "STARTED":
+                return
+            documents = [
+                Document.from_json(request_id, doc)
+                for doc in documents
+            ]
+            yield self.download_database.create_documents(logger, documents)
+
+        documents = [
+            doc for doc in documents
+            if doc.content_location is None and not doc.errored
+        ]
+        # Documents which an earlier download already fetched are reused,
+        # rather than fetched from VBMS again.
+        reused = yield self.download_database.reuse_blobs(logger, documents)
+        logger.bind(
+            documents=len(documents),
+            reused=len(reused),
+        ).emit("list_documents.reused")
+        yield self.queue_document_downloads(logger, file_number, [
+            doc for doc in documents if doc.content_location is None
+        ])
+        listed = (
+            yield self.download_database.mark_download_manifest_downloaded(
+                logger, request_id
+            )
+        )
+        if not listed:
+            # It was cancelled after the check above, so the jobs just
+            # queued are cancelled too.
+            yield self.cancel_download(logger, request_id)
+
+    @inlineCallbacks
+    def _list_documents(self, logger, file_number):
+        """
+        Returns the ``ListDocuments`` response for ``file_number``, from the
+        manifest cache if it's fresh, or ``None`` if VBMS fails.
+        """
+        now = datetime.datetime.utcnow()
+        manifest = yield self.download_database.get_manifest(
+            logger, file_number
+        )
+        if (
+            manifest is not None and
+            now - manifest[1] < self.manifest_cache_ttl
+        ):
+            logger.emit("list_documents.cached")
+            returnValue(manifest[0])
+
         logger.emit("list_documents.start")
         try:
             documents = yield self.vbms_client.list_documents(
-                logger, file_number
+                logger, file_number, self.make_retry_budget(0)
             )
         except VBMSError as e:
             logger.bind(
@@ -120,35 +479,143 @@ class DownloadEFolder(object):
                 stderr=e.stderr,
                 exit_code=e.exit_code,
             ).emit("list_documents.error")
-            yield self.download_database.mark_download_errored(
-                logger, request_id
-            )
-        else:
-            logger.emit("list_documents.success")
+            returnValue(None)
+        logger.emit("list_documents.success")
+        yield self.download_database.set_manifest(
+            logger, file_number, documents, now
+        )
+        returnValue(documents)
 
-            documents = [
-                Document.from_json(request_id, doc)
-                for doc in documents
-            ]
-            yield self.download_database.create_documents(logger, documents)
-            for doc in documents:
-                self.queue.put(functools.partial(
-                    self.start_file_download, logger, doc
-                ))
-            yield self.download_database.mark_download_manifest_downloaded(
-                logger, request_id
-            )
+    def make_retry_budget(self, document_count):
+        return RetryBudget(max(
+            self.min_retry_budget,
+            int(document_count * self.retry_budget_ratio),
+        ))
+
+    def retry_budget(self, request_id, document_count):
+        """
+        Returns the retry budget shared by the jobs of ``request_id`` which
+        this process is running.
+        """
+        retry_budget = self._retry_budgets.get(request_id)
+        if retry_budget is None:
+            retry_budget = self.make_retry_budget(document_count)
+            self._retry_budgets[request_id] = retry_budget
+        return retry_budget
+
+    def queue_document_downloads(self, logger, file_number, documents):
+        """
+        Queues jobs to fetch the documents of a single download, grouped into
+        batches of ``fetch_batch_size`` which are each fetched with one VBMS
+        call.
+        """
+        return self.jobs.put(
+            logger, self._fetch_documents_jobs(file_number, documents)
+        )
+
+    def _fetch_documents_jobs(self, file_number, documents):
+        return [
+            Job.create(FETCH_DOCUMENTS, documents[i].download_id, DOCUMENTS, {
+                "file_number": file_number,
+                "document_ids": [
+                    doc.id for doc in documents[i:i + self.fetch_batch_size]
+                ],
+                "document_count": len(documents),
+            })
+            for i in xrange(0, len(documents), self.fetch_batch_size)
+        ]
 
     @inlineCallbacks
-    def start_file_download(self, logger, document):
-        logger = logger.bind(document_id=document.document_id)
-        logger.emit("get_document.start")
+    def start_documents_download(self, logger, documents, retry_budget=None):
+        reused = yield self.download_database.reuse_blobs(logger, documents)
+        for doc in reused:
+            logger.bind(
+                document_id=doc.document_id
+            ).emit("get_document.reused")
+        documents = [doc for doc in documents if doc not in reused]
+
+        # Documents which are already being fetched (by another download, or
+        # earlier in this batch) wait for that fetch, and then reuse its blob.
+        fetching = []
+        waiting = []
+        for doc in documents:
+            if (
+                doc.document_id in self._document_fetches or
+                doc.document_id in {d.document_id for d in fetching}
+            ):
+                waiting.append(doc)
+            else:
+                fetching.append(doc)
+
+        writers = []
+        for doc in fetching:
+            logger.bind(document_id=doc.document_id).emit("get_document.start")
+            writers.append(EncryptingWriter(
+                self.fernet, self.blob_store, self.blob_store.new_key()
+            ))
+            self._writers[doc.id] = writers[-1]
+        results = []
+        if fetching:
+            results = self.vbms_client.stream_documents_batch(
+                logger.bind(
+                    document_ids=[doc.document_id for doc in fetching]
+                ),
+                [str(doc.document_id) for doc in fetching],
+                writers,
+                retry_budget,
+            )
+        finished = [
+            self._document_fetches.run(
+                doc.document_id,
+                self._finish_file_download,
+                logger.bind(document_id=doc.document_id),
+                doc,
+                writer,
+                d,
+            )
+            for doc, writer, d in zip(fetching, writers, results)
+        ]
+        for doc in waiting:
+            logger.bind(
+                document_id=doc.document_id,
+                coalesced=self._document_fetches.coalesced + 1,
+            ).emit("get_document.coalesced")
+            finished.append(self._finish_coalesced_download(
+                logger, doc, retry_budget
+            ))
+        yield gatherResults(finished, consumeErrors=True)
 
+    @inlineCallbacks
+    def _finish_coalesced_download(self, logger, document, retry_budget):
         try:
-            contents = yield self.vbms_client.fetch_document_contents(
-                logger, str(document.document_id)
+            yield self._document_fetches.run(
+                document.document_id, lambda: None
             )
+        except VBMSAbortedError:
+            # The job fetching it was cancelled.
+            pass
+        # If the fetch we waited for failed, this fetches the document again.
+        yield self.start_documents_download(logger, [document], retry_budget)
+
+    @inlineCallbacks
+    def _finish_file_download(self, logger, document, writer, d):
+        try:
+            yield d
+        except VBMSAbortedError:
+            # The job was cancelled. The document isn't errored, so the job
+            # fetches it again if it's retried.
+            yield writer.abort()
+            logger.emit("get_document.aborted")
+            raise
+        except CircuitOpenError:
+            # VBMS was still down when the retries ran out. That says nothing
+            # about this document, so rather than erroring it, the job fails
+            # and is retried once its lease expires.
+            yield writer.abort()
+            logger.emit("get_document.circuit_open")
+            raise
         except VBMSError as e:
+            yield writer.abort()
             logger.bind(
                 stdout=e.stdout,
                 stderr=e.stderr,
@@ -157,38 +624,198 @@ class DownloadEFolder(object):
             yield self.download_database.mark_document_errored(
                 logger, document
             )
+        except Exception:
+            # Anything else (such as the fetch being cancelled) leaves the
+            # document to be fetched again, without a partial blob.
+            yield writer.abort()
+            raise
         else:
             logger.emit("get_document.success")
-            target = self.storage_path.child(str(uuid.uuid4()))
-            target.setContent(self.fernet.encrypt(contents))
-            yield self.download_database.set_document_content_location(
-                logger, document, target.path
+            yield writer.close()
+            location = yield self.download_database.add_blob(
+                logger, document, writer.content_hash, writer.key
             )
+            if location != writer.key:
+                # Another download stored this document while we were
+                # fetching it.
+                yield self.blob_store.delete(writer.key)
+        finally:
+            self._writers.pop(document.id, None)
+
+    def refresh_document_types(self):
+        """
+        Loads the document types stored in the database the first time it's
+        called, and fetches them from VBMS again (storing the result) if
+        they're missing or older than ``document_types_ttl``. If VBMS or the
+        database fails, the types already loaded continue to be used.
+        """
+        return log_failures(
+            self.logger,
+            "document_types.refresh_error",
+            self._refresh_document_types,
+        )
 
     @inlineCallbacks
-    def start_fetch_document_types(self):
-        document_types = yield self.vbms_client.get_document_types(self.logger)
-        self.document_types.completed({
+    def _refresh_document_types(self):
+        if not self._document_types_loaded:
+            document_types, fetched_at = (
+                yield self.download_database.get_document_types(self.logger)
+            )
+            self.document_types = document_types
+            self.document_types_fetched_at = fetched_at
+            self._document_types_loaded = True
+
+        now = datetime.datetime.utcnow()
+        if (
+            self.document_types_fetched_at is not None and
+            now - self.document_types_fetched_at < self.document_types_ttl
+        ):
+            return
+
+        self.logger.emit("get_document_types.start")
+        try:
+            document_types = yield self.vbms_client.get_document_types(
+                self.logger
+            )
+        except VBMSError as e:
+            self.logger.bind(
+                stdout=e.stdout,
+                stderr=e.stderr,
+                exit_code=e.exit_code,
+            ).emit("get_document_types.error")
+            return
+        self.logger.emit("get_document_types.success")
+
+        document_types = {
             int(c["type_id"]): c["description"]
             for c in document_types
-        })
+        }
+        yield self.download_database.replace_document_types(
+            self.logger, document_types, now
+        )
+        self.document_types = document_types
+        self.document_types_fetched_at = now
+
+    def admit_waiting_downloads(self):
+        """
+        Starts as many of the longest-waiting ``WAITING`` downloads as there
+        is room for. Without admission control, that's all of them: they were
+        left waiting while it was turned on.
+        """
+        return log_failures(
+            self.logger, "admission.error", self._admit_waiting_downloads
+        )
 
     @inlineCallbacks
-    def queue_pending_work(self):
+    def _admit_waiting_downloads(self):
+        capacity = None
+        if self.admission is not None:
+            active, queued, _ = (
+                yield self.download_database.get_admission_counts(self.logger)
+            )
+            capacity = self.admission.capacity(active, queued)
+            if not capacity:
+                return
+        waiting = yield self.download_database.get_waiting_downloads(
+            self.logger, capacity
+        )
+        for request_id, file_number in waiting:
+            # Another process may have started it first.
+            started = yield self.download_database.mark_download_started(
+                self.logger, request_id
+            )
+            if not started:
+                continue
+            logger = self.logger.bind(
+                request_id=request_id, file_number=file_number
+            )
+            logger.emit("download.admitted")
+            yield self.queue_download(logger, file_number, request_id)
+            if self.admission is not None:
+                self.admission.record_start()
+
+    @inlineCallbacks
+    def cancel_download(self, logger, request_id):
+        """
+        Cancels a download which hasn't finished: its queued work is dropped,
+        and its in-flight document fetches are aborted.
+        """
+        cancelled = yield self.download_database.cancel_download(
+            logger, request_id
+        )
+        if cancelled:
+            logger.emit("download.cancelled")
+        if self.jobs is not None:
+            # Other processes notice at their next heartbeat.
+            self.jobs.cancel(request_id)
+
+    def check_abandoned_downloads(self):
+        """
+        Moves the work of downloads whose status page hasn't been polled for
+        ``deprioritize_after`` seconds behind everyone else's, and cancels
+        them after ``cancel_after`` seconds.
+        """
+        return log_failures(
+            self.logger, "abandonment.error", self._check_abandoned_downloads
+        )
+
+    @inlineCallbacks
+    def _check_abandoned_downloads(self):
+        now = datetime.datetime.utcnow()
+        if self.deprioritize_after is not None:
+            abandoned = yield self.download_database.get_abandoned_downloads(
+                self.logger,
+                now - datetime.timedelta(seconds=self.deprioritize_after),
+            )
+            for request_id in abandoned:
+                yield self.download_database.deprioritize_jobs(
+                    self.logger, request_id
+                )
+                self.jobs.scheduler.deprioritize(request_id)
+        if self.cancel_after is not None:
+            abandoned = yield self.download_database.get_abandoned_downloads(
+                self.logger,
+                now - datetime.timedelta(seconds=self.cancel_after),
+            )
+            for request_id in abandoned:
+                yield self.cancel_download(
+                    self.logger.bind(request_id=request_id, abandoned=True),
+                    request_id,
+                )
+
+    @inlineCallbacks
+    def queue_pending_work(self, page_size=1000):
+        """
+        Queues jobs for the pending work of downloads which were started
+        before work was stored in the ``jobs`` table. Only needed once, after
+        upgrading.
+        """
         downloads, documents = yield self.download_database.get_pending_work(
             self.logger
         )
-        for download in downloads:
-            self.queue.put(functools.partial(
-                self.start_download, download.file_number, download.request_id,
-            ))
+        jobs = [
+            self._list_documents_job(download.file_number, download.request_id)
+            for download in downloads
+        ]
+        documents_by_download = {}
         for document in documents:
-            # TODO: self.logger doesn't include any info about the
-            # DownloadStatus. When triggered from the "usual" path it has
-            # ``file_number`` and ``request_id`` keys.
-            self.queue.put(functools.partial(
-                self.start_file_download, self.logger, document
+            documents_by_download.setdefault(
+                document.download_id, []
+            ).append(document)
+        file_numbers = yield self.download_database.get_file_numbers(
+            self.logger, documents_by_download
+        )
+        for download_id, download_documents in documents_by_download.items():
+            jobs.extend(self._fetch_documents_jobs(
+                file_numbers[download_id], download_documents
             ))
+        for i in xrange(0, len(jobs), page_size):
+            yield self.jobs.put(self.logger, jobs[i:i + page_size])
+        self.logger.bind(
+            downloads=len(downloads),
+            documents=len(documents),
+            jobs=len(jobs),
+        ).emit("queue_pending_work")
 
     @app.route("/")
     @instrumented_route
@@ -209,13 +836,30 @@ class DownloadEFolder(object):
         file_number = file_number.replace("-", "").replace(" ", "")
 
         request_id = str(uuid.uuid4())
-
-        yield self.download_database.create_download(
-            self.logger, request_id, file_number
+        logger = self.logger.bind(
+            request_id=request_id, file_number=file_number
         )
-        self.queue.put(functools.partial(
-            self.start_download, file_number, request_id
-        ))
+
+        decision = START
+        if self.admission is not None:
+            decision = yield self.admission.check(logger)
+        if decision == REJECT:
+            logger.emit("download.rejected")
+            request.setResponseCode(503)
+            request.setHeader("Retry-After", str(self.admission.retry_after))
+            returnValue(self.render_template("busy.html"))
+        elif decision == START:
+            yield self.download_database.create_download(
+                self.logger, request_id, file_number
+            )
+            yield self.queue_download(self.logger, file_number, request_id)
+            if self.admission is not None:
+                self.admission.record_start()
+        else:
+            logger.emit("download.waiting")
+            yield self.download_database.create_download(
+                self.logger, request_id, file_number, state="WAITING"
+            )
 
         request.redirect("/efolder-express/download/{}/".format(request_id))
         returnValue(None)
@@ -225,34 +869,78 @@ class DownloadEFolder(object):
     @inlineCallbacks
     def download_status(self, request, request_id):
         download = yield self.download_database.get_download(
-            self.logger, request_id=request_id
+            self.logger, request_id=request_id, read_only=True
         )
-        returnValue(self.render_template("download.html", {
-            "status": download
-        }))
+        yield self.download_database.touch_download(self.logger, request_id)
+        data = yield self._download_status_data(download)
+        returnValue(self.render_template("download.html", data))
+
+    @app.route(
+        "/efolder-express/download/<request_id>/cancel/", methods=["POST"]
+    )
+    @instrumented_route
+    @inlineCallbacks
+    def download_cancel(self, request, request_id):
+        yield self.cancel_download(
+            self.logger.bind(request_id=request_id), request_id
+        )
+        request.redirect("/efolder-express/download/{}/".format(request_id))
+        returnValue(None)
 
     @app.route("/efolder-express/download/<request_id>/json/")
     @instrumented_route
     @inlineCallbacks
     def download_status_json(self, request, request_id):
-        download = yield self.download_database.get_download(
-            self.logger, request_id=request_id
+        # Polled every couple of seconds, so only the progress counts are
+        # loaded, not every document.
+        download = yield self.download_database.get_download_progress(
+            self.logger, request_id=request_id, read_only=True
         )
-        html = self.render_template("_download_status.html", {
-            "status": download,
-        })
+        yield self.download_database.touch_download(self.logger, request_id)
+        data = yield self._download_status_data(download)
+        html = self.render_template("_download_status.html", data)
         request.setHeader("Content-Type", "application/json")
         returnValue(json.dumps({
-            "completed": download.completed or download.state == "ERRORED",
+            "completed": bool(
+                download.completed or
+                download.state in ["ERRORED", "CANCELLED"]
+            ),
+            "position": data["position"],
+            "estimated_start": data["estimated_start"],
             "html": html,
         }))
 
+    @inlineCallbacks
+    def _download_status_data(self, download):
+        """
+        Returns the template data for a download's status, including its
+        position in line (and roughly when it'll start) if it's waiting.
+        """
+        position = estimated_start = None
+        if download.state == "WAITING":
+            position = yield self.download_database.get_waiting_position(
+                self.logger, download.request_id
+            )
+            wait = None
+            if self.admission is not None:
+                wait = self.admission.estimated_wait(position)
+            if wait is not None:
+                estimated_start = (
+                    datetime.datetime.utcnow() +
+                    datetime.timedelta(seconds=wait)
+                ).strftime("%H:%M UTC")
+        returnValue({
+            "status": download,
+            "position": position,
+            "estimated_start": estimated_start,
+        })
+
     @app.route("/efolder-express/download/<request_id>/zip/")
     @instrumented_route
     @inlineCallbacks
     def download_zip(self, request, request_id):
         download = yield self.download_database.get_download(
-            self.logger, request_id=request_id
+            self.logger, request_id=request_id, read_only=True
         )
         assert download.completed
 
@@ -261,8 +949,9 @@ class DownloadEFolder(object):
             file_number=download.file_number,
         ).emit("download")
 
-        document_types = yield self.document_types.wait()
-        path = download.build_zip(self.jinja_env, self.fernet, document_types)
+        path = yield download.build_zip(
+            self.jinja_env, self.fernet, self.document_types, self.blob_store
+        )
 
         request.setHeader(
             "Content-Disposition",
@@ -0,0 +1,86 @@
+from twisted.internet.defer import Deferred, DeferredList
+
+
+class WriteBatcher(object):
+    """
+    Groups writes into as few transactions (and so, on SQLite, fsyncs) as
+    possible.
+
+    Each call to ``add`` is a list of queries, which are committed together
+    with any others added within ``max_delay`` seconds, up to ``max_size``
+    calls at a time, by ``execute_transaction(logger, queries)``, which
+    returns a ``Deferred`` of a list with a result for each query. Only one
+    batch is committed at a time, and writes added meanwhile go in the next
+    batch, as soon as it's done. If a batch fails, its writes are retried one
+    transaction each, so that one bad write doesn't fail the rest.
+    """
+
+    def __init__(self, clock, execute_transaction, max_delay, max_size):
+        self._clock = clock
+        self._execute_transaction = execute_transaction
+        self._max_delay = max_delay
+        self._max_size = max_size
+
+        # (logger, queries, Deferred) for each write not yet committed.
+        self._pending = []
+        self._delayed_call = None
+        self._committing = False
+
+    def add(self, logger, queries):
+        """
+        Returns a ``Deferred`` which fires, with the results of ``queries``,
+        once they're committed.
+        """
+        d = Deferred()
+        self._pending.append((logger, queries, d))
+        if len(self._pending) >= self._max_size:
+            self.flush()
+        elif self._delayed_call is None:
+            self._delayed_call = self._clock.callLater(
+                self._max_delay, self.flush
+            )
+        return d
+
+    def flush(self):
+        """
+        Starts committing the pending writes, unless a batch is already being
+        committed (in which case they're committed as soon as it's done).
+        """
+        if self._delayed_call is not None:
+            if self._delayed_call.active():
+                self._delayed_call.cancel()
+            self._delayed_call = None
+        if self._committing or not self._pending:
+            return
+        batch = self._pending[:self._max_size]
+        del self._pending[:self._max_size]
+        self._committing = True
+
+        logger = batch[0][0].bind(batch_size=len(batch))
+        d = self._execute_transaction(logger, [
+            query for _, queries, _ in batch for query in queries
+        ])
+        d.addCallbacks(self._committed, self._batch_failed, [batch], {},
+                       [batch], {})
+        d.addBoth(self._done)
+
+    def _committed(self, results, batch):
+        for _, queries, d in batch:
+            d.callback(results[:len(queries)])
+            results = results[len(queries):]
+
+    def _batch_failed(self, failure, batch):
+        batch[0][0].bind(
+            batch_size=len(batch), error=failure.getErrorMessage(),
+        ).emit("write_batch.failed")
+        retries = []
+        for logger, queries, d in batch:
+            retry = self._execute_transaction(logger, queries)
+            retry.chainDeferred(d)
+            retries.append(retry)
+        return DeferredList(retries)
+
+    def _done(self, result):
+        self._committing = False
+        # Anything added meanwhile has already waited for a whole commit.
+        self.flush()
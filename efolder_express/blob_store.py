@@ -0,0 +1,366 @@
+import calendar
+import collections
+import hashlib
+import os
+import shutil
+import tempfile
+import uuid
+
+from twisted.internet.defer import inlineCallbacks, returnValue, succeed
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.filepath import FilePath
+
+
+# ``size`` is in bytes, and ``modified_at`` in seconds since the epoch.
+BlobStat = collections.namedtuple("BlobStat", ["size", "modified_at"])
+
+COPY_CHUNK_SIZE = 64 * 1024
+
+
+class FilesystemBlobStore(object):
+    """
+    Stores encrypted documents as files under ``root``.
+
+    Each blob is filed under ``levels`` subdirectories named after successive
+    ``width``-character prefixes of the SHA-1 of its key (``ab/cd/<key>``), so
+    that no one directory ends up with millions of entries.
+
+    Every blob store has the same interface: keys are opaque strings, which
+    are what documents' ``content_location`` holds, and every method but
+    ``new_key`` and ``open_writer`` returns a ``Deferred``.
+
+    Before the layout was sharded, ``content_location`` was the absolute path
+    of a file directly under ``root``. Those keys can still be read and
+    deleted until they're moved (see ``move_legacy_blobs``).
+    """
+
+    def __init__(self, root, levels=2, width=2):
+        self._root = root
+        self._levels = levels
+        self._width = width
+
+    def new_key(self):
+        return str(uuid.uuid4())
+
+    def _path(self, key):
+        if os.path.isabs(key):
+            return FilePath(key)
+        digest = hashlib.sha1(key).hexdigest()
+        path = self._root
+        for i in xrange(self._levels):
+            path = path.child(digest[i * self._width:(i + 1) * self._width])
+        return path.child(key)
+
+    def open_writer(self, key):
+        """
+        Returns a file to write the blob ``key`` into. It's stored once the
+        file's ``close()`` (which returns a ``Deferred``) is done, and thrown
+        away by ``discard()``.
+        """
+        path = self._path(key)
+        if not path.parent().exists():
+            path.parent().makedirs()
+        return _FileBlobWriter(path)
+
+    @inlineCallbacks
+    def put(self, key, f):
+        """
+        Stores the contents of the file ``f`` as the blob ``key``.
+        """
+        writer = self.open_writer(key)
+        shutil.copyfileobj(f, writer, COPY_CHUNK_SIZE)
+        yield writer.close()
+
+    def open(self, key):
+        """
+        Returns the blob ``key``, as a file to read.
+        """
+        return succeed(self._path(key).open())
+
+    def delete(self, key):
+        """
+        Deletes the blob ``key``. Returns its size, or ``None`` if there was
+        no such blob.
+        """
+        path = self._path(key)
+        try:
+            size = path.getsize()
+            path.remove()
+        except OSError:
+            return succeed(None)
+        return succeed(size)
+
+    def stat(self, key):
+        """
+        Returns the ``BlobStat`` of the blob ``key``, or ``None`` if there's
+        no such blob.
+        """
+        path = self._path(key)
+        try:
+            path.restat()
+        except OSError:
+            return succeed(None)
+        return succeed(BlobStat(path.getsize(), path.getModificationTime()))
+
+    def list_keys(self, after, limit):
+        """
+        Returns up to ``limit`` keys, in the store's own order, starting
+        after ``after`` (``None`` for the first). Blobs which haven't been
+        moved out of the old flat layout aren't listed.
+        """
+        after_path = None
+        if after is not None:
+            after_path = self._path(after).segmentsFrom(self._root)
+        keys = []
+        for segments in self._walk(self._root, self._levels, after_path):
+            keys.append(segments[-1])
+            if len(keys) == limit:
+                break
+        return succeed(keys)
+
+    def _walk(self, directory, depth, after):
+        """
+        Yields the path segments (relative to ``directory``) of the files
+        ``depth`` subdirectories down, in order, skipping those up to and
+        including ``after``.
+        """
+        try:
+            names = sorted(directory.listdir())
+        except OSError:
+            return
+        if after:
+            names = [name for name in names if name >= after[0]]
+        for name in names:
+            child = directory.child(name)
+            if depth == 0:
+                if after and name == after[0]:
+                    continue
+                if child.isfile():
+                    yield [name]
+            elif child.isdir():
+                rest = after[1:] if after and name == after[0] else None
+                for segments in self._walk(child, depth - 1, rest):
+                    yield [name] + segments
+
+
+class _FileBlobWriter(object):
+    def __init__(self, path):
+        self._path = path
+        self._f = path.open("w")
+
+    def write(self, data):
+        self._f.write(data)
+
+    def seek(self, offset):
+        self._f.seek(offset)
+
+    def truncate(self):
+        self._f.truncate()
+
+    def tell(self):
+        return self._f.tell()
+
+    def close(self):
+        self._f.close()
+        return succeed(None)
+
+    def discard(self):
+        self._f.close()
+        self._path.remove()
+        return succeed(None)
+
+
+class ObjectBlobStore(object):
+    """
+    Stores encrypted documents as objects in ``bucket``, with ``prefix``
+    prepended to their keys, using ``client`` (a boto3 S3 client, or anything
+    with the same ``put_object``, ``get_object``, ``head_object``,
+    ``delete_object`` and ``list_objects_v2`` methods).
+
+    The client blocks, so it's only ever called in ``thread_pool``. Blobs are
+    written to a local temporary file and uploaded in one go when they're
+    closed, and read back the same way, so the reactor thread never waits on
+    the network.
+
+    The interface is the same as ``FilesystemBlobStore``'s.
+    """
+
+    def __init__(self, reactor, thread_pool, client, bucket, prefix=""):
+        self._reactor = reactor
+        self._thread_pool = thread_pool
+        self._client = client
+        self._bucket = bucket
+        self._prefix = prefix
+
+    def _call(self, method, key, **kwargs):
+        return deferToThreadPool(
+            self._reactor,
+            self._thread_pool,
+            getattr(self._client, method),
+            Bucket=self._bucket,
+            Key=self._prefix + key,
+            **kwargs
+        )
+
+    def new_key(self):
+        return str(uuid.uuid4())
+
+    def open_writer(self, key):
+        return _ObjectBlobWriter(self, key)
+
+    def put(self, key, f):
+        return self._call("put_object", key, Body=f)
+
+    def open(self, key):
+        return deferToThreadPool(
+            self._reactor, self._thread_pool, self._download, key
+        )
+
+    def _download(self, key):
+        body = self._client.get_object(
+            Bucket=self._bucket, Key=self._prefix + key
+        )["Body"]
+        f = tempfile.TemporaryFile()
+        while True:
+            chunk = body.read(COPY_CHUNK_SIZE)
+            if not chunk:
+                break
+            f.write(chunk)
+        f.seek(0)
+        return f
+
+    @inlineCallbacks
+    def delete(self, key):
+        blob_stat = yield self.stat(key)
+        if blob_stat is None:
+            returnValue(None)
+        yield self._call("delete_object", key)
+        returnValue(blob_stat.size)
+
+    @inlineCallbacks
+    def stat(self, key):
+        try:
+            response = yield self._call("head_object", key)
+        except Exception as e:
+            if _is_not_found(e):
+                returnValue(None)
+            raise
+        returnValue(BlobStat(
+            response["ContentLength"],
+            calendar.timegm(response["LastModified"].utctimetuple()),
+        ))
+
+    @inlineCallbacks
+    def list_keys(self, after, limit):
+        kwargs = {"Prefix": self._prefix, "MaxKeys": limit}
+        if after is not None:
+            kwargs["StartAfter"] = self._prefix + after
+        response = yield deferToThreadPool(
+            self._reactor,
+            self._thread_pool,
+            self._client.list_objects_v2,
+            Bucket=self._bucket,
+            **kwargs
+        )
+        returnValue([
+            obj["Key"][len(self._prefix):]
+            for obj in response.get("Contents", [])
+        ])
+
+
+def _is_not_found(e):
+    # botocore's ``ClientError``, without importing it.
+    error = getattr(e, "response", {}).get("Error", {})
+    return error.get("Code") in ("404", "NoSuchKey", "NotFound")
+
+
+class _ObjectBlobWriter(object):
+    def __init__(self, store, key):
+        self._store = store
+        self._key = key
+        self._f = tempfile.TemporaryFile()
+
+    def write(self, data):
+        self._f.write(data)
+
+    def seek(self, offset):
+        self._f.seek(offset)
+
+    def truncate(self):
+        self._f.truncate()
+
+    def tell(self):
+        return self._f.tell()
+
+    @inlineCallbacks
+    def close(self):
+        self._f.seek(0)
+        try:
+            yield self._store.put(self._key, self._f)
+        finally:
+            self._f.close()
+
+    def discard(self):
+        self._f.close()
+        return succeed(None)
+
+
+def blob_store_from_config(reactor, config):
+    """
+    Builds the blob store described by the ``storage`` section of the
+    config.
+    """
+    if "object_store" in config:
+        # Only needed for this backend.
+        import boto3
+
+        object_config = config["object_store"]
+        client = boto3.client(
+            "s3",
+            endpoint_url=object_config.get("endpoint_url"),
+            region_name=object_config.get("region"),
+        )
+        return ObjectBlobStore(
+            reactor,
+            reactor.getThreadPool(),
+            client,
+            object_config["bucket"],
+            prefix=object_config.get("prefix", ""),
+        )
+    return FilesystemBlobStore(
+        FilePath(config["filesystem"]),
+        levels=config.get("levels", 2),
+    )
+
+
+@inlineCallbacks
+def move_legacy_blobs(logger, download_database, blob_store, batch_size=100):
+    """
+    Moves the files of blobs and documents which are still in the old, flat
+    storage directory into ``blob_store``, ``batch_size`` at a time. Each
+    file's key is its name. Files which are missing are forgotten, and the
+    documents which used them are counted as errored.
+    """
+    moved = missing = 0
+    while True:
+        locations = yield download_database.get_legacy_locations(
+            logger, batch_size
+        )
+        for location in locations:
+            path = FilePath(location)
+            if not path.isfile():
+                yield download_database.forget_location(logger, location)
+                missing += 1
+                logger.bind(path=location).emit("blob_store.missing_file")
+                continue
+            key = path.basename()
+            with path.open() as f:
+                yield blob_store.put(key, f)
+            # The file is only removed once nothing points at it.
+            yield download_database.rename_blob(logger, location, key)
+            path.remove()
+            moved += 1
+        if len(locations) < batch_size:
+            break
+    logger.bind(moved=moved, missing=missing).emit("blob_store.moved_legacy")
+    returnValue(moved)
@@ -0,0 +1,91 @@
+#!/usr/bin/env ruby
+#
+# Resident connect_vbms worker. The first frame on stdin is a JSON object with
+# the VBMS client configuration, every following frame is a JSON request of
+# the form {"request": "<name>", "args": [...]}. Every frame is prefixed with
+# its length as a 4-byte big-endian integer.
+#
+# Each request is answered with a JSON header frame, either {"status": "ok"}
+# or {"status": "error", "error": "..."}. An "ok" header is followed by the
+# response body, split into frames of at most CHUNK_SIZE bytes, and terminated
+# by an empty frame.
+
+require 'json'
+
+CHUNK_SIZE = 64 * 1024
+
+INPUT = STDIN
+INPUT.binmode
+OUTPUT = STDOUT.dup
+OUTPUT.binmode
+# Anything the vbms gem prints must not end up in the middle of our frames.
+STDOUT.reopen(STDERR)
+
+def read_frame
+  header = INPUT.read(4)
+  return nil if header.nil? || header.bytesize < 4
+  length = header.unpack('N')[0]
+  data = INPUT.read(length)
+  return nil if data.nil? || data.bytesize < length
+  data
+end
+
+def write_frame(data)
+  data = data.to_s.b
+  OUTPUT.write([data.bytesize].pack('N'))
+  OUTPUT.write(data)
+end
+
+config = JSON.parse(read_frame)
+
+$LOAD_PATH << File.join(config['connect_vbms_path'], 'src')
+
+require 'vbms'
+
+client = VBMS::Client.new(
+  config['endpoint_url'],
+  config['keyfile'],
+  config['samlfile'],
+  config['key'],
+  config['keypass'],
+  config['ca_cert'],
+  config['client_cert']
+)
+
+REQUESTS = {
+  'GetDocumentTypes' => lambda do |_args|
+    VBMS::Requests::GetDocumentTypes.new
+  end,
+  'ListDocuments' => lambda do |args|
+    VBMS::Requests::ListDocuments.new(args[0])
+  end,
+  'FetchDocumentById' => lambda do |args|
+    VBMS::Requests::FetchDocumentById.new(args[0])
+  end,
+}
+
+FORMATTERS = {
+  'GetDocumentTypes' => lambda { |result| result.map(&:to_h).to_json },
+  'ListDocuments' => lambda { |result| result.map(&:to_h).to_json },
+  'FetchDocumentById' => lambda { |result| result.content },
+}
+
+while (frame = read_frame)
+  message = JSON.parse(frame)
+  begin
+    request = REQUESTS.fetch(message['request']).call(message['args'])
+    body = FORMATTERS.fetch(message['request']).call(client.send(request)).to_s
+  rescue StandardError => e
+    write_frame({
+      'status' => 'error',
+      'error' => "#{e.class}: #{e.message}\n#{(e.backtrace || []).join("\n")}",
+    }.to_json)
+  else
+    write_frame({ 'status' => 'ok' }.to_json)
+    (0...body.bytesize).step(CHUNK_SIZE) do |offset|
+      write_frame(body.byteslice(offset, CHUNK_SIZE))
+    end
+    write_frame('')
+  end
+  OUTPUT.flush
+end
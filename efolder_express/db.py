@@ -1,15 +1,31 @@
+import collections
 import datetime
+import json
+import os
 import tempfile
+import time
 import uuid
 import zipfile
 
-import alchimia
-
 import sqlalchemy
 from sqlalchemy.schema import CreateTable
 
 from twisted.internet.defer import inlineCallbacks, returnValue, succeed
 
+from efolder_express.batching import WriteBatcher
+from efolder_express.db_engine import PINNED_STRATEGY
+from efolder_express.migrations import MIGRATIONS
+from efolder_express.scheduler import BACKGROUND, PRIORITIES
+from efolder_express.storage import decrypt_file
+
+
+def _run_transaction(connection, queries):
+    # The whole transaction is run in one call on a database thread, so that
+    # other queries on that thread can't be interleaved with it (with SQLite,
+    # another writer would wait for this one to commit, which it never could).
+    with connection.begin():
+        return [connection.execute(*query).rowcount for query in queries]
+
 
 class DownloadNotFound(Exception):
     def __init__(self, request_id):
@@ -18,30 +34,49 @@ class DownloadNotFound(Exception):
 
 
 class DownloadStatus(object):
-    def __init__(self, request_id, file_number, state, documents):
+    """
+    The progress counts are taken from ``documents`` unless they're given.
+    ``documents`` is ``None`` when only the counts were loaded (see
+    ``DownloadDatabase.get_download_progress``).
+    """
+
+    def __init__(self, request_id, file_number, state, documents,
+                 total_documents=None, completed_documents=None,
+                 errored_documents=None):
         self.request_id = request_id
         self.file_number = file_number
         self.state = state
         self.documents = documents
+        if total_documents is None:
+            total_documents = len(documents)
+            completed_documents = sum(
+                1 for doc in documents if doc.content_location
+            )
+            errored_documents = sum(
+                1 for doc in documents
+                if doc.errored and not doc.content_location
+            )
+        self.total_documents = total_documents
+        self.completed_documents = completed_documents
+        self.errored_documents = errored_documents
 
     @property
     def completed(self):
-        return (
-            self.documents and
-            all(doc.content_location or doc.errored for doc in self.documents)
+        return self.total_documents > 0 and (
+            self.completed_documents + self.errored_documents ==
+            self.total_documents
         )
 
     @property
     def percent_completed(self):
-        if not self.documents:
+        if not self.total_documents:
             return 5
 
-        completed = sum(
-            1 for doc in self.documents if doc.content_location or doc.errored
-        )
-        return int(100 * (completed / float(len(self.documents))))
+        completed = self.completed_documents + self.errored_documents
+        return int(100 * (completed / float(self.total_documents)))
 
-    def build_zip(self, jinja_env, fernet, document_types):
+    @inlineCallbacks
+    def build_zip(self, jinja_env, fernet, document_types, blob_store):
         with zipfile.ZipFile(
             tempfile.NamedTemporaryFile(suffix=".zip", delete=False),
             "w",
@@ -49,19 +84,28 @@ class DownloadStatus(object):
         ) as z:
             for doc in self.documents:
                 if doc.content_location:
-                    with open(doc.content_location) as f:
-                        data = fernet.decrypt(f.read())
+                    # Decrypt into a temporary file, rather than memory, so
+                    # large documents don't have to be held in full.
+                    with tempfile.NamedTemporaryFile() as plaintext:
+                        f = yield blob_store.open(doc.content_location)
+                        with f:
+                            for chunk in decrypt_file(fernet, f):
+                                plaintext.write(chunk)
+                        plaintext.flush()
 
-                    args = ()
-                    if doc.received_at is not None:
-                        args += (
-                            doc.received_at.timetuple()[:6],
+                        date_time = (1980, 1, 1, 0, 0, 0)
+                        if doc.received_at is not None:
+                            date_time = doc.received_at.timetuple()[:6]
+                        # ``ZipFile.write`` takes the entry's timestamp from
+                        # the file's mtime.
+                        mtime = time.mktime(date_time + (0, 0, -1))
+                        os.utime(plaintext.name, (mtime, mtime))
+                        z.write(
+                            plaintext.name,
+                            "{}-eFolder/{}".format(
+                                self.file_number, doc.filename
+                            ),
                         )
-                    info = zipfile.ZipInfo(
-                        "{}-eFolder/{}".format(self.file_number, doc.filename),
-                        *args
-                    )
-                    z.writestr(info, data)
 
             readme_template = jinja_env.get_template("readme.txt")
             z.writestr(
@@ -71,7 +115,7 @@ class DownloadStatus(object):
                     "document_types": document_types,
                 }).encode(),
             )
-        return z.filename
+        returnValue(z.filename)
 
 
 class Document(object):
@@ -107,14 +151,76 @@ class Document(object):
         )
 
 
+class Job(object):
+    """
+    A unit of work in the durable job queue. ``payload`` is a JSON-able
+    dict, and ``lease_owner`` identifies the claim which holds the job's
+    lease.
+    """
+
+    def __init__(self, id, kind, request_id, priority, payload,
+                 lease_owner=None, attempts=0, error=None):
+        self.id = id
+        self.kind = kind
+        self.request_id = request_id
+        self.priority = priority
+        self.payload = payload
+        self.lease_owner = lease_owner
+        self.attempts = attempts
+        self.error = error
+
+    @classmethod
+    def create(cls, kind, request_id, priority, payload):
+        return cls(str(uuid.uuid4()), kind, request_id, priority, payload)
+
+
 class DownloadDatabase(object):
-    def __init__(self, reactor, thread_pool, database_uri):
+    """
+    Each connection is pinned to one of the threads of ``thread_pool`` (see
+    ``DatabaseThreads``). Read-only queries for status pages can be sent to a
+    separate ``read_thread_pool``, and optionally a separate database (such as
+    a replica), so they don't wait behind writes.
+
+    With a ``write_batch_delay``, documents' status updates are committed in
+    batches (see ``WriteBatcher``) of up to ``write_batch_size``.
+
+    With a ``status_cache`` (a ``StatusCache``), ``get_download_progress`` is
+    served from it, and every write to a download's state or counts is
+    applied to it too.
+    """
+
+    def __init__(self, reactor, thread_pool, database_uri,
+                 read_thread_pool=None, read_database_uri=None,
+                 engine_options={}, write_batch_delay=None,
+                 write_batch_size=100, status_cache=None):
         self._engine = sqlalchemy.create_engine(
             database_uri,
-            strategy=alchimia.TWISTED_STRATEGY,
+            strategy=PINNED_STRATEGY,
             reactor=reactor,
             thread_pool=thread_pool,
+            **engine_options
         )
+        self._read_engine = self._engine
+        if read_thread_pool is not None or read_database_uri is not None:
+            self._read_engine = sqlalchemy.create_engine(
+                read_database_uri or database_uri,
+                strategy=PINNED_STRATEGY,
+                reactor=reactor,
+                thread_pool=read_thread_pool or thread_pool,
+                **engine_options
+            )
+
+        self._status_cache = status_cache
+        self._document_writes = None
+        if write_batch_delay is not None:
+            self._document_writes = WriteBatcher(
+                reactor,
+                lambda logger, queries: self._execute_transaction(
+                    logger, "write_documents", queries
+                ),
+                write_batch_delay,
+                write_batch_size,
+            )
 
         self._metadata = sqlalchemy.MetaData()
 
@@ -140,12 +246,42 @@ class DownloadDatabase(object):
             sqlalchemy.Column(
                 "state",
                 sqlalchemy.Enum(
+                    "WAITING",
                     "STARTED",
                     "MANIFEST_DOWNLOADED",
                     "ERRORED",
+                    "CANCELLED",
+                    name="download_state",
                 ),
                 nullable=False,
             ),
+            # When the status page last asked about this download.
+            sqlalchemy.Column(
+                "last_polled_at",
+                sqlalchemy.DateTime(),
+                nullable=True,
+            ),
+            # Counts of this download's documents, so that status pages don't
+            # have to load them all. A document is either completed (it has
+            # a ``content_location``) or errored, whichever happened first.
+            sqlalchemy.Column(
+                "total_documents",
+                sqlalchemy.Integer(),
+                server_default="0",
+                nullable=False,
+            ),
+            sqlalchemy.Column(
+                "completed_documents",
+                sqlalchemy.Integer(),
+                server_default="0",
+                nullable=False,
+            ),
+            sqlalchemy.Column(
+                "errored_documents",
+                sqlalchemy.Integer(),
+                server_default="0",
+                nullable=False,
+            ),
         )
 
         self._documents = sqlalchemy.Table(
@@ -200,22 +336,298 @@ class DownloadDatabase(object):
             ),
         )
 
+        # Indexes are created by the ``create_indexes`` migration.
+        sqlalchemy.Index("ix_downloads_state", self._downloads.c.state)
+        sqlalchemy.Index(
+            "ix_documents_download_id", self._documents.c.download_id
+        )
+        # Only documents which haven't been fetched yet, for
+        # ``get_pending_work``.
+        pending = (
+            self._documents.c.content_location.is_(None) &
+            ~self._documents.c.errored
+        )
+        sqlalchemy.Index(
+            "ix_documents_pending",
+            self._documents.c.id,
+            sqlite_where=pending,
+            postgresql_where=pending,
+        )
+
+        # Every fetched document, keyed by its VBMS ``document_id``, so that
+        # later downloads can reuse the stored file. ``refcount`` is the number
+        # of ``documents`` rows whose ``content_location`` is ``location``.
+        self._blobs = sqlalchemy.Table(
+            "blobs",
+            self._metadata,
+            sqlalchemy.Column(
+                "document_id",
+                sqlalchemy.Text(),
+                primary_key=True,
+                nullable=False,
+            ),
+            sqlalchemy.Column(
+                "content_hash",
+                sqlalchemy.Text(),
+                nullable=False,
+            ),
+            sqlalchemy.Column(
+                "location",
+                sqlalchemy.Text(),
+                nullable=False,
+            ),
+            sqlalchemy.Column(
+                "refcount",
+                sqlalchemy.Integer(),
+                nullable=False,
+            ),
+            sqlalchemy.Column(
+                "created_at",
+                sqlalchemy.DateTime(),
+                nullable=False,
+            ),
+        )
+
+        self._manifests = sqlalchemy.Table(
+            "manifests",
+            self._metadata,
+            sqlalchemy.Column(
+                "file_number",
+                sqlalchemy.Text(),
+                primary_key=True,
+                nullable=False,
+            ),
+            sqlalchemy.Column(
+                "documents",
+                sqlalchemy.Text(),
+                nullable=False,
+            ),
+            sqlalchemy.Column(
+                "fetched_at",
+                sqlalchemy.DateTime(),
+                nullable=False,
+            ),
+        )
+
+        self._jobs = sqlalchemy.Table(
+            "jobs",
+            self._metadata,
+            sqlalchemy.Column(
+                "id",
+                sqlalchemy.Text(),
+                primary_key=True,
+                nullable=False,
+            ),
+            sqlalchemy.Column(
+                "kind",
+                sqlalchemy.Text(),
+                nullable=False,
+            ),
+            sqlalchemy.Column(
+                "request_id",
+                sqlalchemy.Text(),
+                sqlalchemy.ForeignKey("downloads.request_id"),
+                nullable=False,
+            ),
+            # The index of the job's class in ``scheduler.PRIORITIES``.
+            sqlalchemy.Column(
+                "priority",
+                sqlalchemy.Integer(),
+                nullable=False,
+            ),
+            sqlalchemy.Column(
+                "payload",
+                sqlalchemy.Text(),
+                nullable=False,
+            ),
+            sqlalchemy.Column(
+                "created_at",
+                sqlalchemy.DateTime(),
+                nullable=False,
+            ),
+            sqlalchemy.Column(
+                "attempts",
+                sqlalchemy.Integer(),
+                nullable=False,
+            ),
+            sqlalchemy.Column(
+                "lease_owner",
+                sqlalchemy.Text(),
+                nullable=True,
+            ),
+            sqlalchemy.Column(
+                "lease_expires_at",
+                sqlalchemy.DateTime(),
+                nullable=True,
+            ),
+            sqlalchemy.Column(
+                "completed_at",
+                sqlalchemy.DateTime(),
+                nullable=True,
+            ),
+            sqlalchemy.Column(
+                "dead_lettered_at",
+                sqlalchemy.DateTime(),
+                nullable=True,
+            ),
+            sqlalchemy.Column(
+                "error",
+                sqlalchemy.Text(),
+                nullable=True,
+            ),
+        )
+
+        # For retention (see ``delete_downloads``), created by the
+        # ``create_retention_indexes`` migration.
+        sqlalchemy.Index(
+            "ix_downloads_started_at", self._downloads.c.started_at
+        )
+        sqlalchemy.Index(
+            "ix_documents_content_location",
+            self._documents.c.content_location,
+        )
+        sqlalchemy.Index("ix_blobs_location", self._blobs.c.location)
+        sqlalchemy.Index("ix_jobs_request_id", self._jobs.c.request_id)
+
+        self._document_types = sqlalchemy.Table(
+            "document_types",
+            self._metadata,
+            sqlalchemy.Column(
+                "type_id",
+                sqlalchemy.Integer(),
+                primary_key=True,
+                nullable=False,
+            ),
+            sqlalchemy.Column(
+                "description",
+                sqlalchemy.Text(),
+                nullable=False,
+            ),
+            sqlalchemy.Column(
+                "fetched_at",
+                sqlalchemy.DateTime(),
+                nullable=False,
+            ),
+        )
+
+        # Which of ``migrations.MIGRATIONS`` have been applied. Not part of
+        # ``_metadata``, so that migrations never touch it.
+        self._schema_migrations = sqlalchemy.Table(
+            "schema_migrations",
+            sqlalchemy.MetaData(),
+            sqlalchemy.Column(
+                "version",
+                sqlalchemy.Integer(),
+                primary_key=True,
+                autoincrement=False,
+                nullable=False,
+            ),
+            sqlalchemy.Column(
+                "description",
+                sqlalchemy.Text(),
+                nullable=False,
+            ),
+            sqlalchemy.Column(
+                "applied_at",
+                sqlalchemy.DateTime(),
+                nullable=False,
+            ),
+        )
+
+    def create_database(self, logger):
+        # Migrations skip what's already there, so this can also be run
+        # against an existing database to upgrade it.
+        return self.migrate(logger)
+
     @inlineCallbacks
-    def create_database(self):
-        for table in self._metadata.sorted_tables:
-            yield self._engine.execute(CreateTable(table))
+    def migrate(self, logger, target=None):
+        """
+        Applies each migration, up to version ``target`` (by default the
+        latest), which hasn't been applied yet. Returns the versions applied.
+        """
+        if not (yield self._engine.has_table(self._schema_migrations.name)):
+            yield self._engine.execute(CreateTable(self._schema_migrations))
+        applied = {
+            row[self._schema_migrations.c.version]
+            for row in (yield (yield self._execute(
+                logger,
+                "migrate.get_versions",
+                self._schema_migrations.select(),
+            )).fetchall())
+        }
+        if target is None:
+            target = len(MIGRATIONS)
+
+        versions = []
+        for version, migration in enumerate(MIGRATIONS[:target], 1):
+            if version in applied:
+                continue
+            timer = logger.time("migration.{}".format(migration.__name__))
+            yield self._engine.run_with_connection(migration, self._metadata)
+            timer.stop()
+            yield self._execute(
+                logger,
+                "migrate.record_version",
+                self._schema_migrations.insert().values(
+                    version=version,
+                    description=migration.__name__,
+                    applied_at=datetime.datetime.utcnow(),
+                )
+            )
+            logger.bind(
+                version=version, description=migration.__name__
+            ).emit("migration.applied")
+            versions.append(version)
+        returnValue(versions)
 
     @inlineCallbacks
-    def _execute(self, logger, query_name, query, *args):
+    def _execute(self, logger, query_name, query, *args, **kwargs):
+        engine = self._engine
+        if kwargs.pop("read_only", False):
+            engine = self._read_engine
         timer = logger.time("sql.{}".format(query_name))
         try:
-            result = yield self._engine.execute(query, *args)
+            result = yield engine.execute(query, *args)
         finally:
             timer.stop()
         returnValue(result)
 
     @inlineCallbacks
-    def get_pending_work(self, logger):
+    def _execute_transaction(self, logger, query_name, queries):
+        """
+        Executes each of ``queries`` (tuples of arguments to ``execute``) in
+        a single transaction. Returns the number of rows each matched.
+        """
+        timer = logger.time("sql.{}".format(query_name))
+        try:
+            rowcounts = yield self._engine.run_with_connection(
+                _run_transaction, queries
+            )
+        finally:
+            timer.stop()
+        returnValue(rowcounts)
+
+    @inlineCallbacks
+    def _select_pages(self, logger, query_name, query, key, page_size):
+        """
+        Returns every row of ``query``, selected ``page_size`` rows at a time
+        in order of the unique column ``key``, so that no single query holds
+        the database (or the thread pool) for long.
+        """
+        rows = []
+        while True:
+            page_query = query.order_by(key).limit(page_size)
+            if rows:
+                page_query = page_query.where(key > rows[-1][key])
+            page = yield (yield self._execute(
+                logger, query_name, page_query
+            )).fetchall()
+            rows.extend(page)
+            if len(page) < page_size:
+                returnValue(rows)
+
+    @inlineCallbacks
+    def get_pending_work(self, logger, page_size=1000):
         """
         Returns a 2-tuple of:
             (
@@ -223,32 +635,79 @@ class DownloadDatabase(object):
                 [list documents with no content_location and not errored]
             )
         """
-        download_rows = yield ((yield self._execute(
+        started = self._downloads.c.state == "STARTED"
+        download_rows = yield self._select_pages(
             logger,
             "get_pending_work.get_downloads",
-            self._downloads.select().where(
-                self._downloads.c.state == "STARTED"
-            )
-        )).fetchall())
-        document_rows = yield ((yield self._execute(
+            self._downloads.select().where(started),
+            self._downloads.c.request_id,
+            page_size,
+        )
+        started_document_rows = yield self._select_pages(
+            logger,
+            "get_pending_work.get_download_documents",
+            self._documents.select().where(
+                self._documents.c.download_id.in_(
+                    sqlalchemy.select([self._downloads.c.request_id]).where(
+                        started
+                    )
+                )
+            ),
+            self._documents.c.id,
+            page_size,
+        )
+        document_rows = yield self._select_pages(
             logger,
             "get_pending_work.get_documents",
             self._documents.select().where(
                 self._documents.c.content_location.is_(None) &
                 ~self._documents.c.errored
-            )
-        )).fetchall())
-        # TODO: O(n) queries
+            ),
+            self._documents.c.id,
+            page_size,
+        )
+
+        documents_by_download = {}
+        for row in started_document_rows:
+            documents_by_download.setdefault(
+                row[self._documents.c.download_id], []
+            ).append(self._document_from_row(row))
         returnValue((
             [
-                (yield self.get_download(
-                    logger, row[self._downloads.c.request_id]
+                self._download_from_row(row, documents_by_download.get(
+                    row[self._downloads.c.request_id], []
                 ))
                 for row in download_rows
             ],
             [self._document_from_row(row) for row in document_rows],
         ))
 
+    @inlineCallbacks
+    def get_file_numbers(self, logger, request_ids, page_size=500):
+        """
+        Returns a dict of the file number of each of ``request_ids``.
+        """
+        request_ids = list(request_ids)
+        file_numbers = {}
+        for i in xrange(0, len(request_ids), page_size):
+            rows = yield (yield self._execute(
+                logger,
+                "get_file_numbers",
+                sqlalchemy.select([
+                    self._downloads.c.request_id,
+                    self._downloads.c.file_number,
+                ]).where(
+                    self._downloads.c.request_id.in_(
+                        request_ids[i:i + page_size]
+                    )
+                ),
+            )).fetchall()
+            for row in rows:
+                file_numbers[row[self._downloads.c.request_id]] = (
+                    row[self._downloads.c.file_number]
+                )
+        returnValue(file_numbers)
+
     def _document_from_row(self, row):
         return Document(
             id=row[self._documents.c.id],
@@ -262,35 +721,490 @@ class DownloadDatabase(object):
             errored=row[self._documents.c.errored],
         )
 
-    def create_download(self, logger, request_id, file_number):
+    def create_download(self, logger, request_id, file_number,
+                        state="STARTED"):
+        now = datetime.datetime.utcnow()
         query = self._downloads.insert().values(
             request_id=request_id,
             file_number=file_number,
-            started_at=datetime.datetime.utcnow(),
-            state="STARTED",
+            started_at=now,
+            state=state,
+            last_polled_at=now,
         )
-        return self._execute(logger, "create_download", query)
+        d = self._execute(logger, "create_download", query)
+        d.addCallback(lambda result: self._update_status(request_id, state))
+        return d
 
-    def mark_download_errored(self, logger, request_id):
-        query = self._downloads.update().where(
-            self._downloads.c.request_id == request_id
-        ).values(state="ERRORED")
-        return self._execute(logger, "mark_download_errored", query)
+    def _update_status(self, request_id, state=None, total=0, completed=0,
+                       errored=0):
+        if self._status_cache is not None:
+            self._status_cache.update(
+                request_id, state, total, completed, errored
+            )
 
-    def mark_download_manifest_downloaded(self, logger, request_id):
-        query = self._downloads.update().where(
+    @inlineCallbacks
+    def mark_download_started(self, logger, request_id):
+        """
+        Moves a download from WAITING to STARTED. Returns whether it was
+        waiting, so that only one process starts it.
+        """
+        result = yield self._execute(
+            logger,
+            "mark_download_started",
+            self._downloads.update().where(
+                (self._downloads.c.request_id == request_id) &
+                (self._downloads.c.state == "WAITING")
+            ).values(state="STARTED"),
+        )
+        if result.rowcount == 1:
+            self._update_status(request_id, "STARTED")
+        returnValue(result.rowcount == 1)
+
+    @inlineCallbacks
+    def get_admission_counts(self, logger):
+        """
+        Returns a 3-tuple of the number of downloads with unfinished jobs,
+        the number of documents waiting to be fetched, and the number of
+        WAITING downloads. Documents only count as waiting while their
+        download is running and still has jobs to fetch them, so those of
+        cancelled downloads and dead-lettered jobs don't hold up new ones.
+        """
+        active = yield (yield self._execute(
+            logger,
+            "get_admission_counts.active",
+            sqlalchemy.select([
+                sqlalchemy.func.count(
+                    sqlalchemy.distinct(self._jobs.c.request_id)
+                )
+            ]).where(
+                self._jobs.c.completed_at.is_(None) &
+                self._jobs.c.dead_lettered_at.is_(None)
+            ),
+        )).scalar()
+        queued = yield (yield self._execute(
+            logger,
+            "get_admission_counts.queued",
+            sqlalchemy.select([sqlalchemy.func.count()]).select_from(
+                self._documents.join(
+                    self._downloads,
+                    self._documents.c.download_id ==
+                    self._downloads.c.request_id,
+                )
+            ).where(
+                self._documents.c.content_location.is_(None) &
+                ~self._documents.c.errored &
+                self._downloads.c.state.in_([
+                    "STARTED", "MANIFEST_DOWNLOADED"
+                ]) &
+                sqlalchemy.exists().where(
+                    (self._jobs.c.request_id == self._downloads.c.request_id) &
+                    self._jobs.c.completed_at.is_(None) &
+                    self._jobs.c.dead_lettered_at.is_(None)
+                )
+            ),
+        )).scalar()
+        waiting = yield (yield self._execute(
+            logger,
+            "get_admission_counts.waiting",
+            sqlalchemy.select([sqlalchemy.func.count()]).where(
+                self._downloads.c.state == "WAITING"
+            ),
+        )).scalar()
+        returnValue((active, queued, waiting))
+
+    @inlineCallbacks
+    def get_waiting_downloads(self, logger, limit):
+        """
+        Returns up to ``limit`` (``None`` for all) WAITING downloads, as
+        2-tuples of ``(request_id, file_number)``, longest waiting first.
+        """
+        rows = yield (yield self._execute(
+            logger,
+            "get_waiting_downloads",
+            sqlalchemy.select([
+                self._downloads.c.request_id,
+                self._downloads.c.file_number,
+            ]).where(
+                self._downloads.c.state == "WAITING"
+            ).order_by(self._downloads.c.started_at).limit(limit),
+        )).fetchall()
+        returnValue([
+            (
+                row[self._downloads.c.request_id],
+                row[self._downloads.c.file_number],
+            )
+            for row in rows
+        ])
+
+    @inlineCallbacks
+    def get_waiting_position(self, logger, request_id):
+        """
+        Returns the position (starting from 1) of a WAITING download in the
+        line of waiting downloads.
+        """
+        started_at = sqlalchemy.select([self._downloads.c.started_at]).where(
             self._downloads.c.request_id == request_id
-        ).values(state="MANIFEST_DOWNLOADED")
+        ).as_scalar()
+        position = yield (yield self._execute(
+            logger,
+            "get_waiting_position",
+            sqlalchemy.select([sqlalchemy.func.count()]).where(
+                (self._downloads.c.state == "WAITING") &
+                (self._downloads.c.started_at <= started_at)
+            ),
+            read_only=True,
+        )).scalar()
+        returnValue(position)
+
+    @inlineCallbacks
+    def get_expired_downloads(self, logger, started_before, limit):
+        """
+        Returns the ``request_id``s of up to ``limit`` downloads, oldest
+        first, which started before ``started_before``.
+        """
+        rows = yield (yield self._execute(
+            logger,
+            "get_expired_downloads",
+            sqlalchemy.select([self._downloads.c.request_id]).where(
+                self._downloads.c.started_at < started_before
+            ).order_by(self._downloads.c.started_at).limit(limit),
+        )).fetchall()
+        returnValue([row[self._downloads.c.request_id] for row in rows])
+
+    @inlineCallbacks
+    def delete_downloads(self, logger, request_ids):
+        """
+        Deletes downloads, with their documents and jobs, releasing their
+        references to blobs. Blobs which are no longer referenced are deleted
+        too. Returns a 2-tuple of the number of documents deleted, and the
+        locations of the deleted blobs, whose files can now be removed.
+        """
+        rows = yield (yield self._execute(
+            logger,
+            "delete_downloads.get_documents",
+            sqlalchemy.select([self._documents.c.content_location]).where(
+                self._documents.c.download_id.in_(request_ids)
+            ),
+        )).fetchall()
+        references = collections.Counter(
+            row[self._documents.c.content_location] for row in rows
+            if row[self._documents.c.content_location] is not None
+        )
+        queries = [
+            (self._blobs.update().where(
+                self._blobs.c.location == location
+            ).values(refcount=self._blobs.c.refcount - count),)
+            for location, count in references.items()
+        ]
+        queries.extend([
+            (self._documents.delete().where(
+                self._documents.c.download_id.in_(request_ids)
+            ),),
+            (self._jobs.delete().where(
+                self._jobs.c.request_id.in_(request_ids)
+            ),),
+            (self._downloads.delete().where(
+                self._downloads.c.request_id.in_(request_ids)
+            ),),
+        ])
+        yield self._execute_transaction(
+            logger, "delete_downloads.delete", queries
+        )
+        if self._status_cache is not None:
+            for request_id in request_ids:
+                self._status_cache.discard(request_id)
+
+        locations = []
+        for location in references:
+            # Only deleted if nothing has taken a new reference meanwhile.
+            result = yield self._execute(
+                logger,
+                "delete_downloads.delete_blob",
+                self._blobs.delete().where(
+                    (self._blobs.c.location == location) &
+                    (self._blobs.c.refcount <= 0)
+                ),
+            )
+            if result.rowcount:
+                locations.append(location)
+        returnValue((len(rows), locations))
+
+    @inlineCallbacks
+    def get_referenced_locations(self, logger, locations):
+        """
+        Returns which of ``locations`` belong to a blob, or are a document's
+        ``content_location``: documents fetched before there was a ``blobs``
+        table don't have a blob.
+        """
+        if not locations:
+            returnValue(set())
+        rows = yield (yield self._execute(
+            logger,
+            "get_referenced_locations",
+            sqlalchemy.union(
+                sqlalchemy.select([self._blobs.c.location]).where(
+                    self._blobs.c.location.in_(locations)
+                ),
+                sqlalchemy.select([self._documents.c.content_location]).where(
+                    self._documents.c.content_location.in_(locations)
+                ),
+            ),
+        )).fetchall()
+        returnValue({row[0] for row in rows})
+
+    @inlineCallbacks
+    def get_blob_locations(self, logger, after, limit):
+        """
+        Returns up to ``limit`` blob locations which sort after ``after``
+        (``None`` for the first), in order.
+        """
+        query = sqlalchemy.select([self._blobs.c.location]).order_by(
+            self._blobs.c.location
+        ).limit(limit)
+        if after is not None:
+            query = query.where(self._blobs.c.location > after)
+        rows = yield (yield self._execute(
+            logger, "get_blob_locations", query
+        )).fetchall()
+        returnValue([row[self._blobs.c.location] for row in rows])
+
+    def delete_blob(self, logger, location):
+        """
+        Forgets a blob (whose file is missing), so that it isn't reused.
+        Documents which already point at it are left as they are.
+        """
+        return self._execute(
+            logger,
+            "delete_blob",
+            self._blobs.delete().where(self._blobs.c.location == location),
+        )
+
+    @inlineCallbacks
+    def get_legacy_locations(self, logger, limit):
+        """
+        Returns up to ``limit`` locations, of blobs or documents, which are
+        still absolute paths to files in the old, flat storage directory,
+        rather than blob store keys.
+        """
+        rows = yield (yield self._execute(
+            logger,
+            "get_legacy_locations",
+            sqlalchemy.union(
+                sqlalchemy.select([
+                    self._blobs.c.location.label("location"),
+                ]).where(self._blobs.c.location.startswith("/")),
+                sqlalchemy.select([
+                    self._documents.c.content_location.label("location"),
+                ]).where(self._documents.c.content_location.startswith("/")),
+            ).order_by("location").limit(limit),
+        )).fetchall()
+        returnValue([row["location"] for row in rows])
+
+    def rename_blob(self, logger, location, key):
+        """
+        Points a blob, and every document which uses it, at ``key`` instead
+        of ``location``.
+        """
+        return self._execute_transaction(logger, "rename_blob", [
+            (self._blobs.update().where(
+                self._blobs.c.location == location
+            ).values(location=key),),
+            (self._documents.update().where(
+                self._documents.c.content_location == location
+            ).values(content_location=key),),
+        ])
+
+    @inlineCallbacks
+    def forget_location(self, logger, location):
+        """
+        Forgets ``location``, whose file is missing: its blob is deleted, and
+        the documents which point at it are counted as errored instead of
+        completed, so that their downloads don't try to read it.
+        """
+        rows = yield (yield self._execute(
+            logger,
+            "forget_location.get_documents",
+            sqlalchemy.select([self._documents.c.download_id]).where(
+                self._documents.c.content_location == location
+            ),
+        )).fetchall()
+        counts = collections.Counter(
+            row[self._documents.c.download_id] for row in rows
+        )
+        completed = self._downloads.c.completed_documents
+        errored = self._downloads.c.errored_documents
+        queries = [
+            (self._downloads.update().where(
+                self._downloads.c.request_id == request_id
+            ).values({completed: completed - n, errored: errored + n}),)
+            for request_id, n in counts.items()
+        ]
+        queries.extend([
+            (self._documents.update().where(
+                self._documents.c.content_location == location
+            ).values(content_location=None, errored=True),),
+            (self._blobs.delete().where(
+                self._blobs.c.location == location
+            ),),
+        ])
+        yield self._execute_transaction(logger, "forget_location", queries)
+        for request_id, n in counts.items():
+            self._update_status(request_id, completed=-n, errored=n)
+
+    def delete_expired_manifests(self, logger, fetched_before):
         return self._execute(
-            logger, "mark_download_manifest_downloaded", query
+            logger,
+            "delete_expired_manifests",
+            self._manifests.delete().where(
+                self._manifests.c.fetched_at < fetched_before
+            ),
         )
 
+    def touch_download(self, logger, request_id, interval=30):
+        """
+        Records that a download's status page was polled. Status pages poll
+        every couple of seconds, so the row is only written if it wasn't
+        touched in the last ``interval`` seconds, and only while the download
+        can still be abandoned.
+        """
+        now = datetime.datetime.utcnow()
+        return self._execute(
+            logger,
+            "touch_download",
+            self._downloads.update().where(
+                (self._downloads.c.request_id == request_id) &
+                self._downloads.c.state.in_([
+                    "WAITING", "STARTED", "MANIFEST_DOWNLOADED"
+                ]) &
+                (
+                    self._downloads.c.last_polled_at.is_(None) |
+                    (
+                        self._downloads.c.last_polled_at <
+                        now - datetime.timedelta(seconds=interval)
+                    )
+                )
+            ).values(last_polled_at=now),
+        )
+
+    @inlineCallbacks
+    def get_abandoned_downloads(self, logger, polled_before):
+        """
+        Returns the ids of the downloads which are waiting, or have unfinished
+        jobs, and whose status page hasn't been polled since
+        ``polled_before``.
+        """
+        unfinished_jobs = sqlalchemy.select([self._jobs.c.id]).where(
+            (self._jobs.c.request_id == self._downloads.c.request_id) &
+            self._jobs.c.completed_at.is_(None) &
+            self._jobs.c.dead_lettered_at.is_(None)
+        )
+        rows = yield (yield self._execute(
+            logger,
+            "get_abandoned_downloads",
+            sqlalchemy.select([self._downloads.c.request_id]).where(
+                (self._downloads.c.last_polled_at < polled_before) &
+                (
+                    (self._downloads.c.state == "WAITING") |
+                    (
+                        self._downloads.c.state.in_([
+                            "STARTED", "MANIFEST_DOWNLOADED"
+                        ]) &
+                        sqlalchemy.exists(unfinished_jobs)
+                    )
+                )
+            ),
+        )).fetchall()
+        returnValue([row[self._downloads.c.request_id] for row in rows])
+
+    @inlineCallbacks
+    def cancel_download(self, logger, request_id):
+        """
+        Marks a download which hasn't finished as cancelled, and completes its
+        unfinished jobs so they're never claimed again. Returns whether it was
+        cancelled.
+        """
+        now = datetime.datetime.utcnow()
+        result = yield self._execute(
+            logger,
+            "cancel_download.download",
+            self._downloads.update().where(
+                (self._downloads.c.request_id == request_id) &
+                self._downloads.c.state.in_([
+                    "WAITING", "STARTED", "MANIFEST_DOWNLOADED"
+                ])
+            ).values(state="CANCELLED"),
+        )
+        yield self._execute(
+            logger,
+            "cancel_download.jobs",
+            self._jobs.update().where(
+                (self._jobs.c.request_id == request_id) &
+                self._jobs.c.completed_at.is_(None)
+            ).values(
+                completed_at=now,
+                lease_owner=None,
+                lease_expires_at=None,
+                error="Cancelled",
+            ),
+        )
+        if result.rowcount == 1:
+            self._update_status(request_id, "CANCELLED")
+        returnValue(result.rowcount == 1)
+
+    def mark_download_errored(self, logger, request_id):
+        return self._finish_listing(
+            logger, "mark_download_errored", request_id, "ERRORED"
+        )
+
+    def mark_download_manifest_downloaded(self, logger, request_id):
+        return self._finish_listing(
+            logger, "mark_download_manifest_downloaded", request_id,
+            "MANIFEST_DOWNLOADED",
+        )
+
+    @inlineCallbacks
+    def _finish_listing(self, logger, query_name, request_id, state):
+        """
+        Moves a STARTED download to ``state``. Returns whether it was still
+        STARTED, rather than (say) cancelled while its documents were being
+        listed.
+        """
+        result = yield self._execute(
+            logger,
+            query_name,
+            self._downloads.update().where(
+                (self._downloads.c.request_id == request_id) &
+                (self._downloads.c.state == "STARTED")
+            ).values(state=state),
+        )
+        if result.rowcount == 1:
+            self._update_status(request_id, state)
+        returnValue(result.rowcount == 1)
+
     def create_documents(self, logger, documents):
         if not documents:
             return succeed(None)
-        return self._execute(
-            logger,
-            "create_documents",
+        # Counts of [total, completed, errored] documents, by download.
+        counts = {}
+        for doc in documents:
+            count = counts.setdefault(doc.download_id, [0, 0, 0])
+            count[0] += 1
+            if doc.content_location:
+                count[1] += 1
+            elif doc.errored:
+                count[2] += 1
+        c = self._downloads.c
+        queries = [
+            (self._downloads.update().where(
+                c.request_id == download_id
+            ).values(
+                total_documents=c.total_documents + total,
+                completed_documents=c.completed_documents + completed,
+                errored_documents=c.errored_documents + errored,
+            ),)
+            for download_id, [total, completed, errored] in counts.items()
+        ]
+        queries.append((
             self._documents.insert(),
             [{
                 "id": doc.id,
@@ -300,32 +1214,498 @@ class DownloadDatabase(object):
                 "filename": doc.filename,
                 "received_at": doc.received_at,
                 "source": doc.source,
-                "content_location": None,
-                "errored": False
+                "content_location": doc.content_location,
+                "errored": doc.errored,
             } for doc in documents]
+        ))
+        d = self._execute_transaction(logger, "create_documents", queries)
+
+        @d.addCallback
+        def created(rowcounts):
+            for download_id, [total, completed, errored] in counts.items():
+                self._update_status(
+                    download_id,
+                    total=total,
+                    completed=completed,
+                    errored=errored,
+                )
+        return d
+
+    def _write_document(self, logger, query_name, document, counter,
+                        queries, condition=None):
+        """
+        Runs ``queries``, which finish ``document``, counting it as
+        ``counter`` ("completed" or "errored"), in a transaction, or as part of
+        a batch if batching is enabled. It's only counted if ``condition``
+        holds. Returns the rowcounts of ``queries``.
+        """
+        queries = [
+            self._count_finished_query(document, counter, condition)
+        ] + queries
+        if self._document_writes is None:
+            d = self._execute_transaction(logger, query_name, queries)
+        else:
+            d = self._document_writes.add(logger, queries)
+
+        @d.addCallback
+        def written(rowcounts):
+            if rowcounts[0]:
+                self._update_status(document.download_id, **{counter: 1})
+            return rowcounts[1:]
+        return d
+
+    def _count_finished_query(self, document, counter, condition=None):
+        """
+        Adds one to the ``counter`` ("completed" or "errored") count of
+        ``document``'s download, unless ``document`` is already completed or
+        errored (or ``condition`` doesn't hold). Must come before the query
+        which updates ``document``, in the same transaction.
+        """
+        column = self._downloads.c["{}_documents".format(counter)]
+        unfinished = sqlalchemy.exists().where(
+            (self._documents.c.id == document.id) &
+            self._documents.c.content_location.is_(None) &
+            ~self._documents.c.errored
         )
+        if condition is not None:
+            unfinished = unfinished & condition
+        return (self._downloads.update().where(
+            (self._downloads.c.request_id == document.download_id) &
+            unfinished
+        ).values({column: column + 1}),)
 
     def mark_document_errored(self, logger, document):
-        query = self._documents.update().where(
-            self._documents.c.id == document.id
-        ).values(errored=True)
-        return self._execute(logger, "mark_document_errored", query)
+        return self._write_document(
+            logger, "mark_document_errored", document, "errored", [
+                (self._documents.update().where(
+                    self._documents.c.id == document.id
+                ).values(errored=True),),
+            ]
+        )
 
     def set_document_content_location(self, logger, document, path):
-        query = self._documents.update().where(
-            self._documents.c.id == document.id,
-        ).values(
-            content_location=path,
+        return self._write_document(
+            logger, "set_document_content_location", document, "completed", [
+                (self._documents.update().where(
+                    self._documents.c.id == document.id,
+                ).values(
+                    content_location=path,
+                ),),
+            ]
         )
-        return self._execute(logger, "set_document_content_location", query)
 
     @inlineCallbacks
-    def get_download(self, logger, request_id):
+    def get_document_types(self, logger):
+        """
+        Returns a 2-tuple of the stored document types, as a dict of
+        ``type_id`` to description, and when they were fetched from VBMS
+        (``None`` if they never have been).
+        """
+        rows = yield (yield self._execute(
+            logger, "get_document_types", self._document_types.select()
+        )).fetchall()
+        fetched_at = None
+        if rows:
+            fetched_at = min(
+                row[self._document_types.c.fetched_at] for row in rows
+            )
+        returnValue(({
+            row[self._document_types.c.type_id]: (
+                row[self._document_types.c.description]
+            )
+            for row in rows
+        }, fetched_at))
+
+    def replace_document_types(self, logger, document_types, fetched_at):
+        queries = [(self._document_types.delete(),)]
+        if document_types:
+            queries.append((self._document_types.insert(), [
+                {
+                    "type_id": type_id,
+                    "description": description,
+                    "fetched_at": fetched_at,
+                }
+                for type_id, description in document_types.items()
+            ]))
+        return self._execute_transaction(
+            logger, "replace_document_types", queries
+        )
+
+    @inlineCallbacks
+    def get_manifest(self, logger, file_number):
+        """
+        Returns a 2-tuple of the cached ``ListDocuments`` response for
+        ``file_number`` and when it was fetched, or ``None`` if there isn't
+        one.
+        """
+        row = yield (yield self._execute(
+            logger,
+            "get_manifest",
+            self._manifests.select().where(
+                self._manifests.c.file_number == file_number
+            ),
+        )).first()
+        if row is None:
+            returnValue(None)
+        returnValue((
+            json.loads(row[self._manifests.c.documents]),
+            row[self._manifests.c.fetched_at],
+        ))
+
+    def set_manifest(self, logger, file_number, documents, fetched_at):
+        return self._execute_transaction(logger, "set_manifest", [
+            (self._manifests.delete().where(
+                self._manifests.c.file_number == file_number
+            ),),
+            (self._manifests.insert().values(
+                file_number=file_number,
+                documents=json.dumps(documents),
+                fetched_at=fetched_at,
+            ),),
+        ])
+
+    @inlineCallbacks
+    def reuse_blobs(self, logger, documents):
+        """
+        Points each of ``documents`` whose ``document_id`` has already been
+        fetched (by any download) at the existing blob, taking a reference to
+        it. Returns the documents which were reused; the rest (including any
+        whose blob was deleted before the reference was taken) need fetching.
+        """
+        if not documents:
+            returnValue([])
+        rows = yield (yield self._execute(
+            logger,
+            "reuse_blobs.get_blobs",
+            self._blobs.select().where(self._blobs.c.document_id.in_(
+                {doc.document_id for doc in documents}
+            )),
+        )).fetchall()
+        locations = {
+            row[self._blobs.c.document_id]: row[self._blobs.c.location]
+            for row in rows
+        }
+        found = [doc for doc in documents if doc.document_id in locations]
+        queries = []
+        for doc in found:
+            location = locations[doc.document_id]
+            queries.append(self._count_finished_query(
+                doc, "completed", self._blob_exists(doc, location)
+            ))
+            queries.extend(self._reference_blob_queries(doc, location))
+        reused = []
+        if queries:
+            rowcounts = yield self._execute_transaction(
+                logger, "reuse_blobs.reference_blobs", queries
+            )
+            step = len(queries) // len(found)
+            for i, doc in enumerate(found):
+                counted, referenced = rowcounts[i * step:i * step + 2]
+                if not referenced:
+                    # Retention deleted the blob since it was looked up.
+                    continue
+                doc.content_location = locations[doc.document_id]
+                reused.append(doc)
+                if counted:
+                    self._update_status(doc.download_id, completed=1)
+        returnValue(reused)
+
+    @inlineCallbacks
+    def add_blob(self, logger, document, content_hash, location):
+        """
+        Records ``location`` as the blob for ``document.document_id`` and
+        points ``document`` at it. If another download stored the same
+        document first (even at the same time, from another process),
+        ``document`` is pointed at that blob instead, and if its
+        ``content_hash`` differs it's logged as ``add_blob.content_mismatch``.
+        Returns the location ``document`` now points at.
+        """
+        while True:
+            row = yield (yield self._execute(
+                logger,
+                "add_blob.get_blob",
+                self._blobs.select().where(
+                    self._blobs.c.document_id == document.document_id
+                ),
+            )).first()
+            if row is not None:
+                existing = row[self._blobs.c.location]
+                if row[self._blobs.c.content_hash] != content_hash:
+                    logger.bind(
+                        content_hash=content_hash,
+                        existing_content_hash=row[self._blobs.c.content_hash],
+                    ).emit("add_blob.content_mismatch")
+                [referenced, _] = yield self._write_document(
+                    logger, "add_blob", document, "completed",
+                    self._reference_blob_queries(document, existing),
+                    self._blob_exists(document, existing),
+                )
+                if referenced:
+                    returnValue(existing)
+                # Retention deleted it since it was looked up, so ours is
+                # stored instead.
+                continue
+            try:
+                yield self._write_document(
+                    logger, "add_blob", document, "completed", [
+                        (self._blobs.insert().values(
+                            document_id=document.document_id,
+                            content_hash=content_hash,
+                            location=location,
+                            refcount=1,
+                            created_at=datetime.datetime.utcnow(),
+                        ),),
+                        (self._documents.update().where(
+                            self._documents.c.id == document.id
+                        ).values(content_location=location),),
+                    ]
+                )
+            except sqlalchemy.exc.IntegrityError:
+                # Another process stored it since it was looked up.
+                continue
+            returnValue(location)
+
+    def _blob_exists(self, document, location):
+        return sqlalchemy.exists().where(
+            (self._blobs.c.document_id == document.document_id) &
+            (self._blobs.c.location == location)
+        )
+
+    def _reference_blob_queries(self, document, location):
+        """
+        Takes a reference to the blob at ``location`` for ``document``, and
+        points ``document`` at it, unless the blob has been deleted.
+        """
+        return [
+            (self._blobs.update().where(
+                (self._blobs.c.document_id == document.document_id) &
+                (self._blobs.c.location == location)
+            ).values(refcount=self._blobs.c.refcount + 1),),
+            (self._documents.update().where(
+                (self._documents.c.id == document.id) &
+                self._blob_exists(document, location)
+            ).values(content_location=location),),
+        ]
+
+    def create_jobs(self, logger, jobs):
+        if not jobs:
+            return succeed(None)
+        return self._execute(
+            logger,
+            "create_jobs",
+            self._jobs.insert(),
+            [{
+                "id": job.id,
+                "kind": job.kind,
+                "request_id": job.request_id,
+                "priority": PRIORITIES.index(job.priority),
+                "payload": json.dumps(job.payload),
+                "created_at": datetime.datetime.utcnow(),
+                "attempts": 0,
+            } for job in jobs]
+        )
+
+    @inlineCallbacks
+    def claim_jobs(self, logger, owner, limit, lease_duration):
+        """
+        Takes leases on up to ``limit`` jobs which aren't completed or leased
+        (or whose lease has expired), highest priority first, and returns
+        them. Within a priority, downloads take turns, oldest job first, so
+        that one large download can't hold up everyone else's. Safe to call
+        concurrently from several processes: on PostgreSQL rows locked by
+        another claim are skipped, and SQLite serializes the claiming
+        ``UPDATE``.
+        """
+        now = datetime.datetime.utcnow()
+        lease_owner = "{}/{}".format(owner, uuid.uuid4())
+        # Each job's place in its download's queue for its priority.
+        ranked = sqlalchemy.select([
+            self._jobs.c.id,
+            sqlalchemy.func.row_number().over(
+                partition_by=[self._jobs.c.request_id, self._jobs.c.priority],
+                order_by=self._jobs.c.created_at,
+            ).label("turn"),
+        ]).where(
+            self._jobs.c.completed_at.is_(None) &
+            self._jobs.c.dead_lettered_at.is_(None) &
+            (
+                self._jobs.c.lease_expires_at.is_(None) |
+                (self._jobs.c.lease_expires_at < now)
+            )
+        ).alias("ranked")
+        claimable = sqlalchemy.select([self._jobs.c.id]).select_from(
+            self._jobs.join(ranked, ranked.c.id == self._jobs.c.id)
+        ).order_by(
+            self._jobs.c.priority, ranked.c.turn, self._jobs.c.created_at
+        ).limit(limit).suffix_with(
+            # Only ``jobs`` can be locked, not the window over it.
+            "FOR UPDATE OF jobs SKIP LOCKED", dialect="postgresql"
+        )
+        yield self._execute(
+            logger,
+            "claim_jobs.lease",
+            self._jobs.update().where(self._jobs.c.id.in_(claimable)).values(
+                lease_owner=lease_owner,
+                lease_expires_at=now + lease_duration,
+                attempts=self._jobs.c.attempts + 1,
+            ),
+        )
+        rows = yield (yield self._execute(
+            logger,
+            "claim_jobs.get_jobs",
+            self._jobs.select().where(
+                (self._jobs.c.lease_owner == lease_owner) &
+                self._jobs.c.completed_at.is_(None)
+            ).order_by(self._jobs.c.priority, self._jobs.c.created_at),
+        )).fetchall()
+        returnValue([self._job_from_row(row) for row in rows])
+
+    def _job_from_row(self, row):
+        return Job(
+            id=row[self._jobs.c.id],
+            kind=row[self._jobs.c.kind],
+            request_id=row[self._jobs.c.request_id],
+            priority=PRIORITIES[row[self._jobs.c.priority]],
+            payload=json.loads(row[self._jobs.c.payload]),
+            lease_owner=row[self._jobs.c.lease_owner],
+            attempts=row[self._jobs.c.attempts],
+            error=row[self._jobs.c.error],
+        )
+
+    def renew_leases(self, logger, jobs, lease_duration):
+        if not jobs:
+            return succeed(None)
+        return self._execute(
+            logger,
+            "renew_leases",
+            self._jobs.update().where(
+                self._jobs.c.lease_owner.in_(
+                    {job.lease_owner for job in jobs}
+                ) &
+                self._jobs.c.id.in_([job.id for job in jobs]) &
+                self._jobs.c.completed_at.is_(None)
+            ).values(
+                lease_expires_at=datetime.datetime.utcnow() + lease_duration,
+            ),
+        )
+
+    def deprioritize_jobs(self, logger, request_id):
+        """
+        Moves the unfinished jobs of ``request_id`` to the ``background``
+        priority class.
+        """
+        return self._execute(
+            logger,
+            "deprioritize_jobs",
+            self._jobs.update().where(
+                (self._jobs.c.request_id == request_id) &
+                self._jobs.c.completed_at.is_(None)
+            ).values(priority=PRIORITIES.index(BACKGROUND)),
+        )
+
+    @inlineCallbacks
+    def get_finished_jobs(self, logger, job_ids):
+        """
+        Returns which of ``job_ids`` have been completed or dead-lettered.
+        """
+        if not job_ids:
+            returnValue([])
+        rows = yield (yield self._execute(
+            logger,
+            "get_finished_jobs",
+            sqlalchemy.select([self._jobs.c.id]).where(
+                self._jobs.c.id.in_(job_ids) &
+                (
+                    self._jobs.c.completed_at.isnot(None) |
+                    self._jobs.c.dead_lettered_at.isnot(None)
+                )
+            ),
+        )).fetchall()
+        returnValue([row[self._jobs.c.id] for row in rows])
+
+    def complete_job(self, logger, job):
+        """
+        Marks ``job`` as completed. Completing a job which has already been
+        completed (for example by another process, after this one's lease
+        expired) does nothing.
+        """
+        return self._execute(
+            logger,
+            "complete_job",
+            self._jobs.update().where(
+                (self._jobs.c.id == job.id) &
+                self._jobs.c.completed_at.is_(None)
+            ).values(
+                completed_at=datetime.datetime.utcnow(),
+                lease_owner=None,
+                lease_expires_at=None,
+            ),
+        )
+
+    def dead_letter_job(self, logger, job, error):
+        return self._execute(
+            logger,
+            "dead_letter_job",
+            self._jobs.update().where(
+                (self._jobs.c.id == job.id) &
+                self._jobs.c.completed_at.is_(None)
+            ).values(
+                dead_lettered_at=datetime.datetime.utcnow(),
+                error=error,
+                lease_owner=None,
+                lease_expires_at=None,
+            ),
+        )
+
+    @inlineCallbacks
+    def get_dead_letters(self, logger):
+        rows = yield (yield self._execute(
+            logger,
+            "get_dead_letters",
+            self._jobs.select().where(
+                self._jobs.c.dead_lettered_at.isnot(None)
+            ).order_by(self._jobs.c.dead_lettered_at),
+        )).fetchall()
+        returnValue([self._job_from_row(row) for row in rows])
+
+    def replay_dead_letters(self, logger, job_ids=None):
+        """
+        Makes dead-lettered jobs (all of them, or those in ``job_ids``)
+        claimable again, with their attempts reset.
+        """
+        condition = self._jobs.c.dead_lettered_at.isnot(None)
+        if job_ids is not None:
+            condition &= self._jobs.c.id.in_(job_ids)
+        return self._execute(
+            logger,
+            "replay_dead_letters",
+            self._jobs.update().where(condition).values(
+                dead_lettered_at=None,
+                error=None,
+                attempts=0,
+            ),
+        )
+
+    @inlineCallbacks
+    def get_documents(self, logger, ids):
+        rows = yield (yield self._execute(
+            logger,
+            "get_documents",
+            self._documents.select().where(self._documents.c.id.in_(ids)),
+        )).fetchall()
+        returnValue([self._document_from_row(row) for row in rows])
+
+    @inlineCallbacks
+    def get_download(self, logger, request_id, read_only=False):
+        """
+        ``read_only`` sends the queries to the read-only engine, for status
+        pages, which may lag slightly behind if that's a replica.
+        """
         query = self._downloads.select().where(
             self._downloads.c.request_id == request_id
         )
         download_row = (yield (yield self._execute(
-            logger, "get_download.get_download", query
+            logger, "get_download.get_download", query, read_only=read_only
         )).first())
         if download_row is None:
             raise DownloadNotFound(request_id)
@@ -334,15 +1714,50 @@ class DownloadDatabase(object):
             self._documents.c.download_id == request_id,
         )
         document_rows = yield self._execute(
-            logger, "get_download.get_documents", query
+            logger, "get_download.get_documents", query, read_only=read_only
         )
 
-        returnValue(DownloadStatus(
-            request_id=download_row[self._downloads.c.request_id],
-            file_number=download_row[self._downloads.c.file_number],
-            state=download_row[self._downloads.c.state],
-            documents=[
-                self._document_from_row(row)
-                for row in (yield document_rows.fetchall())
-            ]
-        ))
+        returnValue(self._download_from_row(download_row, [
+            self._document_from_row(row)
+            for row in (yield document_rows.fetchall())
+        ]))
+
+    def get_download_progress(self, logger, request_id, read_only=False):
+        """
+        Like ``get_download``, but only loads the download's progress
+        counts, not its documents (which are ``None``). Served from the
+        status cache, if there is one.
+        """
+        if self._status_cache is None:
+            return self._load_download_progress(logger, request_id, read_only)
+        return self._status_cache.get(
+            request_id,
+            lambda: self._load_download_progress(
+                logger, request_id, read_only
+            ),
+        )
+
+    @inlineCallbacks
+    def _load_download_progress(self, logger, request_id, read_only):
+        download_row = (yield (yield self._execute(
+            logger,
+            "get_download_progress",
+            self._downloads.select().where(
+                self._downloads.c.request_id == request_id
+            ),
+            read_only=read_only,
+        )).first())
+        if download_row is None:
+            raise DownloadNotFound(request_id)
+        returnValue(self._download_from_row(download_row, None))
+
+    def _download_from_row(self, row, documents):
+        return DownloadStatus(
+            request_id=row[self._downloads.c.request_id],
+            file_number=row[self._downloads.c.file_number],
+            state=row[self._downloads.c.state],
+            documents=documents,
+            total_documents=row[self._downloads.c.total_documents],
+            completed_documents=row[self._downloads.c.completed_documents],
+            errored_documents=row[self._downloads.c.errored_documents],
+        )
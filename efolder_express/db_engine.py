@@ -0,0 +1,133 @@
+from alchimia.engine import (
+    TwistedConnection, TwistedEngine, TwistedResultProxy
+)
+from alchimia.strategy import TwistedEngineStrategy
+
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
+
+
+PINNED_STRATEGY = "_twisted_pinned"
+
+
+class DatabaseThreads(object):
+    """
+    ``size`` threads for running database calls on, each a single-thread
+    ``ThreadPool``.
+
+    A plain ``ThreadPool`` with several threads would run each of alchimia's
+    calls on whichever thread is free, so one connection could be used from
+    several threads (which SQLite, for one, refuses). ``PinnedEngine`` instead
+    pins each connection to one of these threads with ``pin``.
+    """
+
+    def __init__(self, reactor, size, name="db"):
+        self._reactor = reactor
+        self._threads = [
+            ThreadPool(
+                minthreads=1, maxthreads=1, name="{}-{}".format(name, i)
+            )
+            for i in xrange(size)
+        ]
+        # The number of calls queued or running on each thread.
+        self._load = [0] * size
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        for thread in self._threads:
+            thread.stop()
+
+    def pin(self):
+        """
+        Returns a ``thread_pool`` which runs everything on the least busy
+        thread.
+        """
+        i = min(xrange(len(self._threads)), key=self._load.__getitem__)
+        return _PinnedThread(self, i)
+
+    def callInThreadWithCallback(self, on_result, f, *args, **kwargs):
+        self.pin().callInThreadWithCallback(on_result, f, *args, **kwargs)
+
+
+class _PinnedThread(object):
+    def __init__(self, threads, index):
+        self._threads = threads
+        self._index = index
+
+    def pin(self):
+        return self
+
+    def callInThreadWithCallback(self, on_result, f, *args, **kwargs):
+        threads = self._threads
+        threads._load[self._index] += 1
+
+        def finished(success, result):
+            threads._reactor.callFromThread(self._finished)
+            on_result(success, result)
+        threads._threads[self._index].callInThreadWithCallback(
+            finished, f, *args, **kwargs
+        )
+
+    def _finished(self):
+        self._threads._load[self._index] -= 1
+
+
+class _PinnedEngine(object):
+    """
+    Stands in for the engine of a ``TwistedConnection`` or
+    ``TwistedResultProxy``, which only use it to run their calls.
+    """
+
+    def __init__(self, reactor, thread_pool):
+        self._reactor = reactor
+        self._thread_pool = thread_pool
+
+    def _defer_to_thread(self, f, *args, **kwargs):
+        return deferToThreadPool(
+            self._reactor, self._thread_pool, f, *args, **kwargs
+        )
+
+
+class PinnedEngine(TwistedEngine):
+    """
+    An alchimia engine which runs every call for a connection, its
+    transactions and its results on the thread it was opened on. Its
+    ``thread_pool`` must have a ``pin`` method, like ``DatabaseThreads``.
+    """
+
+    def _pinned(self):
+        return _PinnedEngine(self._reactor, self._tpool.pin())
+
+    def connect(self):
+        engine = self._pinned()
+        d = engine._defer_to_thread(self._engine.connect)
+        d.addCallback(TwistedConnection, engine)
+        return d
+
+    def execute(self, *args, **kwargs):
+        engine = self._pinned()
+        d = engine._defer_to_thread(self._engine.execute, *args, **kwargs)
+        d.addCallback(TwistedResultProxy, engine)
+        return d
+
+    def run_with_connection(self, f, *args, **kwargs):
+        """
+        Calls ``f`` with a (synchronous) SQLAlchemy connection, and any other
+        arguments, on a database thread, returning a ``Deferred`` of its
+        result.
+        """
+        def run():
+            with self._engine.connect() as connection:
+                return f(connection, *args, **kwargs)
+        return self._pinned()._defer_to_thread(run)
+
+
+class PinnedEngineStrategy(TwistedEngineStrategy):
+    name = PINNED_STRATEGY
+    engine_cls = PinnedEngine
+
+
+PinnedEngineStrategy()
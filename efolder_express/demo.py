@@ -119,5 +119,15 @@ class DemoMemoryDownloadDatabase(object):
             )
         }
 
-    def get_download(self, logger, request_id):
+    def get_download(self, logger, request_id, read_only=False):
         return succeed(self._data[request_id])
+
+    def get_download_progress(self, logger, request_id, read_only=False):
+        return succeed(self._data[request_id])
+
+    def touch_download(self, logger, request_id):
+        return succeed(None)
+
+    def cancel_download(self, logger, request_id):
+        self._data[request_id].state = "CANCELLED"
+        return succeed(True)
@@ -0,0 +1,205 @@
+import datetime
+import functools
+import socket
+import uuid
+
+from twisted.internet.defer import (
+    Deferred, inlineCallbacks, maybeDeferred, succeed
+)
+from twisted.internet.task import LoopingCall
+from twisted.python.failure import Failure
+
+
+LIST_DOCUMENTS = "list_documents"
+FETCH_DOCUMENTS = "fetch_documents"
+
+
+class JobQueue(object):
+    """
+    A durable work queue, stored in the ``jobs`` table, which several
+    processes can share.
+
+    Each process claims up to ``capacity`` jobs at a time, taking a lease of
+    ``lease_duration`` seconds on each, which is renewed while it holds the
+    job. Claimed jobs are passed to ``scheduler``, and each is completed once
+    ``handler`` has run it. A job whose handler fails, or whose process dies,
+    is claimed again (by any process) once its lease expires. After
+    ``max_attempts`` failed attempts it is dead-lettered instead: it's never
+    claimed again, unless it's replayed (see ``replay_dead_letters``).
+
+    Jobs which are completed by something else while this process holds them
+    (for example, because their download was cancelled) are dropped if they
+    haven't started, and cancelled if they're running. This is noticed
+    immediately for ``cancel``, and otherwise at the next heartbeat.
+    """
+
+    def __init__(self, clock, logger, download_database, scheduler,
+                 lease_duration=300, capacity=100, poll_interval=5,
+                 max_attempts=5):
+        self._clock = clock
+        self._logger = logger
+        self._download_database = download_database
+        self.scheduler = scheduler
+        self._lease_duration = datetime.timedelta(seconds=lease_duration)
+        self._capacity = capacity
+        self._poll_interval = poll_interval
+        self._max_attempts = max_attempts
+
+        self.owner = "{}:{}".format(socket.gethostname(), uuid.uuid4())
+        self._handler = None
+        self._held = {}
+        # The Deferreds of the held jobs which are running.
+        self._running = {}
+        self._cancelled = set()
+        self._polling = None
+        self._poll_call = None
+        self._heartbeat_call = None
+
+    def start(self, handler):
+        self._handler = handler
+        self._poll_call = LoopingCall(self.poll)
+        self._poll_call.clock = self._clock
+        self._poll_call.start(self._poll_interval)
+        self._heartbeat_call = LoopingCall(self.heartbeat)
+        self._heartbeat_call.clock = self._clock
+        self._heartbeat_call.start(
+            self._lease_duration.total_seconds() / 3, now=False
+        )
+
+    def stop(self):
+        for call in [self._poll_call, self._heartbeat_call]:
+            if call is not None and call.running:
+                call.stop()
+
+    @inlineCallbacks
+    def put(self, logger, jobs):
+        yield self._download_database.create_jobs(logger, jobs)
+        if self._handler is not None:
+            yield self.poll()
+
+    def poll(self):
+        """
+        Claims as many jobs as there is capacity for. Concurrent polls share
+        one claim.
+        """
+        if self._polling is not None:
+            return self._polling
+        d = self._polling = Deferred()
+        self._claim().addBoth(self._finish_poll, d)
+        return d
+
+    def _finish_poll(self, result, d):
+        self._polling = None
+        d.callback(None)
+        if isinstance(result, Failure):
+            # Logged rather than returned, so the LoopingCall keeps running.
+            self._logger.bind(
+                error=result.getErrorMessage()
+            ).emit("job.poll_error")
+
+    def heartbeat(self):
+        d = self._download_database.renew_leases(
+            self._logger, self._held.values(), self._lease_duration
+        )
+        d.addCallback(lambda _: self._download_database.get_finished_jobs(
+            self._logger, list(self._held)
+        ))
+        d.addCallback(lambda job_ids: [
+            self._cancel(self._held[job_id])
+            for job_id in job_ids
+            if job_id in self._held
+        ])
+        d.addErrback(lambda failure: self._logger.bind(
+            error=failure.getErrorMessage()
+        ).emit("job.heartbeat_error"))
+        return d
+
+    def cancel(self, request_id):
+        """
+        Stops this process's jobs for ``request_id``, which must already have
+        been completed in the database (see ``cancel_download``). Queued jobs
+        are removed from the scheduler, and running ones are cancelled.
+        """
+        self.scheduler.cancel(request_id)
+        for job in self._held.values():
+            if job.request_id != request_id:
+                continue
+            running = job.id in self._running
+            self._cancel(job)
+            if not running:
+                # It's no longer in the scheduler, so it'll never run.
+                del self._held[job.id]
+                self._cancelled.discard(job.id)
+
+    def _cancel(self, job):
+        self._logger.bind(
+            job_id=job.id, kind=job.kind, request_id=job.request_id
+        ).emit("job.cancelled")
+        self._cancelled.add(job.id)
+        d = self._running.get(job.id)
+        if d is not None and not d.called:
+            d.cancel()
+
+    @inlineCallbacks
+    def _claim(self):
+        limit = self._capacity - len(self._held)
+        if limit <= 0:
+            return
+        jobs = yield self._download_database.claim_jobs(
+            self._logger, self.owner, limit, self._lease_duration
+        )
+        for job in jobs:
+            self._logger.bind(
+                job_id=job.id,
+                kind=job.kind,
+                request_id=job.request_id,
+                attempts=job.attempts,
+            ).emit("job.claimed")
+            self._held[job.id] = job
+            self.scheduler.put(
+                functools.partial(self._run, job), job.priority, job.request_id
+            )
+
+    def _run(self, job):
+        # Not ``inlineCallbacks``, which wouldn't pass cancellation on: the
+        # handler's own Deferred is returned, so cancelling it (when a
+        # worker's task deadline passes) runs the handler's canceller. That
+        # only stops the work if the handler has one (``run_job`` aborts its
+        # document fetches); otherwise the work carries on in the background.
+        if job.id in self._cancelled:
+            return succeed(self._finished(None, job))
+        logger = self._logger.bind(
+            job_id=job.id, kind=job.kind, request_id=job.request_id
+        )
+        d = self._running[job.id] = maybeDeferred(self._handler, job)
+        d.addCallbacks(
+            lambda _: self._download_database.complete_job(logger, job),
+            self._failed,
+            errbackArgs=(logger, job),
+        )
+        d.addBoth(self._finished, job)
+        return d
+
+    def _failed(self, failure, logger, job):
+        if job.id in self._cancelled:
+            return None
+        logger = logger.bind(
+            error=failure.getErrorMessage(), attempts=job.attempts
+        )
+        logger.emit("job.error")
+        if job.attempts < self._max_attempts:
+            # The lease is left to expire, after which the job is retried.
+            return failure
+        logger.emit("job.dead_lettered")
+        d = self._download_database.dead_letter_job(
+            logger, job, failure.getErrorMessage()
+        )
+        d.addCallback(lambda _: failure)
+        return d
+
+    def _finished(self, result, job):
+        del self._held[job.id]
+        self._running.pop(job.id, None)
+        self._cancelled.discard(job.id)
+        self.poll()
+        return result
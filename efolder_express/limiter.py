@@ -0,0 +1,113 @@
+from twisted.internet.defer import (
+    Deferred, DeferredSemaphore, maybeDeferred, succeed
+)
+from twisted.python.failure import Failure
+
+
+class FixedLimiter(DeferredSemaphore):
+    """
+    A ``DeferredSemaphore`` with the same interface as ``AdaptiveLimiter``.
+    """
+
+    def run_batch(self, size, f, *args, **kwargs):
+        return self.run(f, *args, **kwargs)
+
+
+class AdaptiveLimiter(object):
+    """
+    A replacement for ``DeferredSemaphore`` whose number of tokens adapts to
+    how the upstream service is coping, using additive-increase /
+    multiplicative-decrease (AIMD).
+
+    Every call which succeeds within ``latency_target`` seconds raises the
+    limit by ``1 / limit`` (so by roughly one per round of calls). A call which
+    takes longer than ``latency_target``, or fails with an exception for which
+    ``is_overload`` returns true, multiplies the limit by ``backoff``; other
+    failures (a cancelled request, a missing document) leave it alone. Only
+    calls which started after the previous decrease can decrease it again, so
+    one slow period shrinks the limit once rather than once per in-flight
+    call. The limit always stays between ``minimum`` and
+    ``maximum``.
+
+    Each change to the (whole number) limit is emitted as a
+    ``vbms.concurrency_limit`` event.
+    """
+
+    def __init__(self, clock, logger, initial, minimum, maximum,
+                 latency_target, backoff=0.75, is_overload=None):
+        assert minimum <= initial <= maximum
+        self._clock = clock
+        self._logger = logger
+        self._minimum = minimum
+        self._maximum = maximum
+        self._latency_target = latency_target
+        self._backoff = backoff
+        self._is_overload = is_overload or (lambda error: True)
+
+        self._limit = float(initial)
+        self._last_decrease = None
+        self._active = 0
+        self._waiting = []
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    def acquire(self):
+        if self._active < self.limit:
+            self._active += 1
+            return succeed(self)
+        d = Deferred()
+        self._waiting.append(d)
+        return d
+
+    def release(self):
+        self._active -= 1
+        self._wake()
+
+    def run(self, f, *args, **kwargs):
+        return self.run_batch(1, f, *args, **kwargs)
+
+    def run_batch(self, size, f, *args, **kwargs):
+        """
+        Like ``run``, for a call which does the work of ``size`` calls; its
+        latency is divided by ``size`` before being compared to the target.
+        """
+        def start(_):
+            started = self._clock.seconds()
+            d = maybeDeferred(f, *args, **kwargs)
+            d.addBoth(finish, started)
+            return d
+
+        def finish(result, started):
+            self.release()
+            latency = (self._clock.seconds() - started) / size
+            failure = result if isinstance(result, Failure) else None
+            self._record(started, latency, failure)
+            return result
+
+        return self.acquire().addCallback(start)
+
+    def _record(self, started, latency, failure):
+        old_limit = self.limit
+        failed = failure is not None
+        if (latency > self._latency_target or
+                failed and self._is_overload(failure.value)):
+            if self._last_decrease is None or started >= self._last_decrease:
+                self._limit = max(self._minimum, self._limit * self._backoff)
+                self._last_decrease = self._clock.seconds()
+        elif not failed:
+            self._limit = min(self._maximum, self._limit + 1 / self._limit)
+
+        if self.limit != old_limit:
+            self._logger.bind(
+                limit=self.limit,
+                latency=latency,
+                failed=failed,
+            ).emit("vbms.concurrency_limit")
+            self._wake()
+
+    def _wake(self):
+        while self._waiting and self._active < self.limit:
+            self._active += 1
+            self._waiting.pop(0).callback(self)
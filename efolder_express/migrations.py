@@ -0,0 +1,165 @@
+"""
+Schema migrations, run in order by ``DownloadDatabase.migrate``.
+
+Each migration is a function which is called with a synchronous SQLAlchemy
+connection and the ``MetaData`` of the current schema. A migration's version
+is its position in ``MIGRATIONS`` (counting from 1), so new migrations are
+only ever appended.
+
+SQLite commits around DDL statements, so a migration isn't atomic. Instead,
+each checks what's already there, so that one which failed part way can
+simply be run again.
+"""
+
+import sqlalchemy
+from sqlalchemy.schema import CreateIndex, CreateTable
+
+
+def create_tables(connection, metadata):
+    """
+    Create any missing tables.
+    """
+    for table in metadata.sorted_tables:
+        # Unlike ``CreateTable``, this also creates the types (such as
+        # PostgreSQL's ``download_state`` enum) and indexes of new tables.
+        table.create(connection, checkfirst=True)
+
+
+def _add_columns(connection, table, names):
+    existing = {
+        column["name"]
+        for column in sqlalchemy.inspect(connection).get_columns(table.name)
+    }
+    compiler = connection.dialect.ddl_compiler(connection.dialect, None)
+    for name in names:
+        if name not in existing:
+            connection.execute("ALTER TABLE {} ADD COLUMN {}".format(
+                table.name, compiler.get_column_specification(table.c[name])
+            ))
+
+
+def add_last_polled_at(connection, metadata):
+    """
+    Add downloads.last_polled_at.
+    """
+    _add_columns(connection, metadata.tables["downloads"], ["last_polled_at"])
+
+
+def add_download_states(connection, metadata):
+    """
+    Allow the WAITING and CANCELLED download states.
+    """
+    if connection.dialect.name == "postgresql":
+        connection = connection.execution_options(
+            isolation_level="AUTOCOMMIT"
+        )
+        for state in ["WAITING", "CANCELLED"]:
+            connection.execute(
+                "ALTER TYPE download_state ADD VALUE IF NOT EXISTS "
+                "'{}'".format(state)
+            )
+    elif connection.dialect.name == "sqlite":
+        row = connection.execute(
+            "SELECT sql FROM sqlite_master "
+            "WHERE type = 'table' AND name = 'downloads'"
+        ).first()
+        if row is None:
+            # An earlier attempt failed after dropping the old table.
+            connection.execute("ALTER TABLE downloads_new RENAME TO downloads")
+        elif "'CANCELLED'" not in row[0]:
+            _rebuild_sqlite_table(connection, metadata.tables["downloads"])
+
+
+def _rebuild_sqlite_table(connection, table):
+    # SQLite can't alter a CHECK constraint, so the table is recreated from
+    # its current definition (see https://www.sqlite.org/lang_altertable.html).
+    columns = ", ".join(
+        column["name"]
+        for column in sqlalchemy.inspect(connection).get_columns(table.name)
+    )
+    new_name = "{}_new".format(table.name)
+    connection.execute("DROP TABLE IF EXISTS {}".format(new_name))
+    connection.execute(str(
+        CreateTable(table).compile(dialect=connection.dialect)
+    ).replace(
+        "CREATE TABLE {} ".format(table.name),
+        "CREATE TABLE {} ".format(new_name),
+        1,
+    ))
+    connection.execute("INSERT INTO {} ({}) SELECT {} FROM {}".format(
+        new_name, columns, columns, table.name
+    ))
+    connection.execute("DROP TABLE {}".format(table.name))
+    connection.execute("ALTER TABLE {} RENAME TO {}".format(
+        new_name, table.name
+    ))
+
+
+def _create_indexes(connection, metadata, names):
+    # Only the named indexes, so that each migration creates the same ones
+    # however many more are added to the schema later.
+    inspector = sqlalchemy.inspect(connection)
+    for table in metadata.sorted_tables:
+        existing = {
+            index["name"] for index in inspector.get_indexes(table.name)
+        }
+        for index in table.indexes:
+            if index.name in names and index.name not in existing:
+                connection.execute(CreateIndex(index))
+
+
+def create_indexes(connection, metadata):
+    """
+    Add the indexes for status pages and pending work.
+    """
+    _create_indexes(connection, metadata, [
+        "ix_downloads_state",
+        "ix_documents_download_id",
+        "ix_documents_pending",
+    ])
+
+
+def add_document_counters(connection, metadata):
+    """
+    Add the downloads.*_documents progress counts, counting the existing
+    documents.
+    """
+    downloads = metadata.tables["downloads"]
+    documents = metadata.tables["documents"]
+    _add_columns(connection, downloads, [
+        "total_documents", "completed_documents", "errored_documents",
+    ])
+
+    def count(where):
+        return sqlalchemy.select([sqlalchemy.func.count()]).where(
+            (documents.c.download_id == downloads.c.request_id) & where
+        ).as_scalar()
+    connection.execute(downloads.update().values(
+        total_documents=count(sqlalchemy.true()),
+        completed_documents=count(documents.c.content_location.isnot(None)),
+        errored_documents=count(
+            documents.c.content_location.is_(None) & documents.c.errored
+        ),
+    ))
+
+
+def create_retention_indexes(connection, metadata):
+    """
+    Add the indexes used to find and delete expired downloads and blobs.
+    """
+    _create_indexes(connection, metadata, [
+        "ix_downloads_started_at",
+        "ix_documents_content_location",
+        "ix_blobs_location",
+        "ix_jobs_request_id",
+    ])
+
+
+MIGRATIONS = [
+    create_tables,
+    add_last_polled_at,
+    add_download_states,
+    create_indexes,
+    add_document_counters,
+    create_retention_indexes,
+]
@@ -0,0 +1,146 @@
+import datetime
+
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import deferLater
+
+from efolder_express.utils import log_failures
+
+
+class Retention(object):
+    """
+    Deletes downloads which started more than ``max_age`` seconds ago, along
+    with their documents, jobs, and the blobs no other download uses, and
+    keeps ``blob_store`` and the ``blobs`` table in step.
+
+    Work is done ``batch_size`` rows or blobs at a time, pausing for
+    ``batch_delay`` seconds between batches, so that it doesn't hold up
+    everything else using the database.
+    """
+
+    def __init__(self, clock, logger, download_database, blob_store,
+                 max_age, batch_size=100, batch_delay=1,
+                 orphan_age=24 * 60 * 60):
+        self._clock = clock
+        self._logger = logger
+        self._download_database = download_database
+        self._blob_store = blob_store
+        self._max_age = max_age
+        self._batch_size = batch_size
+        self._batch_delay = batch_delay
+        # Blobs are stored before they're recorded in the database, so one
+        # with no row is only an orphan once it's this old (in seconds).
+        self._orphan_age = orphan_age
+
+    def _pause(self):
+        return deferLater(self._clock, self._batch_delay, lambda: None)
+
+    def collect(self):
+        """
+        Deletes every expired download, and the manifests cached before
+        them.
+        """
+        return log_failures(
+            self._logger, "retention.collect_error", self._collect
+        )
+
+    @inlineCallbacks
+    def _collect(self):
+        expired_before = datetime.datetime.utcfromtimestamp(
+            self._clock.seconds() - self._max_age
+        )
+        downloads = documents = blobs = reclaimed = 0
+        while True:
+            request_ids = yield self._download_database.get_expired_downloads(
+                self._logger, expired_before, self._batch_size
+            )
+            if request_ids:
+                deleted, locations = (
+                    yield self._download_database.delete_downloads(
+                        self._logger, request_ids
+                    )
+                )
+                downloads += len(request_ids)
+                documents += deleted
+                blobs += len(locations)
+                for location in locations:
+                    size = yield self._blob_store.delete(location)
+                    reclaimed += size or 0
+            if len(request_ids) < self._batch_size:
+                break
+            yield self._pause()
+        yield self._download_database.delete_expired_manifests(
+            self._logger, expired_before
+        )
+        self._logger.bind(
+            downloads=downloads,
+            documents=documents,
+            blobs=blobs,
+            bytes_reclaimed=reclaimed,
+        ).emit("retention.collected")
+
+    def check_storage(self):
+        """
+        Deletes blobs in the store which the database doesn't know about, and
+        forgets blobs which are missing from the store.
+        """
+        return log_failures(
+            self._logger, "retention.check_storage_error", self._check_storage
+        )
+
+    @inlineCallbacks
+    def _check_storage(self):
+        orphans = missing = reclaimed = 0
+
+        after = None
+        while True:
+            keys = yield self._blob_store.list_keys(after, self._batch_size)
+            referenced = (
+                yield self._download_database.get_referenced_locations(
+                    self._logger, keys
+                )
+            )
+            now = self._clock.seconds()
+            for key in keys:
+                if key in referenced:
+                    continue
+                blob_stat = yield self._blob_store.stat(key)
+                if (
+                    blob_stat is None or
+                    now - blob_stat.modified_at < self._orphan_age
+                ):
+                    continue
+                size = yield self._blob_store.delete(key)
+                orphans += 1
+                reclaimed += size or 0
+                self._logger.bind(
+                    key=key, size=size
+                ).emit("retention.orphan_file")
+            if len(keys) < self._batch_size:
+                break
+            after = keys[-1]
+            yield self._pause()
+
+        after = None
+        while True:
+            locations = yield self._download_database.get_blob_locations(
+                self._logger, after, self._batch_size
+            )
+            for location in locations:
+                if (yield self._blob_store.stat(location)) is None:
+                    yield self._download_database.delete_blob(
+                        self._logger, location
+                    )
+                    missing += 1
+                    self._logger.bind(
+                        key=location
+                    ).emit("retention.missing_file")
+            if len(locations) < self._batch_size:
+                break
+            after = locations[-1]
+            yield self._pause()
+
+        self._logger.bind(
+            orphans=orphans,
+            missing=missing,
+            bytes_reclaimed=reclaimed,
+        ).emit("retention.storage_checked")
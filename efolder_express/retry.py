@@ -0,0 +1,208 @@
+import random
+import re
+
+from twisted.internet.defer import inlineCallbacks, maybeDeferred, returnValue
+from twisted.internet.task import deferLater
+
+from efolder_express.vbms import (
+    VBMSAbortedError, VBMSError, VBMSTimeoutError
+)
+
+
+# Errors which VBMS (or the network in between) reports for a request that
+# may well succeed if it's made again.
+TRANSIENT_ERRORS = re.compile("|".join([
+    r"Timeout",
+    r"ECONNRESET",
+    r"ECONNREFUSED",
+    r"EHOSTUNREACH",
+    r"ETIMEDOUT",
+    r"EPIPE",
+    r"SocketError",
+    r"SSLError",
+    r"Connection reset",
+    r"Service Unavailable",
+    r"Bad Gateway",
+    r"\b50[234]\b",
+    r"Circuit breaker open",
+]), re.IGNORECASE)
+
+# Errors which will happen again however often the request is retried. These
+# are checked first, so a "document not found" is never retried even if its
+# message happens to mention a timeout.
+FATAL_ERRORS = re.compile("|".join([
+    r"not found",
+    r"Invalid file number",
+    r"ClientError",
+    r"Worker pool stopped",
+]), re.IGNORECASE)
+
+
+def is_retryable(error):
+    """
+    Classifies a failed VBMS call. Timeouts, and processes which died without
+    any output (for example killed by a signal), are assumed to be transient,
+    otherwise the error is retryable only if ``stderr`` matches
+    ``TRANSIENT_ERRORS``. Aborted requests are never retried.
+    """
+    if isinstance(error, VBMSAbortedError):
+        return False
+    if isinstance(error, VBMSTimeoutError):
+        return True
+    if not isinstance(error, VBMSError):
+        return False
+    stderr = error.stderr or ""
+    if FATAL_ERRORS.search(stderr):
+        return False
+    if TRANSIENT_ERRORS.search(stderr):
+        return True
+    return error.exit_code is None and not stderr.strip()
+
+
+class CircuitOpenError(VBMSError):
+    def __init__(self):
+        super(CircuitOpenError, self).__init__(
+            "", "Circuit breaker open", None
+        )
+
+
+class RetryBudget(object):
+    """
+    The number of retries a single download may make, shared by all of its
+    VBMS calls, so that one eFolder of failing documents can't monopolize
+    VBMS with retries.
+    """
+
+    def __init__(self, retries):
+        self.remaining = retries
+
+    def spend(self):
+        if self.remaining <= 0:
+            return False
+        self.remaining -= 1
+        return True
+
+
+class RetryPolicy(object):
+    """
+    Retries failed calls which ``is_retryable`` with capped exponential
+    backoff and full jitter: before attempt ``n`` (counting from 0) it waits a
+    random delay between 0 and ``min(max_delay, base_delay * 2 ** n)``
+    seconds, scheduled on ``clock``.
+    """
+
+    def __init__(self, clock, max_attempts, base_delay, max_delay,
+                 random=random.random):
+        self._clock = clock
+        self._max_attempts = max_attempts
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._random = random
+
+    def delay(self, attempt):
+        return self._random() * min(
+            self._max_delay, self._base_delay * 2 ** attempt
+        )
+
+    @inlineCallbacks
+    def run(self, logger, budget, f, before_retry=None):
+        """
+        Calls ``f`` until it succeeds, fails with an error which isn't
+        retryable, runs out of attempts, or ``budget`` (which may be ``None``
+        for no limit) is used up. ``before_retry`` is called before each
+        retry.
+        """
+        attempt = 0
+        while True:
+            try:
+                result = yield maybeDeferred(f)
+            except Exception as e:
+                attempt += 1
+                if (
+                    not is_retryable(e) or
+                    attempt >= self._max_attempts or
+                    (budget is not None and not budget.spend())
+                ):
+                    raise
+                delay = self.delay(attempt)
+                logger.bind(
+                    attempt=attempt,
+                    delay=delay,
+                    stderr=e.stderr,
+                    exit_code=e.exit_code,
+                ).emit("vbms.retry")
+                yield deferLater(self._clock, delay, lambda: None)
+                if before_retry is not None:
+                    before_retry()
+            else:
+                returnValue(result)
+
+
+class CircuitBreaker(object):
+    """
+    Stops calls to VBMS while it is clearly down. After
+    ``failure_threshold`` consecutive retryable failures the circuit opens
+    and every call fails immediately with ``CircuitOpenError``. Once
+    ``reset_timeout`` seconds have passed a single probe call is let through
+    (half-open); if it succeeds the circuit closes again, otherwise it
+    re-opens for another ``reset_timeout``.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, clock, logger, failure_threshold, reset_timeout):
+        self._clock = clock
+        self._logger = logger
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    def call(self, f, *args, **kwargs):
+        if self.state == self.OPEN:
+            if self._clock.seconds() < self._opened_at + self._reset_timeout:
+                return maybeDeferred(self._reject)
+            self._set_state(self.HALF_OPEN)
+        if self.state == self.HALF_OPEN:
+            if self._probing:
+                return maybeDeferred(self._reject)
+            self._probing = True
+
+        d = maybeDeferred(f, *args, **kwargs)
+        d.addCallbacks(self._succeeded, self._failed)
+        return d
+
+    def _reject(self):
+        raise CircuitOpenError()
+
+    def _succeeded(self, result):
+        self._probing = False
+        self._failures = 0
+        if self.state != self.CLOSED:
+            self._set_state(self.CLOSED)
+        return result
+
+    def _failed(self, failure):
+        self._probing = False
+        if is_retryable(failure.value):
+            self._failures += 1
+            if (
+                self.state == self.HALF_OPEN or
+                self._failures >= self._failure_threshold
+            ):
+                self._opened_at = self._clock.seconds()
+                self._set_state(self.OPEN)
+        elif self.state == self.HALF_OPEN:
+            # VBMS answered, even if it was with an error.
+            self._failures = 0
+            self._set_state(self.CLOSED)
+        return failure
+
+    def _set_state(self, state):
+        self.state = state
+        self._logger.bind(state=state).emit("vbms.circuit_breaker")
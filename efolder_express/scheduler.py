@@ -0,0 +1,121 @@
+import collections
+
+from twisted.internet.defer import Deferred, succeed
+
+
+MANIFEST = "manifest"
+DOCUMENTS = "documents"
+# The work of downloads whose status page is no longer being watched.
+BACKGROUND = "background"
+
+# Highest priority first: listing a new download's documents is a single call
+# which the user is waiting on, so it never waits behind document fetches.
+PRIORITIES = [MANIFEST, DOCUMENTS, BACKGROUND]
+
+ROUND_ROBIN = "round_robin"
+SHORTEST_FIRST = "shortest_first"
+
+
+class Scheduler(object):
+    """
+    A replacement for ``DeferredQueue`` which is fair between downloads.
+
+    Items are taken from the highest priority class with any queued. Within a
+    class, each ``request_id`` has its own FIFO queue, and those queues are
+    served round-robin, so a download with thousands of documents can't
+    starve one with ten. With the ``shortest_first`` policy the download with
+    the fewest queued items is served first instead.
+
+    Each item taken is emitted as a ``scheduler.dequeue`` event, with how
+    long it waited and the number of items still queued in its class.
+    """
+
+    def __init__(self, clock, logger, policy=ROUND_ROBIN):
+        assert policy in [ROUND_ROBIN, SHORTEST_FIRST]
+        self._clock = clock
+        self._logger = logger
+        self._policy = policy
+
+        # For each priority class, the queues of each request_id with items
+        # queued, in the order they're served.
+        self._queues = {
+            priority: collections.OrderedDict() for priority in PRIORITIES
+        }
+        self._waiting = []
+
+    def depth(self, priority):
+        return sum(len(q) for q in self._queues[priority].values())
+
+    def oldest_wait(self):
+        """
+        Returns how long (in seconds) the longest-waiting queued item has been
+        waiting, or 0 if nothing is queued.
+        """
+        queued_at = [
+            q[0][1]
+            for queues in self._queues.values()
+            for q in queues.values()
+        ]
+        if not queued_at:
+            return 0
+        return self._clock.seconds() - min(queued_at)
+
+    def put(self, item, priority=DOCUMENTS, request_id=None):
+        if self._waiting:
+            self._emit_dequeue(priority, 0)
+            self._waiting.pop(0).callback(item)
+            return
+        self._queues[priority].setdefault(request_id, collections.deque())
+        self._queues[priority][request_id].append(
+            (item, self._clock.seconds())
+        )
+
+    def deprioritize(self, request_id):
+        """
+        Moves the queued items of ``request_id`` to the ``background`` class.
+        """
+        for priority in [MANIFEST, DOCUMENTS]:
+            q = self._queues[priority].pop(request_id, None)
+            if q:
+                self._queues[BACKGROUND].setdefault(
+                    request_id, collections.deque()
+                ).extend(q)
+
+    def cancel(self, request_id):
+        """
+        Removes the queued items of ``request_id``, returning how many there
+        were.
+        """
+        return sum(
+            len(queues.pop(request_id, ()))
+            for queues in self._queues.values()
+        )
+
+    def get(self):
+        for priority in PRIORITIES:
+            queues = self._queues[priority]
+            if queues:
+                return succeed(self._pop(priority, queues))
+        d = Deferred(canceller=self._waiting.remove)
+        self._waiting.append(d)
+        return d
+
+    def _pop(self, priority, queues):
+        if self._policy == SHORTEST_FIRST:
+            request_id = min(queues, key=lambda r: len(queues[r]))
+        else:
+            request_id = next(iter(queues))
+        q = queues.pop(request_id)
+        item, queued_at = q.popleft()
+        if q:
+            # Back of the line for this download's next item.
+            queues[request_id] = q
+        self._emit_dequeue(priority, self._clock.seconds() - queued_at)
+        return item
+
+    def _emit_dequeue(self, priority, wait):
+        self._logger.bind(
+            priority=priority,
+            wait=wait,
+            depth=self.depth(priority),
+        ).emit("scheduler.dequeue")
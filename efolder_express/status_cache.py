@@ -0,0 +1,120 @@
+import collections
+
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+
+# States in which a download's status no longer changes.
+FINAL_STATES = frozenset(["ERRORED", "CANCELLED"])
+
+
+class StatusCache(object):
+    """
+    The most recently used ``size`` downloads' progress (``DownloadStatus``
+    without documents), by ``request_id``.
+
+    ``DownloadDatabase`` updates the cached statuses in place as it writes,
+    so they're always current as far as this process's writes go. If other
+    processes write to the same database, or statuses are read from a
+    replica, entries for unfinished downloads are reloaded once they're
+    older than ``ttl`` seconds. Finished ones are kept until they're evicted.
+
+    The hit rate and evictions since the last report are emitted as a
+    ``status_cache.gauges`` event.
+    """
+
+    def __init__(self, clock, logger, size, ttl=None):
+        self._clock = clock
+        self._logger = logger
+        self._size = size
+        self._ttl = ttl
+        # request_id -> (DownloadStatus, when it was loaded), least recently
+        # used first.
+        self._entries = collections.OrderedDict()
+        # request_id -> [number of loads in progress, whether it was written
+        # since they started].
+        self._loading = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @inlineCallbacks
+    def get(self, request_id, load):
+        """
+        Returns the status of ``request_id``, from the cache, or from
+        ``load()`` (which returns a ``Deferred``) if it isn't cached.
+        """
+        entry = self._entries.pop(request_id, None)
+        if entry is not None:
+            status, loaded_at = entry
+            if not self._expired(status, loaded_at):
+                self._entries[request_id] = entry
+                self.hits += 1
+                returnValue(status)
+        self.misses += 1
+
+        loading = self._loading.setdefault(request_id, [0, False])
+        loading[0] += 1
+        try:
+            status = yield load()
+        finally:
+            loading[0] -= 1
+            if not loading[0]:
+                del self._loading[request_id]
+        # A load which might have missed a write isn't cached.
+        if not loading[1]:
+            self._put(status)
+        returnValue(status)
+
+    def _expired(self, status, loaded_at):
+        return (
+            self._ttl is not None and
+            not (status.completed or status.state in FINAL_STATES) and
+            self._clock.seconds() - loaded_at >= self._ttl
+        )
+
+    def _put(self, status):
+        self._entries.pop(status.request_id, None)
+        self._entries[status.request_id] = (status, self._clock.seconds())
+        while len(self._entries) > self._size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def update(self, request_id, state=None, total=0, completed=0,
+               errored=0):
+        """
+        Applies a write to the cached status of ``request_id``, if there is
+        one: a new ``state``, and/or changes to its document counts.
+        """
+        if request_id in self._loading:
+            self._loading[request_id][1] = True
+        entry = self._entries.get(request_id)
+        if entry is None:
+            return
+        status, _ = entry
+        if state is not None:
+            status.state = state
+        status.total_documents += total
+        status.completed_documents += completed
+        status.errored_documents += errored
+
+    def discard(self, request_id):
+        """
+        Forgets ``request_id``, which was deleted.
+        """
+        if request_id in self._loading:
+            self._loading[request_id][1] = True
+        self._entries.pop(request_id, None)
+
+    def emit_gauges(self):
+        lookups = self.hits + self.misses
+        self._logger.bind(
+            size=len(self._entries),
+            hits=self.hits,
+            misses=self.misses,
+            hit_rate=float(self.hits) / lookups if lookups else 0.0,
+            evictions=self.evictions,
+        ).emit("status_cache.gauges")
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
@@ -0,0 +1,80 @@
+import hashlib
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+class EncryptingWriter(object):
+    """
+    Encrypts data as it is written to the blob ``key`` of ``blob_store``, so
+    that a document never has to be held in memory in full.
+
+    The plaintext is split into chunks of ``chunk_size`` bytes and each chunk
+    is written as its own Fernet token on its own line. A file written before
+    documents were streamed is a single token, so ``decrypt_file`` reads both.
+
+    ``content_hash`` is the SHA-256 of the plaintext written so far.
+    """
+
+    def __init__(self, fernet, blob_store, key, chunk_size=CHUNK_SIZE):
+        self._fernet = fernet
+        self.key = key
+        self._chunk_size = chunk_size
+        self._buffer = []
+        self._buffered = 0
+        self._f = blob_store.open_writer(key)
+        self._hash = hashlib.sha256()
+
+    @property
+    def content_hash(self):
+        return self._hash.hexdigest()
+
+    def write(self, data):
+        self._hash.update(data)
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self._chunk_size:
+            data = b"".join(self._buffer)
+            while len(data) >= self._chunk_size:
+                self._write_chunk(data[:self._chunk_size])
+                data = data[self._chunk_size:]
+            self._buffer = [data]
+            self._buffered = len(data)
+
+    def close(self):
+        """
+        Returns a ``Deferred`` which fires once the blob is stored.
+        """
+        if self._buffered or self._f.tell() == 0:
+            self._write_chunk(b"".join(self._buffer))
+        self._buffer = []
+        self._buffered = 0
+        return self._f.close()
+
+    def reset(self):
+        """
+        Discards everything written so far, so the document can be written
+        again from the start.
+        """
+        self._buffer = []
+        self._buffered = 0
+        self._hash = hashlib.sha256()
+        self._f.seek(0)
+        self._f.truncate()
+
+    def abort(self):
+        return self._f.discard()
+
+    def _write_chunk(self, chunk):
+        self._f.write(self._fernet.encrypt(chunk) + b"\n")
+
+
+def decrypt_file(fernet, f):
+    """
+    Yields the plaintext of a file written by ``EncryptingWriter``, one chunk
+    at a time.
+    """
+    for line in f:
+        line = line.strip()
+        if line:
+            yield fernet.decrypt(line)
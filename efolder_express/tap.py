@@ -1,18 +1,68 @@
-from twisted.application.internet import StreamServerEndpointService
+from twisted.application.internet import (
+    StreamServerEndpointService, TimerService
+)
 from twisted.application.service import MultiService, Service
-from twisted.internet.defer import DeferredQueue, inlineCallbacks
+from twisted.internet.defer import inlineCallbacks
 from twisted.internet.endpoints import serverFromString
 from twisted.python import log, usage
 from twisted.web.server import Site
 
 from efolder_express.app import DownloadEFolder
+from efolder_express.blob_store import move_legacy_blobs
 from efolder_express.log import Logger
 
 
+# How often (in seconds) to check whether the document types need refreshing.
+DOCUMENT_TYPES_CHECK_INTERVAL = 5 * 60
+
+# How often (in seconds) to check whether waiting downloads can start.
+ADMISSION_CHECK_INTERVAL = 10
+
+# How often (in seconds) to look for downloads nobody is watching any more.
+ABANDONMENT_CHECK_INTERVAL = 60
+
+# How often (in seconds) to report the status cache's hit rate.
+STATUS_CACHE_GAUGE_INTERVAL = 60
+
+# How often (in seconds) to delete expired downloads, and to check the blob
+# store against the database.
+RETENTION_INTERVAL = 60 * 60
+STORAGE_CHECK_INTERVAL = 24 * 60 * 60
+
+
 class CreateDatabaseOptions(usage.Options):
     pass
 
 
+class MigrateOptions(usage.Options):
+    optParameters = [
+        [
+            "target", None, None,
+            "Only migrate up to this version (by default, the latest).", int
+        ],
+    ]
+
+
+class EnqueuePendingWorkOptions(usage.Options):
+    pass
+
+
+class MigrateBlobsOptions(usage.Options):
+    optParameters = [
+        ["batch-size", None, 100, "Move this many files at a time.", int],
+    ]
+
+
+class DeadLettersOptions(usage.Options):
+    optParameters = [
+        ["replay", None, None, "Replay the dead-lettered job with this id."],
+    ]
+
+    optFlags = [
+        ["replay-all", None, "Replay every dead-lettered job."],
+    ]
+
+
 class Options(usage.Options):
     subCommands = [
         [
@@ -21,6 +71,30 @@ class Options(usage.Options):
             CreateDatabaseOptions,
             "Create the database"
         ],
+        [
+            "migrate",
+            None,
+            MigrateOptions,
+            "Apply any schema migrations the database is missing"
+        ],
+        [
+            "migrate-blobs",
+            None,
+            MigrateBlobsOptions,
+            "Move documents stored in the old flat layout into the blob store"
+        ],
+        [
+            "enqueue-pending-work",
+            None,
+            EnqueuePendingWorkOptions,
+            "Queue jobs for work started before upgrading to the jobs table"
+        ],
+        [
+            "dead-letters",
+            None,
+            DeadLettersOptions,
+            "List or replay jobs which failed too many times"
+        ],
     ]
 
     optParameters = [
@@ -44,28 +118,129 @@ class CreateDatabaseService(Service):
     @inlineCallbacks
     def start_create_tables(self):
         try:
-            yield self.app.download_database.create_database()
+            yield self.app.download_database.create_database(self.app.logger)
         finally:
             self.reactor.stop()
 
 
-class DeferredQueueConsumerService(Service):
-    def __init__(self, queue, handler):
-        self.queue = queue
+class MigrateService(Service):
+    def __init__(self, reactor, app, options):
+        self.reactor = reactor
+        self.app = app
+        self.options = options
+
+    def startService(self):
+        Service.startService(self)
+        self.start_migrate()
+
+    @inlineCallbacks
+    def start_migrate(self):
+        try:
+            yield self.app.download_database.migrate(
+                self.app.logger, target=self.options["target"]
+            )
+        finally:
+            self.reactor.stop()
+
+
+class MigrateBlobsService(Service):
+    def __init__(self, reactor, app, options):
+        self.reactor = reactor
+        self.app = app
+        self.options = options
+
+    def startService(self):
+        Service.startService(self)
+        self.start_migrate_blobs()
+
+    @inlineCallbacks
+    def start_migrate_blobs(self):
+        try:
+            yield move_legacy_blobs(
+                self.app.logger,
+                self.app.download_database,
+                self.app.blob_store,
+                batch_size=self.options["batch-size"],
+            )
+        finally:
+            self.reactor.stop()
+
+
+class EnqueuePendingWorkService(Service):
+    def __init__(self, reactor, app):
+        self.reactor = reactor
+        self.app = app
+
+    def startService(self):
+        Service.startService(self)
+        self.start_enqueue_pending_work()
+
+    @inlineCallbacks
+    def start_enqueue_pending_work(self):
+        try:
+            yield self.app.queue_pending_work()
+        finally:
+            self.reactor.stop()
+
+
+class JobQueueService(Service):
+    def __init__(self, jobs, handler):
+        self.jobs = jobs
         self.handler = handler
 
     def startService(self):
         Service.startService(self)
-        self.start_consume_queue()
+        self.jobs.start(self.handler)
+
+    def stopService(self):
+        Service.stopService(self)
+        self.jobs.stop()
+
+
+class DeadLettersService(Service):
+    def __init__(self, reactor, app, options):
+        self.reactor = reactor
+        self.app = app
+        self.options = options
+
+    def startService(self):
+        Service.startService(self)
+        self.start_dead_letters()
 
     @inlineCallbacks
-    def start_consume_queue(self):
-        # Without any special termination logic, SIGINT kills the process
-        # cleanly. So that seems sufficient.
-        while True:
-            item = yield self.queue.get()
-            # TODO: error handling
-            yield self.handler(item)
+    def start_dead_letters(self):
+        db = self.app.download_database
+        try:
+            if self.options["replay-all"]:
+                yield db.replay_dead_letters(self.app.logger)
+            elif self.options["replay"]:
+                yield db.replay_dead_letters(
+                    self.app.logger, [self.options["replay"]]
+                )
+            else:
+                for job in (yield db.get_dead_letters(self.app.logger)):
+                    self.app.logger.bind(
+                        job_id=job.id,
+                        kind=job.kind,
+                        request_id=job.request_id,
+                        attempts=job.attempts,
+                        error=job.error,
+                    ).emit("dead_letter")
+        finally:
+            self.reactor.stop()
+
+
+class WorkerPoolService(Service):
+    def __init__(self, workers):
+        self.workers = workers
+
+    def startService(self):
+        Service.startService(self)
+        self.workers.start()
+
+    def stopService(self):
+        Service.stopService(self)
+        self.workers.stop()
 
 
 def makeService(options):
@@ -76,20 +251,22 @@ def makeService(options):
     if options["demo"]:
         app = DownloadEFolder.create_demo(reactor, Logger(log))
     else:
-        queue = DeferredQueue()
         app = DownloadEFolder.from_config(
             reactor,
             Logger(log),
-            queue,
             options["config"],
         )
 
     if options.subCommand == "create-database":
         return CreateDatabaseService(reactor, app)
-
-    if not options["demo"]:
-        app.start_fetch_document_types()
-        app.queue_pending_work()
+    if options.subCommand == "migrate":
+        return MigrateService(reactor, app, options.subOptions)
+    if options.subCommand == "migrate-blobs":
+        return MigrateBlobsService(reactor, app, options.subOptions)
+    if options.subCommand == "enqueue-pending-work":
+        return EnqueuePendingWorkService(reactor, app)
+    if options.subCommand == "dead-letters":
+        return DeadLettersService(reactor, app, options.subOptions)
 
     service = MultiService()
     endpoint = serverFromString(reactor, "tcp:8080:interface=127.0.0.1")
@@ -98,8 +275,34 @@ def makeService(options):
         Site(app.app.resource(), logPath="/dev/null"),
     ).setServiceParent(service)
     if not options["demo"]:
-        for _ in xrange(8):
-            DeferredQueueConsumerService(
-                queue, lambda item: item()
+        # Document types are loaded from the database immediately, and
+        # refreshed from VBMS once they're stale.
+        TimerService(
+            DOCUMENT_TYPES_CHECK_INTERVAL, app.refresh_document_types
+        ).setServiceParent(service)
+        JobQueueService(app.jobs, app.run_job).setServiceParent(service)
+        WorkerPoolService(app.workers).setServiceParent(service)
+        # Even without admission control, so that downloads left waiting
+        # when it was turned off are started.
+        TimerService(
+            ADMISSION_CHECK_INTERVAL, app.admit_waiting_downloads
+        ).setServiceParent(service)
+        if (
+            app.deprioritize_after is not None or
+            app.cancel_after is not None
+        ):
+            TimerService(
+                ABANDONMENT_CHECK_INTERVAL, app.check_abandoned_downloads
+            ).setServiceParent(service)
+        if app.retention is not None:
+            TimerService(
+                RETENTION_INTERVAL, app.retention.collect
+            ).setServiceParent(service)
+            TimerService(
+                STORAGE_CHECK_INTERVAL, app.retention.check_storage
+            ).setServiceParent(service)
+        if app.status_cache is not None:
+            TimerService(
+                STATUS_CACHE_GAUGE_INTERVAL, app.status_cache.emit_gauges
             ).setServiceParent(service)
     return service
@@ -1,4 +1,7 @@
-from twisted.internet.defer import Deferred, succeed
+import struct
+
+from twisted.internet.defer import Deferred, maybeDeferred, succeed
+from twisted.python.failure import Failure
 
 
 class DeferredValue(object):
@@ -26,3 +29,77 @@ class DeferredValue(object):
             d.callback(value)
 
         del self._waiters[:]
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls: while a call made with ``run`` is in flight,
+    later calls with the same key wait for it and get the same result (or
+    failure), instead of being made again. ``coalesced`` counts those calls.
+    """
+
+    def __init__(self):
+        self._in_flight = {}
+        self.coalesced = 0
+
+    def __contains__(self, key):
+        return key in self._in_flight
+
+    def run(self, key, f, *args, **kwargs):
+        if key in self._in_flight:
+            self.coalesced += 1
+            d = Deferred()
+            self._in_flight[key].append(d)
+            return d
+
+        waiters = self._in_flight[key] = []
+
+        def done(result):
+            del self._in_flight[key]
+            for d in waiters:
+                if isinstance(result, Failure):
+                    d.errback(result)
+                else:
+                    d.callback(result)
+            return result
+
+        return maybeDeferred(f, *args, **kwargs).addBoth(done)
+
+
+def log_failures(logger, event, f, *args, **kwargs):
+    """
+    Calls ``f``, logging its failure as ``event`` rather than returning it,
+    so that the ``TimerService`` (or ``LoopingCall``) which runs it keeps
+    running.
+    """
+    d = maybeDeferred(f, *args, **kwargs)
+    d.addErrback(
+        lambda failure: logger.bind(
+            error=failure.getErrorMessage()
+        ).emit(event)
+    )
+    return d
+
+
+def encode_frame(data):
+    """
+    Frames ``data`` with a 4-byte big-endian length prefix, the format
+    understood by ``FrameParser``.
+    """
+    return struct.pack(">I", len(data)) + data
+
+
+class FrameParser(object):
+    def __init__(self, frame_received):
+        self._frame_received = frame_received
+        self._buffer = b""
+
+    def data_received(self, data):
+        self._buffer += data
+        while len(self._buffer) >= 4:
+            [length] = struct.unpack(">I", self._buffer[:4])
+            if len(self._buffer) < 4 + length:
+                break
+            frame = self._buffer[4:4 + length]
+            self._buffer = self._buffer[4 + length:]
+            self._frame_received(frame)
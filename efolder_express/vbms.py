@@ -1,13 +1,19 @@
+import functools
 import json
 import os
 import pipes
+import shutil
+import signal
 import stat
+import sys
 import tempfile
+import weakref
 
-from twisted.internet.defer import (
-    DeferredSemaphore, inlineCallbacks, returnValue
-)
-from twisted.internet.utils import getProcessOutputAndValue
+from twisted.internet.defer import Deferred, inlineCallbacks, returnValue
+from twisted.internet.protocol import ProcessProtocol
+
+from efolder_express.limiter import FixedLimiter
+from efolder_express.utils import FrameParser, SingleFlight
 
 
 class VBMSError(Exception):
@@ -18,9 +24,247 @@ class VBMSError(Exception):
         self.exit_code = exit_code
 
 
+class VBMSTimeoutError(VBMSError):
+    def __init__(self, stdout, stderr, exit_code, timeout):
+        super(VBMSTimeoutError, self).__init__(
+            stdout,
+            "{}Timed out after {} seconds".format(stderr, timeout),
+            exit_code,
+        )
+        self.timeout = timeout
+
+
+class VBMSAbortedError(VBMSError):
+    """
+    The request was aborted with ``VBMSClient.abort``. It's never retried.
+    """
+
+    def __init__(self, stdout="", stderr="", exit_code=None):
+        super(VBMSAbortedError, self).__init__(
+            stdout, "{}Aborted".format(stderr), exit_code
+        )
+
+
+# Runs a command as the leader of a new process group, so that everything it
+# starts can be killed along with it, see ``terminate_process_group``.
+NEW_PROCESS_GROUP = [
+    sys.executable,
+    "-c",
+    "import os, sys; os.setsid(); os.execv(sys.argv[1], sys.argv[1:])",
+]
+
+
+def _signal_process_group(pid, sig):
+    try:
+        os.killpg(pid, sig)
+    except OSError:
+        # The process group has already exited.
+        pass
+
+
+def terminate_process_group(reactor, transport, grace_period):
+    """
+    Sends SIGTERM to the process group led by the process of ``transport``
+    (see ``NEW_PROCESS_GROUP``), followed by SIGKILL ``grace_period`` seconds
+    later. Returns the ``DelayedCall`` of the SIGKILL, for
+    ``process_group_ended``.
+    """
+    pid = transport.pid
+    if pid is None:
+        return None
+    _signal_process_group(pid, signal.SIGTERM)
+    return reactor.callLater(
+        grace_period, _signal_process_group, pid, signal.SIGKILL
+    )
+
+
+def process_group_ended(kill_call):
+    """
+    Cancels the SIGKILL scheduled by ``terminate_process_group`` once the
+    group's leader has exited, so that it can't reach a new process group
+    which reuses the id. Anything left in the group is killed straight away
+    instead.
+    """
+    if kill_call is not None and kill_call.active():
+        # ``cancel`` forgets the call's arguments.
+        args = kill_call.args
+        kill_call.cancel()
+        _signal_process_group(*args)
+
+
+_SINGLE_REQUEST = """
+request = {request}
+result = client.send(request)
+STDOUT.write({formatter})
+STDOUT.flush()
+"""
+
+_REQUESTS = {
+    "GetDocumentTypes": _SINGLE_REQUEST.format(
+        request="VBMS::Requests::GetDocumentTypes.new()",
+        formatter="result.map(&:to_h).to_json",
+    ),
+    "ListDocuments": _SINGLE_REQUEST.format(
+        request="VBMS::Requests::ListDocuments.new(ARGV[0])",
+        formatter="result.map(&:to_h).to_json",
+    ),
+    "FetchDocumentById": _SINGLE_REQUEST.format(
+        request="VBMS::Requests::FetchDocumentById.new(ARGV[0])",
+        formatter="result.content",
+    ),
+    # Fetches every document id in ARGV, writing one response per document
+    # in the same framing used by connect_vbms_worker.rb.
+    "FetchDocumentsById": """
+STDOUT.binmode
+
+def write_frame(data)
+  data = data.to_s.b
+  STDOUT.write([data.bytesize].pack('N'))
+  STDOUT.write(data)
+end
+
+ARGV.each do |document_id|
+  begin
+    request = VBMS::Requests::FetchDocumentById.new(document_id)
+    content = client.send(request).content.to_s
+  rescue StandardError => e
+    write_frame({
+      'status' => 'error',
+      'error' => "#{e.class}: #{e.message}",
+    }.to_json)
+  else
+    write_frame({ 'status' => 'ok' }.to_json)
+    (0...content.bytesize).step(64 * 1024) do |offset|
+      write_frame(content.byteslice(offset, 64 * 1024))
+    end
+    write_frame('')
+  end
+  STDOUT.flush
+end
+""",
+}
+
+
+class ResponseReader(object):
+    """
+    Parses the responses written by ``connect_vbms_worker.rb`` (and the
+    ``FetchDocumentsById`` script): a JSON header frame, followed for
+    successful responses by the body in chunks, terminated by an empty frame.
+    """
+
+    def __init__(self):
+        self._parser = FrameParser(self._frame_received)
+        self._pending = []
+        self._got_header = False
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    def expect(self, write):
+        """
+        Returns a ``Deferred`` for the next response, which fires once its
+        body has been passed to ``write``, or fails with a ``VBMSError``.
+        """
+        d = Deferred()
+        self._pending.append((d, write))
+        return d
+
+    def data_received(self, data):
+        self._parser.data_received(data)
+
+    def fail_all(self, exc):
+        pending = self._pending
+        self._pending = []
+        for d, _ in pending:
+            d.errback(exc)
+
+    def _frame_received(self, frame):
+        if not self._pending:
+            return
+        d, write = self._pending[0]
+        if not self._got_header:
+            header = json.loads(frame)
+            if header["status"] == "error":
+                self._pending.pop(0)
+                d.errback(VBMSError("", header["error"], None))
+            else:
+                self._got_header = True
+        elif frame:
+            write(frame)
+        else:
+            self._pending.pop(0)
+            self._got_header = False
+            d.callback(None)
+
+
+class _StreamingProcessProtocol(ProcessProtocol):
+    """
+    Passes a process's stdout to ``write`` as it arrives, rather than
+    collecting it in memory. ``ended`` fires with a 2-tuple of the process's
+    stderr and its exit code.
+    """
+
+    def __init__(self, write):
+        self._write = write
+        self._stderr = []
+        self.ended = Deferred()
+        self.timed_out = False
+        self.aborted = False
+        self._kill_call = None
+
+    def terminate(self, reactor, grace_period):
+        self.timed_out = True
+        self._kill_call = terminate_process_group(
+            reactor, self.transport, grace_period
+        )
+
+    def abort(self, reactor, grace_period):
+        if not self.aborted:
+            self.aborted = True
+            self._kill_call = terminate_process_group(
+                reactor, self.transport, grace_period
+            )
+
+    def outReceived(self, data):
+        self._write(data)
+
+    def errReceived(self, data):
+        self._stderr.append(data)
+
+    def processEnded(self, reason):
+        process_group_ended(self._kill_call)
+        self.ended.callback(("".join(self._stderr), reason.value.exitCode))
+
+
+class _BufferSink(object):
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(data)
+
+    def reset(self):
+        del self._chunks[:]
+
+    def getvalue(self):
+        return b"".join(self._chunks)
+
+
+# The number of seconds a request may take before its process is killed.
+# ``FetchDocumentsById`` gets the ``FetchDocumentById`` timeout per document.
+DEFAULT_TIMEOUTS = {
+    "GetDocumentTypes": 300,
+    "ListDocuments": 300,
+    "FetchDocumentById": 600,
+}
+
+
 class VBMSClient(object):
     def __init__(self, reactor, connect_vbms_path, bundle_path, endpoint_url,
-                 keyfile, samlfile, key, keypass, ca_cert, client_cert):
+                 keyfile, samlfile, key, keypass, ca_cert, client_cert,
+                 worker_pool=None, limiter=None, retry_policy=None,
+                 circuit_breaker=None, timeouts=None, kill_grace_period=10):
         self._reactor = reactor
 
         self._connect_vbms_path = connect_vbms_path
@@ -32,8 +276,26 @@ class VBMSClient(object):
         self._keypass = keypass
         self._ca_cert = ca_cert
         self._client_cert = client_cert
+        self._worker_pool = worker_pool
 
-        self._connect_vbms_semaphore = DeferredSemaphore(tokens=8)
+        if limiter is None:
+            limiter = FixedLimiter(tokens=8)
+        self._connect_vbms_semaphore = limiter
+        self._retry_policy = retry_policy
+        self._circuit_breaker = circuit_breaker
+        self._timeouts = dict(DEFAULT_TIMEOUTS, **(timeouts or {}))
+        self._kill_grace_period = kill_grace_period
+        self.timeout_counts = {}
+        self._single_flight = SingleFlight()
+        # For each sink being streamed into, a function which kills the
+        # process (or worker) writing to it.
+        self._streams = {}
+        self._aborted = weakref.WeakSet()
+
+        self._script_dir = tempfile.mkdtemp(prefix="connect_vbms-")
+        self._scripts = {
+            request: self._write_script(request) for request in _REQUESTS
+        }
 
     def _path_to_ruby(self, path):
         if path is None:
@@ -41,7 +303,114 @@ class VBMSClient(object):
         else:
             return repr(path)
 
-    def _execute_connect_vbms(self, logger, request, formatter, args):
+    def stop(self):
+        shutil.rmtree(self._script_dir, ignore_errors=True)
+        if self._worker_pool is not None:
+            return self._worker_pool.stop()
+
+    def abort(self, sinks):
+        """
+        Aborts the fetches streaming into any of ``sinks``: the processes (or
+        resident workers) fetching them are killed, and the fetches fail with
+        ``VBMSAbortedError`` rather than being retried.
+        """
+        for sink in sinks:
+            self._aborted.add(sink)
+            kill = self._streams.get(sink)
+            if kill is not None:
+                kill()
+
+    def _check_aborted(self, sinks):
+        if any(sink in self._aborted for sink in sinks):
+            raise VBMSAbortedError()
+
+    def _track_streams(self, sinks, kill):
+        for sink in sinks:
+            self._streams[sink] = kill
+
+    def _start_streams(self, sinks, kill):
+        # A fetch may have been aborted while it waited for a worker.
+        self._check_aborted(sinks)
+        self._track_streams(sinks, kill)
+
+    def _untrack_streams(self, sinks):
+        for sink in sinks:
+            self._streams.pop(sink, None)
+
+    def _guard(self, run, size=1):
+        """
+        Runs ``run`` behind the circuit breaker and the concurrency limiter.
+        ``size`` is the number of documents ``run`` fetches.
+        """
+        if self._circuit_breaker is not None:
+            return self._circuit_breaker.call(
+                self._connect_vbms_semaphore.run_batch, size, run
+            )
+        return self._connect_vbms_semaphore.run_batch(size, run)
+
+    def _retry(self, logger, retry_budget, attempt, before_retry=None):
+        if self._retry_policy is None:
+            return attempt()
+        return self._retry_policy.run(
+            logger, retry_budget, attempt, before_retry
+        )
+
+    def _execute_connect_vbms(self, logger, request, args, retry_budget=None):
+        """
+        Runs ``request``, returning its output. Concurrent calls with the same
+        request and arguments share a single ``connect_vbms`` call (with the
+        first caller's retry budget).
+        """
+        logger = logger.bind(process=request)
+        key = (request, tuple(args))
+        if key in self._single_flight:
+            logger.bind(
+                coalesced=self._single_flight.coalesced + 1,
+            ).emit("vbms.coalesced")
+        if self._worker_pool is not None:
+            run = functools.partial(
+                self._execute_in_worker, logger, request, args
+            )
+        else:
+            run = functools.partial(
+                self._execute_in_process, logger, request, args
+            )
+        return self._single_flight.run(
+            key,
+            self._retry,
+            logger,
+            retry_budget,
+            lambda: self._guard(run),
+        )
+
+    @inlineCallbacks
+    def _execute_in_worker(self, logger, request, args):
+        chunks = []
+        yield self._run_in_worker(logger, request, args, chunks.append)
+        returnValue(b"".join(chunks))
+
+    @inlineCallbacks
+    def _run_in_worker(self, logger, request, args, write, sinks=()):
+        self._check_aborted(sinks)
+        timeout = self._timeouts.get(request)
+        timer = logger.time("process.worker_request")
+        try:
+            yield self._worker_pool.execute(
+                logger,
+                request,
+                args,
+                write,
+                timeout,
+                functools.partial(self._start_streams, sinks),
+            )
+        except VBMSTimeoutError:
+            self._record_timeout(logger, request, timeout)
+            raise
+        finally:
+            self._untrack_streams(sinks)
+            timer.stop()
+
+    def _write_script(self, request):
         ruby_code = """#!/usr/bin/env ruby
 
 $LOAD_PATH << '{connect_vbms_path}/src/'
@@ -60,10 +429,7 @@ client = VBMS::Client.new(
     {ca_cert},
     {client_cert},
 )
-request = {request}
-result = client.send(request)
-STDOUT.write({formatter})
-STDOUT.flush()
+{request}
         """.format(
             connect_vbms_path=self._connect_vbms_path,
             endpoint_url=self._endpoint_url,
@@ -74,64 +440,233 @@ STDOUT.flush()
             ca_cert=self._path_to_ruby(self._ca_cert),
             client_cert=self._path_to_ruby(self._client_cert),
 
-            request=request,
-            formatter=formatter,
+            request=_REQUESTS[request].strip(),
         ).strip()
-        with tempfile.NamedTemporaryFile(suffix=".rb", delete=False) as f:
+        path = os.path.join(self._script_dir, "{}.rb".format(request))
+        # The script contains credentials, so only we may read it.
+        fd = os.open(
+            path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, stat.S_IRWXU
+        )
+        with os.fdopen(fd, "w") as f:
             f.write(ruby_code)
+        return path
+
+    def _process_args(self, script, args):
+        return [
+            '-lc',
+            '{} exec {} {}'.format(
+                self._bundle_path,
+                script,
+                " ".join(map(pipes.quote, args))
+            )
+        ]
+
+    @inlineCallbacks
+    def _execute_in_process(self, logger, request, args):
+        chunks = []
+        try:
+            yield self._stream_in_process(logger, request, args, chunks.append)
+        except VBMSError as e:
+            e.stdout = b"".join(chunks)
+            raise
+        returnValue(b"".join(chunks))
+
+    def _record_timeout(self, logger, request, timeout):
+        self.timeout_counts[request] = self.timeout_counts.get(request, 0) + 1
+        logger.bind(
+            timeout=timeout,
+            timeouts=self.timeout_counts[request],
+        ).emit("process.timeout")
+
+    def _stream_connect_vbms(self, logger, request, args, sink):
+        logger = logger.bind(process=request)
+        if self._worker_pool is not None:
+            run = functools.partial(
+                self._run_in_worker, logger, request, args, sink.write,
+                sinks=[sink],
+            )
+        else:
+            run = functools.partial(
+                self._stream_in_process, logger, request, args, sink.write,
+                sinks=[sink],
+            )
+        return self._guard(run)
+
+    @inlineCallbacks
+    def _stream_in_process(self, logger, request, args, write, timeout=None,
+                           sinks=()):
+        self._check_aborted(sinks)
+        if timeout is None:
+            timeout = self._timeouts.get(request)
+        script = self._scripts[request]
 
-        st = os.stat(f.name)
-        os.chmod(f.name, st.st_mode | stat.S_IEXEC)
-
-        @inlineCallbacks
-        def run():
-            timer = logger.time("process.spawn")
-            try:
-                stdout, stderr, exit_code = yield getProcessOutputAndValue(
-                    '/bin/bash', [
-                        '-lc',
-                        '{} exec {} {}'.format(
-                            self._bundle_path,
-                            f.name,
-                            " ".join(map(pipes.quote, args))
-                        )
-                    ],
-                    env=os.environ,
-                    path=self._connect_vbms_path,
-                    reactor=self._reactor
+        protocol = _StreamingProcessProtocol(write)
+        timeout_call = None
+        timer = logger.time("process.spawn")
+        try:
+            self._reactor.spawnProcess(
+                protocol,
+                NEW_PROCESS_GROUP[0],
+                NEW_PROCESS_GROUP + (
+                    ['/bin/bash'] + self._process_args(script, args)
+                ),
+                env=os.environ,
+                path=self._connect_vbms_path,
+            )
+            if timeout is not None:
+                timeout_call = self._reactor.callLater(
+                    timeout,
+                    protocol.terminate,
+                    self._reactor,
+                    self._kill_grace_period,
                 )
-            finally:
-                timer.stop()
-            if exit_code != 0:
-                raise VBMSError(stdout, stderr, exit_code)
-            returnValue(stdout)
+            self._track_streams(sinks, functools.partial(
+                protocol.abort, self._reactor, self._kill_grace_period
+            ))
+            stderr, exit_code = yield protocol.ended
+        finally:
+            self._untrack_streams(sinks)
+            timer.stop()
+            if timeout_call is not None and timeout_call.active():
+                timeout_call.cancel()
+        if protocol.aborted:
+            raise VBMSAbortedError("", stderr, exit_code)
+        if protocol.timed_out:
+            self._record_timeout(logger, request, timeout)
+            raise VBMSTimeoutError("", stderr, exit_code, timeout)
+        if exit_code != 0:
+            raise VBMSError("", stderr, exit_code)
 
-        return self._connect_vbms_semaphore.run(run)
+    @inlineCallbacks
+    def _stream_batch_in_process(self, logger, reader, document_ids, sinks):
+        try:
+            timeout = self._timeouts.get("FetchDocumentById")
+            yield self._stream_in_process(
+                logger,
+                "FetchDocumentsById",
+                document_ids,
+                reader.data_received,
+                timeout * len(document_ids) if timeout is not None else None,
+                sinks,
+            )
+        except VBMSError as e:
+            reader.fail_all(e)
+            # Re-raised so that the limiter sees the failure; every document
+            # has already been failed with it.
+            raise
+        except EnvironmentError as e:
+            # The process couldn't be started.
+            reader.fail_all(VBMSError("", str(e), None))
+        except Exception as e:
+            # A bug rather than a VBMS failure, so it's passed on as it is.
+            reader.fail_all(e)
+            raise
+        else:
+            reader.fail_all(VBMSError("", "Missing response", 0))
 
     @inlineCallbacks
     def get_document_types(self, logger):
         response = yield self._execute_connect_vbms(
-            logger.bind(process="GetDocumentTypes"),
-            "VBMS::Requests::GetDocumentTypes.new()",
-            "result.map(&:to_h).to_json",
-            [],
+            logger, "GetDocumentTypes", []
         )
         returnValue(json.loads(response))
 
     @inlineCallbacks
-    def list_documents(self, logger, file_number):
+    def list_documents(self, logger, file_number, retry_budget=None):
         response = yield self._execute_connect_vbms(
-            logger.bind(process="ListDocuments"),
-            "VBMS::Requests::ListDocuments.new(ARGV[0])",
-            'result.map(&:to_h).to_json',
-            [file_number],
+            logger, "ListDocuments", [file_number], retry_budget
         )
         returnValue(json.loads(response))
 
-    def fetch_document_contents(self, logger, document_id):
+    def fetch_document_contents(self, logger, document_id, retry_budget=None):
         return self._execute_connect_vbms(
-            logger.bind(process="FetchDocumentById"),
-            "VBMS::Requests::FetchDocumentById.new(ARGV[0])",
-            "result.content",
-            [document_id],
+            logger, "FetchDocumentById", [document_id], retry_budget
+        )
+
+    def stream_document_contents(self, logger, document_id, sink,
+                                 retry_budget=None):
+        """
+        Like ``fetch_document_contents``, but passes the document's contents
+        to ``sink.write`` in chunks as they arrive, instead of buffering them.
+        ``sink.reset`` is called before the document is fetched again after
+        a failure.
+        """
+        return self._retry(
+            logger,
+            retry_budget,
+            lambda: self._stream_connect_vbms(
+                logger, "FetchDocumentById", [document_id], sink
+            ),
+            sink.reset,
+        )
+
+    def stream_documents_batch(self, logger, document_ids, sinks,
+                               retry_budget=None):
+        """
+        Fetches several documents with a single ``connect_vbms`` process,
+        passing the contents of each document to the corresponding sink in
+        ``sinks`` (see ``stream_document_contents``). Returns a list of
+        ``Deferred``s, one per document id, each of which fires or fails with
+        a ``VBMSError`` as soon as that document has been fetched. Documents
+        whose fetch fails are retried one by one.
+
+        With resident workers there is no per-process overhead to save, so
+        each document is fetched with its own worker request.
+        """
+        if self._worker_pool is not None or len(document_ids) == 1:
+            return [
+                self.stream_document_contents(
+                    logger, document_id, sink, retry_budget
+                )
+                for document_id, sink in zip(document_ids, sinks)
+            ]
+
+        reader = ResponseReader()
+        batch_results = [reader.expect(sink.write) for sink in sinks]
+
+        def batch_failed(failure):
+            failure.trap(VBMSError)
+            # If the batch ran, every document has already failed, but if
+            # the circuit breaker rejected it none of them have.
+            reader.fail_all(failure.value)
+        self._guard(
+            functools.partial(
+                self._stream_batch_in_process,
+                logger.bind(process="FetchDocumentsById"),
+                reader,
+                document_ids,
+                sinks,
+            ),
+            size=len(document_ids),
+        ).addErrback(batch_failed)
+
+        def retry_single(batch_result, document_id, sink):
+            attempts = [batch_result]
+
+            def attempt():
+                if attempts:
+                    return attempts.pop()
+                return self._stream_connect_vbms(
+                    logger, "FetchDocumentById", [document_id], sink
+                )
+            return self._retry(logger, retry_budget, attempt, sink.reset)
+
+        return [
+            retry_single(batch_result, document_id, sink)
+            for batch_result, document_id, sink in zip(
+                batch_results, document_ids, sinks
+            )
+        ]
+
+    def fetch_documents_batch(self, logger, document_ids, retry_budget=None):
+        """
+        Like ``stream_documents_batch``, but each ``Deferred`` fires with the
+        document's contents.
+        """
+        sinks = [_BufferSink() for _ in document_ids]
+        results = self.stream_documents_batch(
+            logger, document_ids, sinks, retry_budget
         )
+        for d, sink in zip(results, sinks):
+            d.addCallback(lambda _, sink=sink: sink.getvalue())
+        return results
@@ -0,0 +1,231 @@
+import functools
+import json
+import os
+import pipes
+
+from twisted.internet.defer import (
+    Deferred, DeferredList, inlineCallbacks, succeed
+)
+from twisted.internet.protocol import ProcessProtocol
+from twisted.python.filepath import FilePath
+
+from efolder_express.utils import encode_frame
+from efolder_express.vbms import (
+    NEW_PROCESS_GROUP, ResponseReader, VBMSAbortedError, VBMSError,
+    VBMSTimeoutError, process_group_ended, terminate_process_group
+)
+
+
+WORKER_SCRIPT = FilePath(__file__).sibling("connect_vbms_worker.rb").path
+
+
+def connect_vbms_worker_command(bundle_path):
+    return [
+        "/bin/bash",
+        "-lc",
+        "{} exec ruby {}".format(bundle_path, pipes.quote(WORKER_SCRIPT)),
+    ]
+
+
+class _ConnectVBMSWorkerProtocol(ProcessProtocol):
+    def __init__(self, pool, config):
+        self._pool = pool
+        self._config = config
+        self._reader = ResponseReader()
+
+        self.requests = 0
+        self.retired = False
+        self.exited = False
+        self.timeout = None
+        self.aborted = False
+        self.ended = Deferred()
+        self._kill_call = None
+
+        self._logger = None
+        self._stderr = []
+
+    def connectionMade(self):
+        self.transport.write(encode_frame(json.dumps(self._config)))
+
+    def send_request(self, logger, request, args, write):
+        assert not self._reader.pending
+        self._logger = logger
+        del self._stderr[:]
+        d = self._reader.expect(write)
+        self.transport.write(encode_frame(json.dumps({
+            "request": request,
+            "args": args,
+        })))
+        return d
+
+    def terminate(self, reactor, timeout, grace_period):
+        self.timeout = timeout
+        self._kill_call = terminate_process_group(
+            reactor, self.transport, grace_period
+        )
+
+    def abort(self, reactor, grace_period):
+        if not self.aborted:
+            self.aborted = True
+            self._kill_call = terminate_process_group(
+                reactor, self.transport, grace_period
+            )
+
+    def retire(self):
+        self.retired = True
+        self.transport.closeStdin()
+
+    def outReceived(self, data):
+        self._reader.data_received(data)
+
+    def errReceived(self, data):
+        self._stderr.append(data)
+
+    def processEnded(self, reason):
+        self.exited = True
+        process_group_ended(self._kill_call)
+        self._pool._worker_ended(self)
+        if self._reader.pending and self.aborted:
+            self._reader.fail_all(VBMSAbortedError(
+                "", "".join(self._stderr), reason.value.exitCode
+            ))
+        elif self._reader.pending and self.timeout is not None:
+            self._reader.fail_all(VBMSTimeoutError(
+                "", "".join(self._stderr), reason.value.exitCode, self.timeout
+            ))
+        elif self._reader.pending:
+            self._logger.bind(
+                exit_code=reason.value.exitCode,
+            ).emit("connect_vbms_worker.crashed")
+            self._reader.fail_all(VBMSError(
+                "", "".join(self._stderr), reason.value.exitCode
+            ))
+        self.ended.callback(None)
+
+
+class ConnectVBMSWorkerPool(object):
+    """
+    A pool of resident ``connect_vbms`` worker processes (see
+    ``connect_vbms_worker.rb``), which keep a ``VBMS::Client`` loaded between
+    requests instead of booting Ruby for every call.
+
+    Workers are spawned on demand, up to ``size`` of them. A worker which
+    crashes is replaced the next time one is needed, and a worker is recycled
+    after it has served ``max_requests`` requests. A worker whose request
+    takes longer than its timeout is killed, along with its process group.
+    """
+
+    def __init__(self, reactor, command, path, config, size, max_requests,
+                 kill_grace_period=10):
+        self._reactor = reactor
+        self._command = command
+        self._path = path
+        self._config = config
+        self._size = size
+        self._max_requests = max_requests
+        self._kill_grace_period = kill_grace_period
+
+        self._workers = set()
+        self._idle = []
+        self._waiters = []
+        self._stopped = False
+
+    @inlineCallbacks
+    def execute(self, logger, request, args, write, timeout=None,
+                started=None):
+        """
+        Runs ``request`` on an idle worker, passing each chunk of the response
+        body to ``write``. Returns a ``Deferred`` which fires once the whole
+        body has been written, or fails with a ``VBMSError`` (a
+        ``VBMSTimeoutError`` if it took more than ``timeout`` seconds).
+
+        Once a worker has been found, ``started`` is called with a function
+        which aborts the request by killing the worker. If ``started`` raises
+        (because the request was aborted while it waited for a worker), the
+        request isn't sent.
+        """
+        worker = yield self._acquire()
+        if started is not None:
+            try:
+                started(functools.partial(
+                    worker.abort, self._reactor, self._kill_grace_period
+                ))
+            except Exception:
+                self._release(logger, worker)
+                raise
+        timeout_call = None
+        if timeout is not None:
+            timeout_call = self._reactor.callLater(
+                timeout,
+                worker.terminate,
+                self._reactor,
+                timeout,
+                self._kill_grace_period,
+            )
+        try:
+            yield worker.send_request(logger, request, args, write)
+        finally:
+            if timeout_call is not None and timeout_call.active():
+                timeout_call.cancel()
+            self._release(logger, worker)
+
+    def stop(self):
+        self._stopped = True
+        for d in self._waiters:
+            d.errback(VBMSError("", "Worker pool stopped", None))
+        del self._waiters[:]
+        ended = []
+        for worker in list(self._workers):
+            ended.append(worker.ended)
+            worker.retire()
+        return DeferredList(ended)
+
+    def _spawn(self):
+        worker = _ConnectVBMSWorkerProtocol(self, self._config)
+        self._reactor.spawnProcess(
+            worker,
+            NEW_PROCESS_GROUP[0],
+            NEW_PROCESS_GROUP + self._command,
+            env=os.environ,
+            path=self._path,
+        )
+        self._workers.add(worker)
+        return worker
+
+    def _acquire(self):
+        if self._stopped:
+            raise VBMSError("", "Worker pool stopped", None)
+        if self._idle:
+            return succeed(self._idle.pop())
+        if len(self._workers) < self._size:
+            return succeed(self._spawn())
+        d = Deferred()
+        self._waiters.append(d)
+        return d
+
+    def _release(self, logger, worker):
+        worker.requests += 1
+        if not worker.exited:
+            if worker.requests >= self._max_requests:
+                logger.bind(
+                    requests=worker.requests
+                ).emit("connect_vbms_worker.recycled")
+                self._workers.discard(worker)
+                worker.retire()
+            elif self._waiters:
+                self._waiters.pop(0).callback(worker)
+                return
+            else:
+                self._idle.append(worker)
+                return
+        self._service_waiters()
+
+    def _worker_ended(self, worker):
+        self._workers.discard(worker)
+        if worker in self._idle:
+            self._idle.remove(worker)
+        self._service_waiters()
+
+    def _service_waiters(self):
+        while self._waiters and len(self._workers) < self._size:
+            self._waiters.pop(0).callback(self._spawn())
@@ -0,0 +1,148 @@
+from twisted.internet.defer import (
+    CancelledError, inlineCallbacks, maybeDeferred
+)
+from twisted.internet.task import LoopingCall
+
+
+class WorkerPool(object):
+    """
+    Runs the items (callables) taken from ``queue`` with ``size`` supervised
+    workers.
+
+    A failing item is logged as ``worker_pool.task_error`` and the worker goes
+    on to the next one. An item which takes longer than ``task_deadline``
+    seconds is cancelled. A worker which dies anyway is logged and replaced.
+
+    Every ``gauge_interval`` seconds the number of live and busy workers, and
+    the number of items which completed and failed (and the failure rate)
+    since the last report, are emitted as a ``worker_pool.gauges`` event.
+
+    See ``autoscale`` for varying the number of workers with the load.
+    """
+
+    def __init__(self, clock, logger, queue, size, task_deadline=None,
+                 gauge_interval=60):
+        self._clock = clock
+        self._logger = logger
+        self._queue = queue
+        self._size = size
+        self._task_deadline = task_deadline
+        self._gauge_interval = gauge_interval
+
+        self.live = 0
+        self.busy = 0
+        self.completed = 0
+        self.failed = 0
+        self._stopped = False
+        # The ``queue.get()`` of each idle worker.
+        self._idle = []
+        self._autoscale = None
+        self._gauge_call = None
+        self._autoscale_call = None
+
+    def autoscale(self, minimum, maximum, wait_target, interval):
+        """
+        Every ``interval`` seconds, adds a worker if the oldest item in the
+        queue has been waiting for longer than ``wait_target`` seconds, or
+        removes an idle worker if nothing is waiting, keeping between
+        ``minimum`` and ``maximum`` workers. Changes are emitted as
+        ``worker_pool.scaled`` events.
+        """
+        assert minimum <= self._size <= maximum
+        self._autoscale = (minimum, maximum, wait_target, interval)
+
+    def start(self):
+        for _ in xrange(self._size):
+            self._start_worker()
+        self._gauge_call = LoopingCall(self.emit_gauges)
+        self._gauge_call.clock = self._clock
+        self._gauge_call.start(self._gauge_interval, now=False)
+        if self._autoscale is not None:
+            self._autoscale_call = LoopingCall(self.scale)
+            self._autoscale_call.clock = self._clock
+            self._autoscale_call.start(self._autoscale[3], now=False)
+
+    def stop(self):
+        self._stopped = True
+        for call in [self._gauge_call, self._autoscale_call]:
+            if call is not None and call.running:
+                call.stop()
+
+    def scale(self):
+        minimum, maximum, wait_target, _ = self._autoscale
+        wait = self._queue.oldest_wait()
+        if wait > wait_target and self.live < maximum:
+            self._start_worker()
+        elif not wait and self._idle and self.live > minimum:
+            # The worker exits once its ``get`` is cancelled.
+            self._idle[0].cancel()
+        else:
+            return
+        self._logger.bind(live=self.live, wait=wait).emit("worker_pool.scaled")
+
+    def emit_gauges(self):
+        total = self.completed + self.failed
+        self._logger.bind(
+            live=self.live,
+            busy=self.busy,
+            completed=self.completed,
+            failed=self.failed,
+            failure_rate=float(self.failed) / total if total else 0.0,
+        ).emit("worker_pool.gauges")
+        self.completed = 0
+        self.failed = 0
+
+    def _start_worker(self):
+        self.live += 1
+        self._work().addErrback(self._worker_died)
+
+    @inlineCallbacks
+    def _work(self):
+        while not self._stopped:
+            d = self._queue.get()
+            self._idle.append(d)
+            try:
+                item = yield d
+            except CancelledError:
+                break
+            finally:
+                self._idle.remove(d)
+            yield self._run(item)
+        self.live -= 1
+
+    def _worker_died(self, failure):
+        self.live -= 1
+        self._logger.bind(
+            error=failure.getErrorMessage(),
+        ).emit("worker_pool.worker_died")
+        if not self._stopped:
+            self._start_worker()
+
+    @inlineCallbacks
+    def _run(self, item):
+        self.busy += 1
+        d = maybeDeferred(item)
+        deadline_call = None
+        if self._task_deadline is not None:
+            # The worker moves on once the deadline passes, but the task only
+            # stops if its Deferred has a canceller which stops it (see
+            # ``JobQueue._run``).
+            deadline_call = self._clock.callLater(
+                self._task_deadline, d.cancel
+            )
+        try:
+            yield d
+        except CancelledError:
+            self.failed += 1
+            self._logger.bind(
+                task_deadline=self._task_deadline,
+            ).emit("worker_pool.deadline_exceeded")
+        except Exception as e:
+            self.failed += 1
+            self._logger.bind(error=repr(e)).emit("worker_pool.task_error")
+        else:
+            self.completed += 1
+        finally:
+            self.busy -= 1
+            if deadline_call is not None and deadline_call.active():
+                deadline_call.cancel()
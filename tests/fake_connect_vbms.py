@@ -0,0 +1,41 @@
+"""
+A stand-in for ``bundle``, run as ``bundle exec <script> <args>``, which
+answers the ``FetchDocumentById.rb`` and ``FetchDocumentsById.rb`` scripts
+from canned data instead of running them. The document id ``error`` fails.
+"""
+
+import json
+import os
+import sys
+
+from fake_connect_vbms_worker import respond, write_frame
+
+
+def main():
+    stdout = getattr(sys.stdout, "buffer", sys.stdout)
+    script, args = sys.argv[2], sys.argv[3:]
+    request = os.path.splitext(os.path.basename(script))[0]
+
+    if request == "FetchDocumentsById":
+        for document_id in args:
+            if document_id == "error":
+                write_frame(stdout, json.dumps({
+                    "status": "error", "error": "Document not found",
+                }).encode())
+            else:
+                respond(
+                    stdout, "contents of {}".format(document_id).encode()
+                )
+            stdout.flush()
+    elif request == "FetchDocumentById":
+        if args[0] == "error":
+            sys.stderr.write("Document not found\n")
+            sys.exit(1)
+        stdout.write("contents of {}".format(args[0]).encode())
+    else:
+        sys.stderr.write("Unknown script: {}\n".format(script))
+        sys.exit(2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+A stand-in for ``efolder_express/connect_vbms_worker.rb`` which speaks the
+same protocol, but answers from canned data instead of talking to VBMS.
+
+``FetchDocumentById`` understands a few special document ids:
+
+* ``error``: responds with an error.
+* ``crash``: exits with status 3 without responding.
+* ``pid``: responds with the worker's process id.
+* ``hang``: never responds.
+"""
+
+import json
+import os
+import struct
+import sys
+import time
+
+
+CHUNK_SIZE = 4
+
+
+def read_frame(f):
+    header = f.read(4)
+    if len(header) < 4:
+        return None
+    [length] = struct.unpack(">I", header)
+    return f.read(length)
+
+
+def write_frame(f, data):
+    f.write(struct.pack(">I", len(data)) + data)
+
+
+def respond(f, body):
+    write_frame(f, json.dumps({"status": "ok"}).encode())
+    for i in range(0, len(body), CHUNK_SIZE):
+        write_frame(f, body[i:i + CHUNK_SIZE])
+    write_frame(f, b"")
+
+
+def main():
+    stdin = getattr(sys.stdin, "buffer", sys.stdin)
+    stdout = getattr(sys.stdout, "buffer", sys.stdout)
+
+    json.loads(read_frame(stdin).decode())
+
+    while True:
+        frame = read_frame(stdin)
+        if frame is None:
+            break
+        message = json.loads(frame.decode())
+        request = message["request"]
+        args = message["args"]
+
+        if request == "GetDocumentTypes":
+            respond(stdout, json.dumps([
+                {"type_id": "1", "description": "Test!"},
+            ]).encode())
+        elif request == "ListDocuments":
+            respond(stdout, json.dumps([{
+                "document_id": "{}-1".format(args[0]),
+                "doc_type": "1",
+                "filename": "file.pdf",
+                "received_at": "2015-01-01",
+                "source": "CUI",
+            }]).encode())
+        elif args[0] == "error":
+            write_frame(stdout, json.dumps({
+                "status": "error", "error": "Document not found",
+            }).encode())
+        elif args[0] == "crash":
+            sys.stderr.write("Crashing!\n")
+            sys.exit(3)
+        elif args[0] == "hang":
+            time.sleep(60)
+        elif args[0] == "pid":
+            respond(stdout, str(os.getpid()).encode())
+        else:
+            respond(stdout, "contents of {}".format(args[0]).encode())
+        stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
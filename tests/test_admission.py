@@ -0,0 +1,66 @@
+from twisted.internet.defer import succeed
+from twisted.internet.task import Clock
+
+from efolder_express.admission import AdmissionControl, REJECT, START, WAIT
+from efolder_express.log import Logger
+
+from .utils import FakeMemoryLog, success_result_of
+
+
+class FakeAdmissionDatabase(object):
+    def __init__(self, active=0, queued=0, waiting=0):
+        self.counts = (active, queued, waiting)
+
+    def get_admission_counts(self, logger):
+        return succeed(self.counts)
+
+
+def make_admission(clock, db):
+    return AdmissionControl(
+        clock,
+        db,
+        max_active_downloads=2,
+        max_queued_documents=100,
+        max_waiting=3,
+    )
+
+
+class TestAdmissionControl(object):
+    def test_check(self):
+        db = FakeAdmissionDatabase()
+        admission = make_admission(Clock(), db)
+        logger = Logger(FakeMemoryLog())
+
+        assert success_result_of(admission.check(logger)) == START
+
+        db.counts = (2, 10, 0)
+        assert success_result_of(admission.check(logger)) == WAIT
+        db.counts = (1, 100, 0)
+        assert success_result_of(admission.check(logger)) == WAIT
+        # There's room, but others are already waiting.
+        db.counts = (0, 0, 2)
+        assert success_result_of(admission.check(logger)) == WAIT
+
+        db.counts = (2, 10, 3)
+        assert success_result_of(admission.check(logger)) == REJECT
+
+    def test_capacity(self):
+        admission = make_admission(Clock(), FakeAdmissionDatabase())
+        assert admission.capacity(0, 0) == 2
+        assert admission.capacity(1, 99) == 1
+        assert admission.capacity(3, 0) == 0
+        assert admission.capacity(0, 100) == 0
+
+    def test_estimated_wait(self):
+        clock = Clock()
+        admission = make_admission(clock, FakeAdmissionDatabase())
+        assert admission.estimated_wait(1) is None
+
+        admission.record_start()
+        clock.advance(30)
+        admission.record_start()
+        clock.advance(60)
+        admission.record_start()
+
+        assert admission.estimated_wait(1) == 45
+        assert admission.estimated_wait(4) == 180
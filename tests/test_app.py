@@ -1,8 +1,36 @@
+import datetime
+
+from cryptography.fernet import Fernet
+
 import pytest
 
+import sqlalchemy
+
+from twisted.internet.defer import Deferred, FirstError, fail
+from twisted.internet.task import Clock, LoopingCall
+from twisted.python.filepath import FilePath
+from twisted.web.test.requesthelper import DummyRequest
+
+from efolder_express.admission import AdmissionControl
 from efolder_express.app import DownloadEFolder
+from efolder_express.blob_store import FilesystemBlobStore
+from efolder_express.db import Document, DownloadDatabase, Job
+from efolder_express.jobs import FETCH_DOCUMENTS, LIST_DOCUMENTS
+from efolder_express.log import Logger
+from efolder_express.retry import (
+    CircuitBreaker, CircuitOpenError, RetryPolicy
+)
+from efolder_express.scheduler import DOCUMENTS, Scheduler
+from efolder_express.storage import decrypt_file
+from efolder_express.vbms import (
+    VBMSAbortedError, VBMSClient, VBMSError, VBMSTimeoutError
+)
+from efolder_express.workers import WorkerPool
 
-from .utils import FakeVBMSClient, no_result, success_result_of
+from .utils import (
+    FakeJobQueue, FakeMemoryLog, FakeReactor, FakeThreadPool, FakeVBMSClient,
+    success_result_of
+)
 
 
 @pytest.fixture
@@ -13,19 +41,593 @@ def app():
         None,
         None,
         vbms_client=FakeVBMSClient(),
-        queue=None,
+        jobs=None,
+        env_name=None,
+    )
+
+
+@pytest.fixture
+def db():
+    db = DownloadDatabase(FakeReactor(), FakeThreadPool(), "sqlite://")
+    success_result_of(db.create_database(Logger(FakeMemoryLog())))
+    return db
+
+
+def make_document(download_id, document_id):
+    return Document(
+        id="id-{}".format(document_id),
+        download_id=download_id,
+        document_id=document_id,
+        doc_type="00356",
+        filename="{}.pdf".format(document_id),
+        received_at=datetime.datetime.utcnow(),
+        source="CUI",
+        content_location=None,
+        errored=False,
+    )
+
+
+def job_document_ids(db, job):
+    return sorted(
+        doc.document_id for doc in success_result_of(db.get_documents(
+            Logger(FakeMemoryLog()), job.payload["document_ids"]
+        ))
+    )
+
+
+def manifest_entry(document_id):
+    return {
+        "document_id": document_id,
+        "doc_type": "00356",
+        "filename": "{}.pdf".format(document_id),
+        "received_at": "2015-03-04",
+        "source": "CUI",
+    }
+
+
+class PendingVBMSClient(object):
+    def __init__(self):
+        self.pending = []
+
+    def stream_documents_batch(self, logger, document_ids, sinks,
+                               retry_budget=None):
+        results = []
+        for sink in sinks:
+            d = Deferred()
+            self.pending.append((sink, d))
+            results.append(d)
+        return results
+
+    def abort(self, sinks):
+        for sink, d in self.pending:
+            if sink in sinks and not d.called:
+                d.errback(VBMSAbortedError())
+
+
+class FakeRequest(DummyRequest):
+    def redirect(self, url):
+        self.setResponseCode(302)
+        self.setHeader("Location", url)
+
+
+def make_app(logger, db):
+    return DownloadEFolder(
+        logger,
+        db,
+        None,
+        None,
+        vbms_client=FakeVBMSClient(),
+        jobs=None,
         env_name=None,
     )
 
 
 class TestDownloadEFolder(object):
-    def test_start_fetch_document_types(self, app):
-        d = app.document_types.wait()
-        no_result(d)
+    def test_refresh_document_types(self, db):
+        logger = Logger(FakeMemoryLog())
+        app = make_app(logger, db)
+        assert app.document_types == {}
 
-        d1 = app.start_fetch_document_types()
-        success_result_of(d1)
+        success_result_of(app.refresh_document_types())
+        assert app.document_types == {1: "Test!"}
+        assert app.vbms_client.document_types_calls == 1
+
+        # Stored in the database, so another instance doesn't call VBMS.
+        app = make_app(logger, db)
+        success_result_of(app.refresh_document_types())
+        assert app.document_types == {1: "Test!"}
+        assert app.vbms_client.document_types_calls == 0
 
-        assert success_result_of(d) == {
+    def test_refresh_document_types_stale(self, db):
+        logger = Logger(FakeMemoryLog())
+        success_result_of(db.replace_document_types(
+            logger,
+            {1: "Old!", 2: "Removed"},
+            datetime.datetime.utcnow() - datetime.timedelta(days=2),
+        ))
+        app = make_app(logger, db)
+
+        success_result_of(app.refresh_document_types())
+        assert app.document_types == {1: "Test!"}
+        assert app.vbms_client.document_types_calls == 1
+        assert success_result_of(db.get_document_types(logger))[0] == {
             1: "Test!"
         }
+
+    def test_refresh_document_types_error(self, db):
+        log = FakeMemoryLog()
+        logger = Logger(log)
+        success_result_of(db.replace_document_types(
+            logger,
+            {1: "Old!"},
+            datetime.datetime.utcnow() - datetime.timedelta(days=2),
+        ))
+        app = make_app(logger, db)
+        app.vbms_client.document_types_error = VBMSError("", "Boom", 1)
+
+        success_result_of(app.refresh_document_types())
+        assert app.document_types == {1: "Old!"}
+        assert [
+            msg for msg in log.msgs
+            if msg["event"] == "get_document_types.error"
+        ]
+
+    @pytest.mark.parametrize(("method", "query", "event"), [
+        (
+            "refresh_document_types", "get_document_types",
+            "document_types.refresh_error",
+        ),
+        (
+            "admit_waiting_downloads", "get_waiting_downloads",
+            "admission.error",
+        ),
+        (
+            "check_abandoned_downloads", "get_abandoned_downloads",
+            "abandonment.error",
+        ),
+    ])
+    def test_periodic_survives_database_error(self, db, method, query,
+                                              event):
+        log = FakeMemoryLog()
+        app = make_app(Logger(log), db)
+        app.deprioritize_after = 60
+        setattr(db, query, lambda *args: fail(
+            sqlalchemy.exc.OperationalError("SELECT", {}, "locked")
+        ))
+        clock = Clock()
+        loop = LoopingCall(getattr(app, method))
+        loop.clock = clock
+
+        loop.start(10)
+        clock.advance(10)
+
+        assert loop.running
+        assert len([msg for msg in log.msgs if msg["event"] == event]) == 2
+        loop.stop()
+
+    def test_start_download_manifest_cache(self, tmpdir, db):
+        logger = Logger(FakeMemoryLog())
+        jobs = FakeJobQueue()
+        app = DownloadEFolder(
+            logger,
+            db,
+            FilesystemBlobStore(FilePath(str(tmpdir))),
+            Fernet(Fernet.generate_key()),
+            vbms_client=FakeVBMSClient(),
+            jobs=jobs,
+            env_name=None,
+            fetch_batch_size=10,
+        )
+        app.vbms_client.documents = [manifest_entry("1"), manifest_entry("2")]
+
+        success_result_of(db.create_download(logger, "request-1", "123"))
+        success_result_of(app.start_download("123", "request-1"))
+        assert app.vbms_client.list_documents_calls == 1
+        [job] = jobs.jobs
+        assert job.kind == FETCH_DOCUMENTS
+        assert job_document_ids(db, job) == ["1", "2"]
+        success_result_of(app.run_job(job))
+
+        # A fresh manifest is reused, along with the fetched documents.
+        del jobs.jobs[:]
+        success_result_of(db.create_download(logger, "request-2", "123"))
+        success_result_of(app.start_download("123", "request-2"))
+        assert app.vbms_client.list_documents_calls == 1
+        assert jobs.jobs == []
+        download = success_result_of(db.get_download(logger, "request-2"))
+        assert download.completed
+        assert download.state == "MANIFEST_DOWNLOADED"
+
+        # Once it's stale, only new documents are fetched.
+        app.manifest_cache_ttl = datetime.timedelta(0)
+        app.vbms_client.documents.append(manifest_entry("3"))
+        success_result_of(db.create_download(logger, "request-3", "123"))
+        success_result_of(app.start_download("123", "request-3"))
+        assert app.vbms_client.list_documents_calls == 2
+        [job] = jobs.jobs
+        assert job_document_ids(db, job) == ["3"]
+        download = success_result_of(db.get_download(logger, "request-3"))
+        assert len(download.documents) == 3
+
+    def test_start_download_cancelled_while_listing(self, db):
+        logger = Logger(FakeMemoryLog())
+        app = make_app(logger, db)
+        app.jobs = FakeJobQueue()
+        listing = Deferred()
+        app.vbms_client.list_documents = (
+            lambda logger, file_number, retry_budget=None: listing
+        )
+
+        success_result_of(db.create_download(logger, "request-1", "123"))
+        d = app.start_download("123", "request-1")
+        success_result_of(db.cancel_download(logger, "request-1"))
+        listing.callback([manifest_entry("1")])
+        success_result_of(d)
+
+        assert app.jobs.jobs == []
+        download = success_result_of(db.get_download(logger, "request-1"))
+        assert download.state == "CANCELLED"
+        assert download.documents == []
+
+    def test_run_job_list_documents_idempotent(self, db):
+        logger = Logger(FakeMemoryLog())
+        jobs = FakeJobQueue()
+        app = make_app(logger, db)
+        app.jobs = jobs
+        app.vbms_client.documents = [manifest_entry("1")]
+
+        success_result_of(db.create_download(logger, "request-1", "123"))
+        success_result_of(app.queue_download(logger, "123", "request-1"))
+        [job] = jobs.jobs
+        assert job.kind == LIST_DOCUMENTS
+        success_result_of(app.run_job(job))
+        # Running it again, after its lease expired, does nothing.
+        success_result_of(app.run_job(job))
+
+        assert app.vbms_client.list_documents_calls == 1
+        assert len(jobs.jobs) == 2
+        download = success_result_of(db.get_download(logger, "request-1"))
+        assert len(download.documents) == 1
+
+    def test_start_documents_download_reuses_blobs(self, tmpdir, db):
+        logger = Logger(FakeMemoryLog())
+        app = make_app(logger, db)
+        app.blob_store = FilesystemBlobStore(FilePath(str(tmpdir)))
+        app.fernet = Fernet(Fernet.generate_key())
+        documents = []
+        for request_id in ["request-1", "request-2"]:
+            success_result_of(db.create_download(logger, request_id, "123"))
+            doc = make_document(request_id, "1")
+            doc.id = "{}-1".format(request_id)
+            documents.append(doc)
+        success_result_of(db.create_documents(logger, documents))
+
+        success_result_of(app.start_documents_download(logger, documents[:1]))
+        app.vbms_client = None
+        success_result_of(app.start_documents_download(logger, documents[1:]))
+
+        [location] = {
+            success_result_of(
+                db.get_download(logger, request_id)
+            ).documents[0].content_location
+            for request_id in ["request-1", "request-2"]
+        }
+        assert success_result_of(
+            app.blob_store.list_keys(None, 10)
+        ) == [location]
+
+    def test_start_documents_download_coalesces(self, tmpdir, db):
+        logger = Logger(FakeMemoryLog())
+        app = make_app(logger, db)
+        app.blob_store = FilesystemBlobStore(FilePath(str(tmpdir)))
+        app.fernet = Fernet(Fernet.generate_key())
+        app.vbms_client = PendingVBMSClient()
+        documents = []
+        for request_id in ["request-1", "request-2"]:
+            success_result_of(db.create_download(logger, request_id, "123"))
+            doc = make_document(request_id, "1")
+            doc.id = "{}-1".format(request_id)
+            documents.append(doc)
+        success_result_of(db.create_documents(logger, documents))
+
+        d1 = app.start_documents_download(logger, documents[:1])
+        d2 = app.start_documents_download(logger, documents[1:])
+        [(sink, d)] = app.vbms_client.pending
+        sink.write("contents")
+        d.callback(None)
+        success_result_of(d1)
+        success_result_of(d2)
+
+        assert len(app.vbms_client.pending) == 1
+        assert documents[1].content_location == (
+            success_result_of(
+                db.get_download(logger, "request-1")
+            ).documents[0].content_location
+        )
+
+    def test_cancel_job_aborts_fetches(self, tmpdir, db):
+        logger = Logger(FakeMemoryLog())
+        app = make_app(logger, db)
+        app.blob_store = FilesystemBlobStore(FilePath(str(tmpdir)))
+        app.fernet = Fernet(Fernet.generate_key())
+        app.vbms_client = PendingVBMSClient()
+        success_result_of(db.create_download(logger, "request-1", "123"))
+        doc = make_document("request-1", "1")
+        success_result_of(db.create_documents(logger, [doc]))
+
+        d = app.run_job(Job.create(FETCH_DOCUMENTS, "request-1", DOCUMENTS, {
+            "file_number": "123",
+            "document_ids": [doc.id],
+            "document_count": 1,
+        }))
+        [(sink, _)] = app.vbms_client.pending
+        sink.write("partial contents")
+        d.cancel()
+
+        with pytest.raises(FirstError):
+            success_result_of(d)
+        # The document can still be fetched by a later download.
+        [doc] = success_result_of(
+            db.get_download(logger, "request-1")
+        ).documents
+        assert not doc.errored
+        assert doc.content_location is None
+        assert success_result_of(app.blob_store.list_keys(None, 10)) == []
+
+    def test_job_deadline_aborts_fetches(self, tmpdir, db):
+        logger = Logger(FakeMemoryLog())
+        app = make_app(logger, db)
+        app.blob_store = FilesystemBlobStore(FilePath(str(tmpdir)))
+        app.fernet = Fernet(Fernet.generate_key())
+        app.vbms_client = PendingVBMSClient()
+        success_result_of(db.create_download(logger, "request-1", "123"))
+        doc = make_document("request-1", "1")
+        success_result_of(db.create_documents(logger, [doc]))
+        clock = Clock()
+        queue = Scheduler(clock, logger)
+        pool = WorkerPool(clock, logger, queue, 1, task_deadline=5)
+        pool.start()
+
+        job = Job.create(FETCH_DOCUMENTS, "request-1", DOCUMENTS, {
+            "file_number": "123",
+            "document_ids": [doc.id],
+            "document_count": 1,
+        })
+        queue.put(lambda: app.run_job(job), DOCUMENTS, "request-1")
+        [(sink, fetch)] = app.vbms_client.pending
+        sink.write("partial contents")
+        clock.advance(5)
+
+        # The fetch is aborted, rather than left holding a VBMS slot.
+        assert fetch.called
+        assert pool.busy == 0
+        [doc] = success_result_of(
+            db.get_download(logger, "request-1")
+        ).documents
+        assert not doc.errored
+        assert success_result_of(app.blob_store.list_keys(None, 10)) == []
+        pool.stop()
+
+    def test_failed_fetch_discards_blob(self, tmpdir, db):
+        logger = Logger(FakeMemoryLog())
+        app = make_app(logger, db)
+        app.blob_store = FilesystemBlobStore(FilePath(str(tmpdir)))
+        app.fernet = Fernet(Fernet.generate_key())
+        app.vbms_client = PendingVBMSClient()
+        success_result_of(db.create_download(logger, "request-1", "123"))
+        doc = make_document("request-1", "1")
+        success_result_of(db.create_documents(logger, [doc]))
+
+        d = app.start_documents_download(logger, [doc])
+        [(sink, fetch)] = app.vbms_client.pending
+        sink.write("partial contents")
+        fetch.errback(IOError("Broken pipe"))
+
+        with pytest.raises(FirstError):
+            success_result_of(d)
+        assert success_result_of(app.blob_store.list_keys(None, 10)) == []
+        [doc] = success_result_of(
+            db.get_download(logger, "request-1")
+        ).documents
+        assert doc.content_location is None
+
+    def test_circuit_open_leaves_document_to_retry(self, tmpdir, db):
+        logger = Logger(FakeMemoryLog())
+        app = make_app(logger, db)
+        app.blob_store = FilesystemBlobStore(FilePath(str(tmpdir)))
+        app.fernet = Fernet(Fernet.generate_key())
+        clock = Clock()
+        breaker = CircuitBreaker(
+            clock, logger, failure_threshold=1, reset_timeout=60
+        )
+        breaker.call(
+            lambda: fail(VBMSTimeoutError("", "", None, 1))
+        ).addErrback(lambda _: None)
+        app.vbms_client = VBMSClient(
+            clock,
+            connect_vbms_path=str(tmpdir),
+            bundle_path="bundle",
+            endpoint_url="https://vbms.example.com/",
+            keyfile=None,
+            samlfile=None,
+            key=None,
+            keypass="secret",
+            ca_cert=None,
+            client_cert=None,
+            retry_policy=RetryPolicy(
+                clock, max_attempts=4, base_delay=2, max_delay=60,
+                random=lambda: 1,
+            ),
+            circuit_breaker=breaker,
+        )
+        success_result_of(db.create_download(logger, "request-1", "123"))
+        doc = make_document("request-1", "1")
+        success_result_of(db.create_documents(logger, [doc]))
+
+        d = app.start_documents_download(logger, [doc])
+        # The retries run out (after 4 + 8 + 16 seconds) while the circuit
+        # is still open.
+        clock.advance(4)
+        clock.advance(8)
+        clock.advance(16)
+
+        with pytest.raises(FirstError) as exc_info:
+            success_result_of(d)
+        assert exc_info.value.subFailure.check(CircuitOpenError)
+        [doc] = success_result_of(
+            db.get_download(logger, "request-1")
+        ).documents
+        assert not doc.errored
+        assert doc.content_location is None
+        assert success_result_of(app.blob_store.list_keys(None, 10)) == []
+        app.vbms_client.stop()
+
+    def test_admit_waiting_downloads(self, db):
+        logger = Logger(FakeMemoryLog())
+        app = make_app(logger, db)
+        app.jobs = FakeJobQueue()
+        app.admission = AdmissionControl(
+            Clock(),
+            db,
+            max_active_downloads=1,
+            max_queued_documents=100,
+            max_waiting=10,
+        )
+        for request_id in ["waiting-1", "waiting-2"]:
+            success_result_of(db.create_download(
+                logger, request_id, "123456789", state="WAITING"
+            ))
+
+        success_result_of(app.admit_waiting_downloads())
+
+        [job] = app.jobs.jobs
+        assert job.kind == LIST_DOCUMENTS
+        assert job.request_id == "waiting-1"
+        download = success_result_of(db.get_download(logger, "waiting-1"))
+        assert download.state == "STARTED"
+        download = success_result_of(db.get_download(logger, "waiting-2"))
+        assert download.state == "WAITING"
+
+    def test_admit_waiting_downloads_without_admission(self, db):
+        logger = Logger(FakeMemoryLog())
+        app = make_app(logger, db)
+        app.jobs = FakeJobQueue()
+        for request_id in ["waiting-1", "waiting-2"]:
+            success_result_of(db.create_download(
+                logger, request_id, "123456789", state="WAITING"
+            ))
+
+        success_result_of(app.admit_waiting_downloads())
+
+        assert sorted(job.request_id for job in app.jobs.jobs) == [
+            "waiting-1", "waiting-2",
+        ]
+
+    def test_download_rejected(self, db):
+        logger = Logger(FakeMemoryLog())
+        app = make_app(logger, db)
+        app.admission = AdmissionControl(
+            Clock(),
+            db,
+            max_active_downloads=0,
+            max_queued_documents=100,
+            max_waiting=0,
+            retry_after=30,
+        )
+        request = FakeRequest(["/efolder-express/download/"])
+        request.args["file_number"] = ["123-45-6789"]
+
+        success_result_of(app.download(request))
+
+        assert request.responseCode == 503
+        assert request.outgoingHeaders["retry-after"] == "30"
+        assert success_result_of(db.get_admission_counts(logger)) == (
+            0, 0, 0
+        )
+
+    def test_download_waits(self, db):
+        logger = Logger(FakeMemoryLog())
+        app = make_app(logger, db)
+        app.jobs = FakeJobQueue()
+        app.admission = AdmissionControl(
+            Clock(),
+            db,
+            max_active_downloads=0,
+            max_queued_documents=100,
+            max_waiting=10,
+        )
+        request = FakeRequest(["/efolder-express/download/"])
+        request.args["file_number"] = ["123-45-6789"]
+
+        success_result_of(app.download(request))
+
+        request_id = request.outgoingHeaders["location"].split("/")[-2]
+        download = success_result_of(db.get_download(logger, request_id))
+        assert download.state == "WAITING"
+        assert download.file_number == "123456789"
+        assert app.jobs.jobs == []
+
+        # The status page works whether or not admission control is on.
+        for admission in [app.admission, None]:
+            app.admission = admission
+            data = success_result_of(app._download_status_data(download))
+            assert (data["position"], data["estimated_start"]) == (1, None)
+
+    def test_queue_document_downloads_batches(self):
+        jobs = FakeJobQueue()
+        app = DownloadEFolder(
+            Logger(FakeMemoryLog()),
+            None,
+            None,
+            None,
+            vbms_client=FakeVBMSClient(),
+            jobs=jobs,
+            env_name=None,
+            fetch_batch_size=2,
+        )
+        documents = [
+            make_document("test-request-id", str(i)) for i in xrange(3)
+        ]
+        success_result_of(
+            app.queue_document_downloads(app.logger, "123", documents)
+        )
+
+        assert [job.payload["document_ids"] for job in jobs.jobs] == [
+            ["id-0", "id-1"], ["id-2"]
+        ]
+        assert {job.payload["document_count"] for job in jobs.jobs} == {3}
+
+    def test_start_documents_download(self, tmpdir, db):
+        logger = Logger(FakeMemoryLog())
+        fernet = Fernet(Fernet.generate_key())
+        app = DownloadEFolder(
+            logger,
+            db,
+            FilesystemBlobStore(FilePath(str(tmpdir))),
+            fernet,
+            vbms_client=FakeVBMSClient(),
+            jobs=None,
+            env_name=None,
+        )
+        success_result_of(db.create_download(
+            logger, "test-request-id", "123456789"
+        ))
+        documents = [
+            make_document("test-request-id", str(i)) for i in xrange(2)
+        ]
+        success_result_of(db.create_documents(logger, documents))
+
+        success_result_of(app.start_documents_download(logger, documents))
+
+        download = success_result_of(db.get_download(
+            logger, "test-request-id"
+        ))
+        assert download.completed
+        assert len({doc.content_location for doc in download.documents}) == 2
+        for doc in download.documents:
+            with success_result_of(app.blob_store.open(
+                doc.content_location
+            )) as f:
+                assert "".join(decrypt_file(fernet, f)) == (
+                    "contents of {}".format(doc.document_id)
+                )
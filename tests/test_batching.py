@@ -0,0 +1,120 @@
+import pytest
+
+from twisted.internet.defer import Deferred, fail
+from twisted.internet.task import Clock
+
+from efolder_express.batching import WriteBatcher
+from efolder_express.log import Logger
+
+from .utils import FakeMemoryLog, no_result, success_result_of
+
+
+class FakeTransactions(object):
+    def __init__(self):
+        # (queries, Deferred) for each transaction started.
+        self.transactions = []
+
+    def execute_transaction(self, logger, queries):
+        d = Deferred()
+        self.transactions.append((queries, d))
+        return d
+
+
+class TestWriteBatcher(object):
+    def test_delay(self):
+        clock = Clock()
+        transactions = FakeTransactions()
+        batcher = WriteBatcher(
+            clock, transactions.execute_transaction, 0.01, 10
+        )
+        logger = Logger(FakeMemoryLog())
+
+        d1 = batcher.add(logger, ["a1", "a2"])
+        d2 = batcher.add(logger, ["b"])
+        assert transactions.transactions == []
+        clock.advance(0.01)
+        [(queries, d)] = transactions.transactions
+        assert queries == ["a1", "a2", "b"]
+        no_result(d1)
+
+        d.callback([1, 2, 3])
+        assert success_result_of(d1) == [1, 2]
+        assert success_result_of(d2) == [3]
+
+    def test_max_size(self):
+        clock = Clock()
+        transactions = FakeTransactions()
+        batcher = WriteBatcher(clock, transactions.execute_transaction, 1, 2)
+        logger = Logger(FakeMemoryLog())
+
+        batcher.add(logger, ["a"])
+        batcher.add(logger, ["b"])
+        assert [q for q, _ in transactions.transactions] == [["a", "b"]]
+        assert not clock.getDelayedCalls()
+
+    def test_one_batch_at_a_time(self):
+        clock = Clock()
+        transactions = FakeTransactions()
+        batcher = WriteBatcher(
+            clock, transactions.execute_transaction, 0.01, 10
+        )
+        logger = Logger(FakeMemoryLog())
+
+        batcher.add(logger, ["a"])
+        clock.advance(0.01)
+        d2 = batcher.add(logger, ["b"])
+        d3 = batcher.add(logger, ["c"])
+        clock.advance(0.01)
+        assert len(transactions.transactions) == 1
+
+        # The next batch is committed as soon as the first is.
+        transactions.transactions[0][1].callback([1])
+        assert [q for q, _ in transactions.transactions] == [
+            ["a"], ["b", "c"],
+        ]
+        transactions.transactions[1][1].callback([2, 3])
+        assert success_result_of(d2) == [2]
+        assert success_result_of(d3) == [3]
+
+    def test_batch_failed(self):
+        clock = Clock()
+        transactions = FakeTransactions()
+        batcher = WriteBatcher(
+            clock, transactions.execute_transaction, 0.01, 10
+        )
+        log = FakeMemoryLog()
+        logger = Logger(log)
+
+        d1 = batcher.add(logger, ["a"])
+        d2 = batcher.add(logger, ["b"])
+        clock.advance(0.01)
+        transactions.transactions[0][1].errback(ValueError("b is bad"))
+        assert [msg["event"] for msg in log.msgs] == ["write_batch.failed"]
+
+        # Each write is retried on its own.
+        assert [q for q, _ in transactions.transactions[1:]] == [["a"], ["b"]]
+        transactions.transactions[1][1].callback([1])
+        transactions.transactions[2][1].errback(ValueError("b is bad"))
+        assert success_result_of(d1) == [1]
+        with pytest.raises(ValueError):
+            success_result_of(d2)
+
+        # Later writes are batched as usual.
+        d3 = batcher.add(logger, ["c"])
+        clock.advance(0.01)
+        assert [q for q, _ in transactions.transactions[3:]] == [["c"]]
+        transactions.transactions[3][1].callback([1])
+        assert success_result_of(d3) == [1]
+
+    def test_execute_fails_immediately(self):
+        clock = Clock()
+        batcher = WriteBatcher(
+            clock,
+            lambda logger, queries: fail(ValueError()),
+            0.01,
+            10,
+        )
+        d = batcher.add(Logger(FakeMemoryLog()), ["a"])
+        clock.advance(0.01)
+        with pytest.raises(ValueError):
+            success_result_of(d)
@@ -0,0 +1,228 @@
+import datetime
+import hashlib
+import io
+
+from twisted.python.filepath import FilePath
+
+from efolder_express.blob_store import (
+    FilesystemBlobStore, ObjectBlobStore, move_legacy_blobs
+)
+from efolder_express.db import Document, DownloadDatabase
+from efolder_express.log import Logger
+
+from .utils import (
+    FakeMemoryLog, FakeReactor, FakeThreadPool, success_result_of
+)
+
+
+class FakeClientError(Exception):
+    def __init__(self, code):
+        super(FakeClientError, self).__init__(code)
+        self.response = {"Error": {"Code": code}}
+
+
+class FakeS3Client(object):
+    """
+    An in-memory stand-in for a boto3 S3 client.
+    """
+
+    def __init__(self):
+        # (bucket, key) -> content
+        self.objects = {}
+
+    def _get(self, kwargs):
+        key = (kwargs["Bucket"], kwargs["Key"])
+        if key not in self.objects:
+            raise FakeClientError("404")
+        return self.objects[key]
+
+    # boto3's keyword arguments are capitalized, hence ``kwargs``.
+    def put_object(self, **kwargs):
+        self.objects[kwargs["Bucket"], kwargs["Key"]] = kwargs["Body"].read()
+
+    def get_object(self, **kwargs):
+        return {"Body": io.BytesIO(self._get(kwargs))}
+
+    def head_object(self, **kwargs):
+        return {
+            "ContentLength": len(self._get(kwargs)),
+            "LastModified": datetime.datetime(2016, 1, 1),
+        }
+
+    def delete_object(self, **kwargs):
+        self.objects.pop((kwargs["Bucket"], kwargs["Key"]), None)
+
+    def list_objects_v2(self, **kwargs):
+        keys = sorted(
+            key for bucket, key in self.objects
+            if bucket == kwargs["Bucket"] and
+            key.startswith(kwargs["Prefix"]) and
+            key > kwargs.get("StartAfter", "")
+        )
+        return {"Contents": [
+            {"Key": key} for key in keys[:kwargs["MaxKeys"]]
+        ]}
+
+
+def write_blob(store, key, content):
+    writer = store.open_writer(key)
+    writer.write(content)
+    return writer
+
+
+def read_blob(store, key):
+    with success_result_of(store.open(key)) as f:
+        return f.read()
+
+
+class TestFilesystemBlobStore(object):
+    def test_layout(self, tmpdir):
+        root = FilePath(str(tmpdir))
+        store = FilesystemBlobStore(root)
+        success_result_of(write_blob(store, "key", "contents").close())
+
+        digest = hashlib.sha1("key").hexdigest()
+        path = root.child(digest[:2]).child(digest[2:4]).child("key")
+        assert path.getContent() == "contents"
+        assert read_blob(store, "key") == "contents"
+        assert success_result_of(store.stat("key")).size == 8
+
+        assert success_result_of(store.delete("key")) == 8
+        assert success_result_of(store.delete("key")) is None
+        assert success_result_of(store.stat("key")) is None
+
+    def test_discard(self, tmpdir):
+        store = FilesystemBlobStore(FilePath(str(tmpdir)))
+        success_result_of(write_blob(store, "key", "contents").discard())
+        assert success_result_of(store.stat("key")) is None
+
+    def test_list_keys(self, tmpdir):
+        root = FilePath(str(tmpdir))
+        store = FilesystemBlobStore(root)
+        keys = ["key-{}".format(i) for i in xrange(5)]
+        for key in keys:
+            success_result_of(write_blob(store, key, "x").close())
+        # Files left in the old, flat layout aren't listed.
+        root.child("legacy").setContent("x")
+
+        listed = []
+        after = None
+        while True:
+            page = success_result_of(store.list_keys(after, 2))
+            listed.extend(page)
+            if len(page) < 2:
+                break
+            after = page[-1]
+        assert sorted(listed) == keys
+
+    def test_legacy_key(self, tmpdir):
+        path = FilePath(str(tmpdir)).child("legacy")
+        path.setContent("contents")
+        store = FilesystemBlobStore(FilePath(str(tmpdir)))
+        assert read_blob(store, path.path) == "contents"
+
+
+class TestObjectBlobStore(object):
+    def test_round_trip(self):
+        client = FakeS3Client()
+        store = ObjectBlobStore(
+            FakeReactor(), FakeThreadPool(), client, "bucket", prefix="p/"
+        )
+
+        writer = write_blob(store, "key", "contents")
+        assert client.objects == {}
+        success_result_of(writer.close())
+        assert client.objects == {("bucket", "p/key"): "contents"}
+
+        assert read_blob(store, "key") == "contents"
+        blob_stat = success_result_of(store.stat("key"))
+        assert blob_stat.size == 8
+        assert blob_stat.modified_at == 1451606400
+        assert success_result_of(store.list_keys(None, 10)) == ["key"]
+
+        assert success_result_of(store.delete("key")) == 8
+        assert success_result_of(store.delete("key")) is None
+        assert success_result_of(store.stat("key")) is None
+
+    def test_discard(self):
+        client = FakeS3Client()
+        store = ObjectBlobStore(
+            FakeReactor(), FakeThreadPool(), client, "bucket"
+        )
+        success_result_of(write_blob(store, "key", "contents").discard())
+        assert client.objects == {}
+
+    def test_list_keys(self):
+        client = FakeS3Client()
+        store = ObjectBlobStore(
+            FakeReactor(), FakeThreadPool(), client, "bucket", prefix="p/"
+        )
+        client.objects["bucket", "other/key"] = "x"
+        for key in ["a", "b", "c"]:
+            success_result_of(store.put(key, io.BytesIO("x")))
+
+        assert success_result_of(store.list_keys(None, 2)) == ["a", "b"]
+        assert success_result_of(store.list_keys("b", 2)) == ["c"]
+
+
+class TestMoveLegacyBlobs(object):
+    def test_move(self, tmpdir):
+        log = FakeMemoryLog()
+        logger = Logger(log)
+        db = DownloadDatabase(FakeReactor(), FakeThreadPool(), "sqlite://")
+        success_result_of(db.create_database(logger))
+        root = FilePath(str(tmpdir))
+        store = FilesystemBlobStore(root)
+
+        success_result_of(db.create_download(logger, "request", "123"))
+        docs = [
+            Document(
+                id=document_id, download_id="request",
+                document_id=document_id, doc_type="00356",
+                filename="file.pdf", received_at=None, source="CUI",
+                content_location=None, errored=False,
+            )
+            for document_id in ["{A}", "{B}", "{C}", "{D}"]
+        ]
+        success_result_of(db.create_documents(logger, docs))
+        root.child("flat-a").setContent("a")
+        root.child("flat-b").setContent("b")
+        success_result_of(
+            db.add_blob(logger, docs[0], "hash", root.child("flat-a").path)
+        )
+        success_result_of(
+            db.add_blob(logger, docs[1], "hash", root.child("flat-b").path)
+        )
+        # Its file has gone missing.
+        success_result_of(
+            db.add_blob(logger, docs[2], "hash", root.child("flat-c").path)
+        )
+        # Fetched before there were blobs.
+        root.child("flat-d").setContent("d")
+        success_result_of(db.set_document_content_location(
+            logger, docs[3], root.child("flat-d").path
+        ))
+
+        moved = success_result_of(
+            move_legacy_blobs(logger, db, store, batch_size=1)
+        )
+
+        assert moved == 3
+        assert not root.child("flat-a").exists()
+        assert read_blob(store, "flat-a") == "a"
+        assert read_blob(store, "flat-d") == "d"
+        assert sorted(
+            success_result_of(db.get_blob_locations(logger, None, 10))
+        ) == ["flat-a", "flat-b"]
+        download = success_result_of(db.get_download(logger, "request"))
+        assert [
+            (doc.content_location, doc.errored) for doc in download.documents
+        ] == [
+            ("flat-a", False), ("flat-b", False), (None, True),
+            ("flat-d", False),
+        ]
+        assert download.completed_documents == 3
+        assert download.errored_documents == 1
+        [event] = [msg for msg in log.msgs
+                   if msg["event"] == "blob_store.moved_legacy"]
+        assert (event["moved"], event["missing"]) == (3, 1)
@@ -1,9 +1,26 @@
 import datetime
+import zipfile
+
+from cryptography.fernet import Fernet
+
+import jinja2
 
 import pytest
 
-from efolder_express.db import Document, DownloadDatabase, DownloadNotFound
+import sqlalchemy
+
+from twisted.internet.task import Clock
+from twisted.python.filepath import FilePath
+
+from efolder_express.blob_store import FilesystemBlobStore
+from efolder_express.db import (
+    Document, DownloadDatabase, DownloadNotFound, DownloadStatus, Job
+)
+from efolder_express.jobs import FETCH_DOCUMENTS
 from efolder_express.log import Logger
+from efolder_express.scheduler import DOCUMENTS
+from efolder_express.status_cache import StatusCache
+from efolder_express.storage import EncryptingWriter
 
 from .utils import (
     FakeMemoryLog, FakeReactor, FakeThreadPool, success_result_of
@@ -13,7 +30,7 @@ from .utils import (
 @pytest.fixture
 def db():
     db = DownloadDatabase(FakeReactor(), FakeThreadPool(), "sqlite://")
-    success_result_of(db.create_database())
+    success_result_of(db.create_database(Logger(FakeMemoryLog())))
     return db
 
 
@@ -29,6 +46,48 @@ class TestDocument(object):
         assert doc.received_at is None
 
 
+class TestDownloadStatus(object):
+    def test_build_zip(self, tmpdir):
+        fernet = Fernet(Fernet.generate_key())
+        store = FilesystemBlobStore(FilePath(str(tmpdir)))
+        writer = EncryptingWriter(fernet, store, "blob", chunk_size=4)
+        writer.write("the contents")
+        writer.close()
+
+        status = DownloadStatus(
+            request_id="test-request-id",
+            file_number="123456789",
+            state="MANIFEST_DOWNLOADED",
+            documents=[
+                Document(
+                    id="test-document-id",
+                    download_id="test-request-id",
+                    document_id="{ABCD}",
+                    doc_type="1",
+                    filename="file.pdf",
+                    received_at=datetime.date(2015, 3, 4),
+                    source="CUI",
+                    content_location="blob",
+                    errored=False,
+                ),
+            ],
+        )
+        jinja_env = jinja2.Environment(loader=jinja2.FileSystemLoader(
+            FilePath(__file__).parent().parent().child("templates").path
+        ))
+        zip_path = success_result_of(
+            status.build_zip(jinja_env, fernet, {1: "Test!"}, store)
+        )
+        try:
+            with zipfile.ZipFile(zip_path) as z:
+                assert z.read("123456789-eFolder/file.pdf") == "the contents"
+                info = z.getinfo("123456789-eFolder/file.pdf")
+                assert info.date_time == (2015, 3, 4, 0, 0, 0)
+                assert "Test!" in z.read("123456789-eFolder/README.txt")
+        finally:
+            FilePath(zip_path).remove()
+
+
 class TestDownloadDatabase(object):
     def scalar(self, db, q):
         d = db._engine.execute(q)
@@ -46,6 +105,261 @@ class TestDownloadDatabase(object):
         success_result_of(d)
         assert self.scalar(db, db._downloads.select().count()) == 2
 
+    def test_admission_counts(self, db):
+        logger = Logger(FakeMemoryLog())
+        jobs = {}
+        for request_id in ["running", "cancelled", "dead-lettered"]:
+            success_result_of(db.create_download(logger, request_id, "123"))
+            success_result_of(db.create_documents(logger, [
+                Document.from_json(request_id, {
+                    "document_id": "{}-{}".format(request_id, i),
+                    "doc_type": "1",
+                    "filename": "file.pdf",
+                    "received_at": None,
+                    "source": "CUI",
+                })
+                for i in xrange(2)
+            ]))
+            jobs[request_id] = Job.create(
+                FETCH_DOCUMENTS, request_id, DOCUMENTS, {}
+            )
+        success_result_of(db.create_jobs(logger, jobs.values()))
+        success_result_of(db.cancel_download(logger, "cancelled"))
+        success_result_of(
+            db.dead_letter_job(logger, jobs["dead-lettered"], "Oops")
+        )
+
+        assert success_result_of(db.get_admission_counts(logger)) == (
+            1, 2, 0
+        )
+
+    def test_waiting_downloads(self, db):
+        logger = Logger(FakeMemoryLog())
+
+        for request_id in ["waiting-1", "waiting-2", "waiting-3"]:
+            d = db.create_download(
+                logger, request_id, "123456789", state="WAITING"
+            )
+            success_result_of(d)
+        success_result_of(db.create_download(logger, "started", "123456789"))
+
+        assert success_result_of(db.get_admission_counts(logger)) == (
+            0, 0, 3
+        )
+        assert success_result_of(
+            db.get_waiting_position(logger, "waiting-2")
+        ) == 2
+        assert success_result_of(db.get_waiting_downloads(logger, 2)) == [
+            ("waiting-1", "123456789"),
+            ("waiting-2", "123456789"),
+        ]
+
+        assert success_result_of(
+            db.mark_download_started(logger, "waiting-1")
+        ) is True
+        # Already started.
+        assert success_result_of(
+            db.mark_download_started(logger, "waiting-1")
+        ) is False
+        assert success_result_of(
+            db.get_waiting_position(logger, "waiting-3")
+        ) == 2
+        download = success_result_of(db.get_download(logger, "waiting-1"))
+        assert download.state == "STARTED"
+
+    def test_cancel_download(self, db):
+        logger = Logger(FakeMemoryLog())
+        success_result_of(db.create_download(logger, "request-1", "123"))
+        success_result_of(db.create_download(logger, "request-2", "123"))
+        jobs = [
+            Job.create("fetch_documents", request_id, "documents", {})
+            for request_id in ["request-1", "request-2"]
+        ]
+        success_result_of(db.create_jobs(logger, jobs))
+
+        # Only downloads with unfinished jobs can be abandoned.
+        later = datetime.datetime.utcnow() + datetime.timedelta(seconds=1)
+        assert sorted(success_result_of(
+            db.get_abandoned_downloads(logger, later)
+        )) == ["request-1", "request-2"]
+        assert success_result_of(db.get_abandoned_downloads(
+            logger, later - datetime.timedelta(minutes=1)
+        )) == []
+
+        assert success_result_of(db.cancel_download(logger, "request-1"))
+        assert not success_result_of(db.cancel_download(logger, "request-1"))
+        download = success_result_of(db.get_download(logger, "request-1"))
+        assert download.state == "CANCELLED"
+        assert success_result_of(db.get_finished_jobs(
+            logger, [job.id for job in jobs]
+        )) == [jobs[0].id]
+        assert success_result_of(
+            db.get_abandoned_downloads(logger, later)
+        ) == ["request-2"]
+
+    def test_touch_download(self, db):
+        logger = Logger(FakeMemoryLog())
+        success_result_of(db.create_download(logger, "request-1", "123"))
+        query = sqlalchemy.select([db._downloads.c.last_polled_at])
+        long_ago = datetime.datetime(2016, 1, 1)
+
+        def set_last_polled_at(value):
+            success_result_of(db._execute(
+                logger, "set_last_polled_at",
+                db._downloads.update().values(last_polled_at=value),
+            ))
+
+        # Recent polls aren't written again.
+        success_result_of(db.touch_download(logger, "request-1"))
+        polled_at = self.scalar(db, query)
+        success_result_of(db.touch_download(logger, "request-1", interval=60))
+        assert self.scalar(db, query) == polled_at
+
+        set_last_polled_at(long_ago)
+        success_result_of(db.touch_download(logger, "request-1"))
+        assert self.scalar(db, query) > long_ago
+
+        # Nor are finished downloads'.
+        set_last_polled_at(long_ago)
+        success_result_of(db.cancel_download(logger, "request-1"))
+        success_result_of(db.touch_download(logger, "request-1"))
+        assert self.scalar(db, query) == long_ago
+
+    def test_create_database_existing(self, db):
+        success_result_of(db.create_database(Logger(FakeMemoryLog())))
+
+    def test_document_types(self, db):
+        logger = Logger(FakeMemoryLog())
+
+        assert success_result_of(db.get_document_types(logger)) == ({}, None)
+
+        fetched_at = datetime.datetime(2016, 1, 1)
+        d = db.replace_document_types(logger, {1: "A", 2: "B"}, fetched_at)
+        success_result_of(d)
+        d = db.replace_document_types(logger, {1: "C"}, fetched_at)
+        success_result_of(d)
+
+        assert success_result_of(db.get_document_types(logger)) == (
+            {1: "C"}, fetched_at
+        )
+
+    def test_blobs(self, db):
+        logger = Logger(FakeMemoryLog())
+
+        success_result_of(db.create_download(logger, "request-1", "123"))
+        success_result_of(db.create_download(logger, "request-2", "123"))
+        doc1, doc2, doc3 = [
+            Document(
+                id="test-document-id-{}".format(i),
+                download_id=download_id,
+                document_id="{ABCD}",
+                doc_type="00356",
+                filename="file.pdf",
+                received_at=None,
+                source="CUI",
+                content_location=None,
+                errored=False,
+            )
+            for i, download_id in enumerate(
+                ["request-1", "request-1", "request-2"]
+            )
+        ]
+        success_result_of(db.create_documents(logger, [doc1, doc2, doc3]))
+
+        assert success_result_of(db.reuse_blobs(logger, [doc1])) == []
+        assert success_result_of(
+            db.add_blob(logger, doc1, "hash", "/path/1")
+        ) == "/path/1"
+        # Stored concurrently by another download.
+        assert success_result_of(
+            db.add_blob(logger, doc2, "hash", "/path/2")
+        ) == "/path/1"
+        assert success_result_of(db.reuse_blobs(logger, [doc3])) == [doc3]
+        assert doc3.content_location == "/path/1"
+
+        assert self.scalar(
+            db, sqlalchemy.select([db._blobs.c.refcount])
+        ) == 3
+        download = success_result_of(db.get_download(logger, "request-2"))
+        assert download.documents[0].content_location == "/path/1"
+
+    def make_blob_documents(self, db, logger, count):
+        success_result_of(db.create_download(logger, "request-1", "123"))
+        docs = [
+            Document(
+                id="test-document-id-{}".format(i),
+                download_id="request-1",
+                document_id="{ABCD}",
+                doc_type="00356",
+                filename="file.pdf",
+                received_at=None,
+                source="CUI",
+                content_location=None,
+                errored=False,
+            )
+            for i in xrange(count)
+        ]
+        success_result_of(db.create_documents(logger, docs))
+        return docs
+
+    def test_add_blob_concurrent_insert(self, db):
+        log = FakeMemoryLog()
+        logger = Logger(log)
+        [doc] = self.make_blob_documents(db, logger, 1)
+        execute = db._execute
+
+        def racing_execute(logger, query_name, query, *args, **kwargs):
+            d = execute(logger, query_name, query, *args, **kwargs)
+            if query_name == "add_blob.get_blob" and not racing_execute.raced:
+                # Another process stores it right after it's looked up.
+                racing_execute.raced = True
+                success_result_of(execute(
+                    logger, "insert_blob", db._blobs.insert().values(
+                        document_id=doc.document_id,
+                        content_hash="other-hash",
+                        location="/path/other",
+                        refcount=0,
+                        created_at=datetime.datetime.utcnow(),
+                    ),
+                ))
+            return d
+        racing_execute.raced = False
+        db._execute = racing_execute
+
+        assert success_result_of(
+            db.add_blob(logger, doc, "hash", "/path/1")
+        ) == "/path/other"
+        assert self.scalar(
+            db, sqlalchemy.select([db._blobs.c.refcount])
+        ) == 1
+        download = success_result_of(db.get_download(logger, "request-1"))
+        assert download.documents[0].content_location == "/path/other"
+        assert download.completed_documents == 1
+        [event] = [msg for msg in log.msgs
+                   if msg["event"] == "add_blob.content_mismatch"]
+        assert event["existing_content_hash"] == "other-hash"
+
+    def test_reuse_deleted_blob(self, db):
+        logger = Logger(FakeMemoryLog())
+        doc1, doc2 = self.make_blob_documents(db, logger, 2)
+        success_result_of(db.add_blob(logger, doc1, "hash", "/path/1"))
+        execute_transaction = db._execute_transaction
+
+        def racing_execute_transaction(logger, query_name, queries):
+            if query_name == "reuse_blobs.reference_blobs":
+                # Retention deletes it right after it's looked up.
+                success_result_of(db.delete_blob(logger, "/path/1"))
+            return execute_transaction(logger, query_name, queries)
+        db._execute_transaction = racing_execute_transaction
+
+        assert success_result_of(db.reuse_blobs(logger, [doc2])) == []
+        assert doc2.content_location is None
+        download = success_result_of(db.get_download(logger, "request-1"))
+        assert [
+            doc.content_location for doc in download.documents
+        ] == ["/path/1", None]
+        assert download.completed_documents == 1
+
     def test_get_download(self, db):
         logger = Logger(FakeMemoryLog())
 
@@ -91,13 +405,30 @@ class TestDownloadDatabase(object):
         success_result_of(d)
 
         d = db.mark_download_manifest_downloaded(logger, "test-request-id")
-        success_result_of(d)
+        assert success_result_of(d)
 
         download = success_result_of(db.get_download(
             logger, "test-request-id"
         ))
         assert download.state == "MANIFEST_DOWNLOADED"
 
+    def test_mark_download_manifest_downloaded_cancelled(self, db):
+        logger = Logger(FakeMemoryLog())
+        success_result_of(
+            db.create_download(logger, "test-request-id", "123456789")
+        )
+        success_result_of(db.cancel_download(logger, "test-request-id"))
+
+        for mark in [
+            db.mark_download_manifest_downloaded, db.mark_download_errored
+        ]:
+            assert not success_result_of(mark(logger, "test-request-id"))
+
+        download = success_result_of(db.get_download(
+            logger, "test-request-id"
+        ))
+        assert download.state == "CANCELLED"
+
     def test_create_documents(self, db):
         logger = Logger(FakeMemoryLog())
 
@@ -205,6 +536,109 @@ class TestDownloadDatabase(object):
         assert download.percent_completed == 100
         assert download.documents[0].content_location == "/path/to/content"
 
+    def test_get_download_progress(self, db):
+        logger = Logger(FakeMemoryLog())
+        success_result_of(db.create_download(logger, "request-1", "123"))
+        docs = [
+            Document(
+                id="id-{}".format(i),
+                download_id="request-1",
+                # The last two are the same VBMS document.
+                document_id="{{{}}}".format(min(i, 2)),
+                doc_type="00356",
+                filename="file.pdf",
+                received_at=None,
+                source="CUI",
+                content_location=None,
+                errored=False,
+            )
+            for i in xrange(4)
+        ]
+        success_result_of(db.create_documents(logger, docs))
+        success_result_of(db.set_document_content_location(
+            logger, docs[0], "/path/0"
+        ))
+        success_result_of(db.mark_document_errored(logger, docs[1]))
+        # Documents are only counted the first time they finish.
+        success_result_of(db.set_document_content_location(
+            logger, docs[0], "/path/0"
+        ))
+        success_result_of(db.set_document_content_location(
+            logger, docs[1], "/path/1"
+        ))
+        success_result_of(db.mark_document_errored(logger, docs[0]))
+
+        download = success_result_of(
+            db.get_download_progress(logger, "request-1")
+        )
+        assert download.documents is None
+        assert (
+            download.total_documents,
+            download.completed_documents,
+            download.errored_documents,
+        ) == (4, 1, 1)
+        assert not download.completed
+        assert download.percent_completed == 50
+
+        success_result_of(db.add_blob(logger, docs[2], "hash", "/path/2"))
+        success_result_of(db.reuse_blobs(logger, [docs[3]]))
+        download = success_result_of(
+            db.get_download_progress(logger, "request-1")
+        )
+        assert download.completed_documents == 3
+        assert download.completed
+
+        with pytest.raises(DownloadNotFound):
+            success_result_of(db.get_download_progress(logger, "missing"))
+
+    def test_status_cache(self):
+        logger = Logger(FakeMemoryLog())
+        cache = StatusCache(Clock(), logger, size=10)
+        db = DownloadDatabase(
+            FakeReactor(), FakeThreadPool(), "sqlite://", status_cache=cache
+        )
+        success_result_of(db.create_database(logger))
+        success_result_of(db.create_download(logger, "request-1", "123"))
+        status = success_result_of(
+            db.get_download_progress(logger, "request-1")
+        )
+
+        docs = [
+            Document(
+                id="id-{}".format(i),
+                download_id="request-1",
+                document_id="{{{}}}".format(i),
+                doc_type="00356",
+                filename="file.pdf",
+                received_at=None,
+                source="CUI",
+                content_location=None,
+                errored=False,
+            )
+            for i in xrange(3)
+        ]
+        success_result_of(db.create_documents(logger, docs))
+        success_result_of(db.mark_download_manifest_downloaded(
+            logger, "request-1"
+        ))
+        success_result_of(db.add_blob(logger, docs[0], "hash", "/path/0"))
+        success_result_of(db.mark_document_errored(logger, docs[1]))
+        success_result_of(db.mark_document_errored(logger, docs[1]))
+
+        assert success_result_of(
+            db.get_download_progress(logger, "request-1")
+        ) is status
+        assert cache.hits == 1
+        assert status.state == "MANIFEST_DOWNLOADED"
+        assert (
+            status.total_documents,
+            status.completed_documents,
+            status.errored_documents,
+        ) == (3, 1, 1)
+
+        success_result_of(db.cancel_download(logger, "request-1"))
+        assert status.state == "CANCELLED"
+
     def test_get_pending_work_downloads(self, db):
         logger = Logger(FakeMemoryLog())
 
@@ -257,3 +691,39 @@ class TestDownloadDatabase(object):
 
         d = db.get_pending_work(logger)
         assert success_result_of(d) == ([], [])
+
+    def test_get_pending_work_pages(self, db):
+        logger = Logger(FakeMemoryLog())
+
+        documents = []
+        for i in xrange(3):
+            request_id = "request-{}".format(i)
+            success_result_of(db.create_download(logger, request_id, str(i)))
+            for j in xrange(2):
+                doc = Document.from_json(request_id, {
+                    "document_id": "{}-{}".format(i, j),
+                    "doc_type": "00356",
+                    "filename": "file.pdf",
+                    "received_at": "2015-03-04",
+                    "source": "CUI",
+                })
+                documents.append(doc)
+        success_result_of(db.create_documents(logger, documents))
+
+        downloads, pending = success_result_of(
+            db.get_pending_work(logger, page_size=2)
+        )
+        assert sorted(d.request_id for d in downloads) == [
+            "request-0", "request-1", "request-2"
+        ]
+        for download in downloads:
+            assert sorted(doc.download_id for doc in download.documents) == [
+                download.request_id, download.request_id
+            ]
+        assert sorted(doc.id for doc in pending) == sorted(
+            doc.id for doc in documents
+        )
+
+        assert success_result_of(db.get_file_numbers(
+            logger, ["request-0", "request-2", "unknown"], page_size=1
+        )) == {"request-0": "0", "request-2": "2"}
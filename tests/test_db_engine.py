@@ -0,0 +1,65 @@
+import datetime
+
+import pytest
+
+from twisted.internet.defer import gatherResults
+
+from efolder_express.db import DownloadDatabase
+from efolder_express.db_engine import DatabaseThreads
+from efolder_express.log import Logger
+
+from .utils import FakeMemoryLog
+
+
+@pytest.fixture
+def reactor():
+    from twisted.internet import reactor
+    return reactor
+
+
+class TestDatabaseThreads(object):
+    def test_pin_least_busy(self):
+        threads = DatabaseThreads(None, 2)
+        # Not started, so calls stay queued.
+        threads.pin().callInThreadWithCallback(None, lambda: None)
+        threads.pin().callInThreadWithCallback(None, lambda: None)
+        pinned = threads.pin()
+        pinned.callInThreadWithCallback(None, lambda: None)
+        pinned.callInThreadWithCallback(None, lambda: None)
+        assert sorted(threads._load) == [1, 3]
+
+    @pytest.inlineCallbacks
+    def test_connections_stay_on_their_thread(self, request, reactor,
+                                              tmpdir):
+        threads = DatabaseThreads(reactor, 4)
+        threads.start()
+        request.addfinalizer(threads.stop)
+        read_threads = DatabaseThreads(reactor, 2)
+        read_threads.start()
+        request.addfinalizer(read_threads.stop)
+        # SQLite refuses to use a connection from any other thread than the
+        # one which opened it.
+        db = DownloadDatabase(
+            reactor,
+            threads,
+            "sqlite:///{}".format(tmpdir.join("db.sqlite")),
+            read_thread_pool=read_threads,
+        )
+        logger = Logger(FakeMemoryLog())
+        yield db.create_database(logger)
+
+        for i in xrange(20):
+            yield db.set_manifest(
+                logger, str(i), [], datetime.datetime.utcnow()
+            )
+            yield db.create_download(logger, "request-{}".format(i), str(i))
+
+        manifests = yield gatherResults([
+            db.get_manifest(logger, str(i)) for i in xrange(20)
+        ])
+        assert [documents for documents, _ in manifests] == [[]] * 20
+        downloads = yield gatherResults([
+            db.get_download(logger, "request-{}".format(i), read_only=True)
+            for i in xrange(20)
+        ])
+        assert [d.file_number for d in downloads] == map(str, xrange(20))
@@ -0,0 +1,198 @@
+import pytest
+
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
+
+from efolder_express.db import DownloadDatabase, Job
+from efolder_express.jobs import FETCH_DOCUMENTS, JobQueue, LIST_DOCUMENTS
+from efolder_express.log import Logger
+from efolder_express.scheduler import DOCUMENTS, MANIFEST, Scheduler
+
+from .utils import (
+    FakeMemoryLog, FakeReactor, FakeThreadPool, success_result_of
+)
+
+
+@pytest.fixture
+def db():
+    db = DownloadDatabase(FakeReactor(), FakeThreadPool(), "sqlite://")
+    success_result_of(db.create_database(Logger(FakeMemoryLog())))
+    logger = Logger(FakeMemoryLog())
+    for request_id in ["request-1", "request-2"]:
+        success_result_of(db.create_download(logger, request_id, "123"))
+    return db
+
+
+def make_job_queue(db, lease_duration=300, capacity=100, max_attempts=5):
+    clock = Clock()
+    logger = Logger(FakeMemoryLog())
+    return JobQueue(
+        clock,
+        logger,
+        db,
+        Scheduler(clock, logger),
+        lease_duration=lease_duration,
+        capacity=capacity,
+        max_attempts=max_attempts,
+    )
+
+
+def drain(scheduler):
+    items = []
+    while scheduler.depth(MANIFEST) or scheduler.depth(DOCUMENTS):
+        items.append(success_result_of(scheduler.get()))
+    return items
+
+
+class TestJobQueue(object):
+    def test_runs_jobs(self, db):
+        jobs = make_job_queue(db)
+        ran = []
+        jobs.start(ran.append)
+        fetch = Job.create(FETCH_DOCUMENTS, "request-1", DOCUMENTS, {})
+        listing = Job.create(LIST_DOCUMENTS, "request-2", MANIFEST, {})
+        success_result_of(jobs.put(jobs._logger, [fetch, listing]))
+
+        for item in drain(jobs.scheduler):
+            success_result_of(item())
+        assert [job.id for job in ran] == [listing.id, fetch.id]
+
+        # Completed jobs are never claimed again.
+        assert success_result_of(db.claim_jobs(
+            jobs._logger, "other", 10, jobs._lease_duration
+        )) == []
+        jobs.stop()
+
+    def test_capacity(self, db):
+        jobs = make_job_queue(db, capacity=1)
+        jobs.start(lambda job: None)
+        success_result_of(jobs.put(jobs._logger, [
+            Job.create(FETCH_DOCUMENTS, "request-1", DOCUMENTS, {})
+            for _ in xrange(2)
+        ]))
+
+        [item] = drain(jobs.scheduler)
+        success_result_of(item())
+        # Finishing a job claims the next one.
+        [item] = drain(jobs.scheduler)
+        jobs.stop()
+
+    def test_failed_job_retried_after_lease_expires(self, db):
+        jobs = make_job_queue(db, lease_duration=0)
+        other = make_job_queue(db)
+        job = Job.create(FETCH_DOCUMENTS, "request-1", DOCUMENTS, {})
+        success_result_of(db.create_jobs(jobs._logger, [job]))
+
+        def fail(job):
+            raise ZeroDivisionError()
+        jobs.start(fail)
+        [item] = drain(jobs.scheduler)
+        with pytest.raises(ZeroDivisionError):
+            success_result_of(item())
+        assert [
+            msg["event"] for msg in jobs._logger._log.msgs
+        ].count("job.error") == 1
+        jobs.stop()
+
+        ran = []
+        other.start(ran.append)
+        [item] = drain(other.scheduler)
+        success_result_of(item())
+        [claimed] = ran
+        assert claimed.id == job.id
+        assert claimed.attempts >= 2
+        other.stop()
+
+    def test_complete_idempotent(self, db):
+        logger = Logger(FakeMemoryLog())
+        job = Job.create(FETCH_DOCUMENTS, "request-1", DOCUMENTS, {})
+        success_result_of(db.create_jobs(logger, [job]))
+        [claimed] = success_result_of(db.claim_jobs(
+            logger, "node", 10, make_job_queue(db)._lease_duration
+        ))
+
+        success_result_of(db.complete_job(logger, claimed))
+        success_result_of(db.complete_job(logger, claimed))
+
+    def test_claim_takes_turns(self, db):
+        logger = Logger(FakeMemoryLog())
+        for request_id, count in [("request-1", 3), ("request-2", 2)]:
+            success_result_of(db.create_jobs(logger, [
+                Job.create(FETCH_DOCUMENTS, request_id, DOCUMENTS, {})
+                for _ in xrange(count)
+            ]))
+
+        claimed = success_result_of(db.claim_jobs(
+            logger, "node", 4, make_job_queue(db)._lease_duration
+        ))
+        assert sorted(job.request_id for job in claimed) == [
+            "request-1", "request-1", "request-2", "request-2",
+        ]
+
+    def test_dead_letters(self, db):
+        jobs = make_job_queue(db, lease_duration=0, max_attempts=2)
+        job = Job.create(FETCH_DOCUMENTS, "request-1", DOCUMENTS, {})
+        success_result_of(db.create_jobs(jobs._logger, [job]))
+
+        def fail(job):
+            raise ZeroDivisionError("Oops")
+        jobs.start(fail)
+        for _ in xrange(2):
+            [item] = drain(jobs.scheduler)
+            with pytest.raises(ZeroDivisionError):
+                success_result_of(item())
+        jobs.stop()
+
+        # Dead-lettered jobs aren't claimed again...
+        assert drain(jobs.scheduler) == []
+        [dead] = success_result_of(db.get_dead_letters(jobs._logger))
+        assert dead.id == job.id
+        assert dead.error == "Oops"
+
+        # ... until they're replayed.
+        success_result_of(db.replay_dead_letters(jobs._logger, [job.id]))
+        assert success_result_of(db.get_dead_letters(jobs._logger)) == []
+        [claimed] = success_result_of(db.claim_jobs(
+            jobs._logger, "node", 10, jobs._lease_duration
+        ))
+        assert claimed.attempts == 1
+
+    def test_cancel(self, db):
+        jobs = make_job_queue(db)
+        running = Deferred(canceller=lambda d: cancelled.append(d))
+        cancelled = []
+        jobs.start(lambda job: running)
+        success_result_of(jobs.put(jobs._logger, [
+            Job.create(FETCH_DOCUMENTS, "request-1", DOCUMENTS, {})
+            for _ in xrange(2)
+        ] + [Job.create(FETCH_DOCUMENTS, "request-2", DOCUMENTS, {})]))
+        [first, other, second] = drain(jobs.scheduler)
+        d = first()
+
+        success_result_of(db.cancel_download(jobs._logger, "request-1"))
+        jobs.cancel("request-1")
+        # The running job is cancelled, rather than failing.
+        assert cancelled == [running]
+        assert success_result_of(d) is None
+        assert [job.request_id for job in jobs._held.values()] == [
+            "request-2"
+        ]
+        jobs.stop()
+
+    def test_heartbeat_drops_jobs_finished_elsewhere(self, db):
+        jobs = make_job_queue(db)
+        jobs.start(lambda job: None)
+        success_result_of(jobs.put(jobs._logger, [
+            Job.create(FETCH_DOCUMENTS, "request-1", DOCUMENTS, {})
+        ]))
+        success_result_of(db.cancel_download(jobs._logger, "request-1"))
+
+        success_result_of(jobs.heartbeat())
+        [item] = drain(jobs.scheduler)
+        success_result_of(item())
+        assert jobs._held == {}
+        assert [
+            msg["event"] for msg in jobs._logger._log.msgs
+            if msg["event"].startswith("job.")
+        ] == ["job.claimed", "job.cancelled"]
+        jobs.stop()
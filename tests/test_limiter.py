@@ -0,0 +1,122 @@
+import pytest
+
+from twisted.internet.defer import Deferred, fail, succeed
+from twisted.internet.task import Clock
+
+from efolder_express.limiter import AdaptiveLimiter
+from efolder_express.log import Logger
+from efolder_express.retry import is_retryable
+from efolder_express.vbms import (
+    VBMSAbortedError, VBMSError, VBMSTimeoutError
+)
+
+from .utils import FakeMemoryLog, no_result, success_result_of
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+def make_limiter(clock, initial=2, minimum=1, maximum=4):
+    return AdaptiveLimiter(
+        clock,
+        Logger(FakeMemoryLog()),
+        initial=initial,
+        minimum=minimum,
+        maximum=maximum,
+        latency_target=10,
+    )
+
+
+class TestAdaptiveLimiter(object):
+    def test_limits_concurrency(self, clock):
+        limiter = make_limiter(clock)
+        calls = [Deferred() for _ in xrange(3)]
+        results = [limiter.run(lambda d=d: d) for d in calls]
+
+        calls[0].callback(1)
+        assert success_result_of(results[0]) == 1
+        no_result(results[2])
+
+        calls[1].callback(2)
+        calls[2].callback(3)
+        assert success_result_of(results[2]) == 3
+
+    def test_additive_increase(self, clock):
+        limiter = make_limiter(clock)
+        for _ in xrange(10):
+            success_result_of(limiter.run(succeed, None))
+        assert limiter.limit == 4
+
+        [msg1, msg2] = limiter._logger._log.msgs
+        assert msg1["event"] == "vbms.concurrency_limit"
+        assert (msg1["limit"], msg2["limit"]) == (3, 4)
+
+    def test_decrease_on_failure(self, clock):
+        limiter = make_limiter(clock, initial=4)
+        d = limiter.run(fail, ZeroDivisionError())
+        with pytest.raises(ZeroDivisionError):
+            success_result_of(d)
+        assert limiter.limit == 3
+
+    def test_only_overload_failures_decrease(self, clock):
+        limiter = AdaptiveLimiter(
+            clock,
+            Logger(FakeMemoryLog()),
+            initial=4,
+            minimum=1,
+            maximum=4,
+            latency_target=10,
+            is_overload=is_retryable,
+        )
+        for error in [
+            VBMSAbortedError(),
+            VBMSError("", "Document not found", 1),
+        ]:
+            d = limiter.run(fail, error)
+            with pytest.raises(VBMSError):
+                success_result_of(d)
+        assert limiter.limit == 4
+
+        d = limiter.run(fail, VBMSTimeoutError("", "", None, 1))
+        with pytest.raises(VBMSTimeoutError):
+            success_result_of(d)
+        assert limiter.limit == 3
+
+    def test_decrease_on_latency(self, clock):
+        limiter = make_limiter(clock, initial=4)
+        call = Deferred()
+        d = limiter.run(lambda: call)
+        clock.advance(11)
+        call.callback(None)
+        success_result_of(d)
+        assert limiter.limit == 3
+
+    def test_decrease_once_per_congestion(self, clock):
+        limiter = make_limiter(clock, initial=4)
+        calls = [Deferred() for _ in xrange(4)]
+        results = [limiter.run(lambda d=d: d) for d in calls]
+        clock.advance(1)
+        for call in calls:
+            call.errback(ZeroDivisionError())
+        for d in results:
+            d.addErrback(lambda f: None)
+        assert limiter.limit == 3
+
+    def test_floor(self, clock):
+        limiter = make_limiter(clock, initial=1)
+        for _ in xrange(3):
+            clock.advance(1)
+            limiter.run(fail, ZeroDivisionError()).addErrback(lambda f: None)
+        assert limiter.limit == 1
+
+    def test_run_batch_latency(self, clock):
+        limiter = make_limiter(clock, initial=2)
+        call = Deferred()
+        d = limiter.run_batch(5, lambda: call)
+        clock.advance(20)
+        call.callback(None)
+        success_result_of(d)
+        # 20 seconds for 5 calls is within the 10 second target.
+        assert limiter._limit > 2
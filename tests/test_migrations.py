@@ -0,0 +1,126 @@
+import sqlite3
+
+import sqlalchemy
+
+from efolder_express.db import DownloadDatabase
+from efolder_express.log import Logger
+from efolder_express.migrations import MIGRATIONS, create_indexes
+
+from .utils import (
+    FakeMemoryLog, FakeReactor, FakeThreadPool, success_result_of
+)
+
+
+# The schema before there were migrations.
+BASELINE_SCHEMA = """
+CREATE TABLE downloads (
+    request_id TEXT NOT NULL,
+    file_number TEXT NOT NULL,
+    started_at DATETIME NOT NULL,
+    state VARCHAR(19) NOT NULL,
+    PRIMARY KEY (request_id),
+    CHECK (state IN ('STARTED', 'MANIFEST_DOWNLOADED', 'ERRORED'))
+);
+CREATE TABLE documents (
+    id TEXT NOT NULL,
+    download_id TEXT NOT NULL,
+    document_id TEXT NOT NULL,
+    doc_type TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    received_at DATE,
+    source TEXT,
+    content_location TEXT,
+    errored BOOLEAN NOT NULL,
+    PRIMARY KEY (id),
+    FOREIGN KEY(download_id) REFERENCES downloads (request_id),
+    CHECK (errored IN (0, 1))
+);
+INSERT INTO downloads VALUES
+    ('request-1', '123', '2016-01-01 00:00:00.000000', 'MANIFEST_DOWNLOADED');
+INSERT INTO documents VALUES
+    ('doc-1', 'request-1', '{ABC}', '00356', 'file.pdf', NULL, NULL, NULL, 0);
+"""
+
+
+def baseline_db(tmpdir):
+    path = str(tmpdir.join("db.sqlite"))
+    conn = sqlite3.connect(path)
+    conn.executescript(BASELINE_SCHEMA)
+    conn.close()
+    return DownloadDatabase(
+        FakeReactor(), FakeThreadPool(), "sqlite:///{}".format(path)
+    )
+
+
+def index_names(db, table):
+    inspector = sqlalchemy.inspect(db._engine._engine)
+    return {index["name"] for index in inspector.get_indexes(table)}
+
+
+class TestMigrate(object):
+    def test_from_baseline(self, tmpdir):
+        log = FakeMemoryLog()
+        logger = Logger(log)
+        db = baseline_db(tmpdir)
+
+        versions = success_result_of(db.migrate(logger))
+        assert versions == range(1, len(MIGRATIONS) + 1)
+        assert [
+            msg["version"]
+            for msg in log.msgs
+            if msg["event"] == "migration.applied"
+        ] == versions
+
+        download = success_result_of(db.get_download(logger, "request-1"))
+        assert download.state == "MANIFEST_DOWNLOADED"
+        assert [doc.document_id for doc in download.documents] == ["{ABC}"]
+        assert download.total_documents == 1
+        assert download.completed_documents == 0
+
+        success_result_of(
+            db.create_download(logger, "request-2", "456", state="WAITING")
+        )
+        success_result_of(db.create_download(logger, "request-3", "789"))
+        assert success_result_of(db.cancel_download(logger, "request-3"))
+        download = success_result_of(db.get_download(logger, "request-3"))
+        assert download.state == "CANCELLED"
+
+        assert index_names(db, "downloads") == {
+            "ix_downloads_state", "ix_downloads_started_at",
+        }
+        assert index_names(db, "documents") == {
+            "ix_documents_download_id", "ix_documents_pending",
+            "ix_documents_content_location",
+        }
+        assert index_names(db, "blobs") == {"ix_blobs_location"}
+
+    def test_target(self, tmpdir):
+        logger = Logger(FakeMemoryLog())
+        db = baseline_db(tmpdir)
+
+        assert success_result_of(db.migrate(logger, target=2)) == [1, 2]
+        assert index_names(db, "documents") == set()
+        assert success_result_of(db.migrate(
+            logger, target=MIGRATIONS.index(create_indexes) + 1
+        )) == [3, 4]
+        assert index_names(db, "documents") == {
+            "ix_documents_download_id", "ix_documents_pending",
+        }
+        assert index_names(db, "downloads") == {"ix_downloads_state"}
+        assert success_result_of(db.migrate(logger)) == range(
+            5, len(MIGRATIONS) + 1
+        )
+        assert success_result_of(db.migrate(logger)) == []
+
+    def test_rerun(self, tmpdir):
+        logger = Logger(FakeMemoryLog())
+        db = baseline_db(tmpdir)
+        # As if each migration had been applied, but not recorded.
+        for migration in MIGRATIONS:
+            success_result_of(
+                db._engine.run_with_connection(migration, db._metadata)
+            )
+
+        success_result_of(db.migrate(logger))
+        download = success_result_of(db.get_download(logger, "request-1"))
+        assert download.state == "MANIFEST_DOWNLOADED"
@@ -26,10 +26,10 @@ def server(request, reactor):
     app = DownloadEFolder(
         logger=logger,
         download_database=DemoMemoryDownloadDatabase(),
-        storage_path=None,
+        blob_store=None,
         fernet=None,
         vbms_client=None,
-        queue=None,
+        jobs=None,
         env_name="testing",
     )
     endpoint = TCP4ServerEndpoint(reactor, 0)
@@ -0,0 +1,200 @@
+import datetime
+import os
+import time
+
+import sqlalchemy
+
+from twisted.internet.defer import fail
+from twisted.internet.task import Clock, LoopingCall
+from twisted.python.filepath import FilePath
+
+from efolder_express.blob_store import FilesystemBlobStore
+from efolder_express.db import Document, DownloadDatabase
+from efolder_express.log import Logger
+from efolder_express.retention import Retention
+
+from .utils import (
+    FakeMemoryLog, FakeReactor, FakeThreadPool, success_result_of
+)
+
+
+def make_document(download_id, document_id):
+    return Document(
+        id="{}-{}".format(download_id, document_id),
+        download_id=download_id,
+        document_id=document_id,
+        doc_type="00356",
+        filename="file.pdf",
+        received_at=None,
+        source="CUI",
+        content_location=None,
+        errored=False,
+    )
+
+
+def make_db(logger):
+    db = DownloadDatabase(FakeReactor(), FakeThreadPool(), "sqlite://")
+    success_result_of(db.create_database(logger))
+    return db
+
+
+def add_download(logger, db, storage, request_id, started_at, document_ids):
+    success_result_of(db.create_download(logger, request_id, "123"))
+    success_result_of(db._execute(
+        logger,
+        "set_started_at",
+        db._downloads.update().where(
+            db._downloads.c.request_id == request_id
+        ).values(started_at=started_at),
+    ))
+    docs = [
+        make_document(request_id, document_id)
+        for document_id in document_ids
+    ]
+    success_result_of(db.create_documents(logger, docs))
+    for doc in docs:
+        key = "{}-{}".format(request_id, doc.document_id)
+        put_blob(storage, key, "x" * 10)
+        success_result_of(db.add_blob(logger, doc, "hash", key))
+
+
+def put_blob(storage, key, content):
+    writer = storage.open_writer(key)
+    writer.write(content)
+    success_result_of(writer.close())
+
+
+def stored_keys(storage):
+    return sorted(success_result_of(storage.list_keys(None, 100)))
+
+
+class TestRetention(object):
+    def test_collect(self, tmpdir):
+        log = FakeMemoryLog()
+        logger = Logger(log)
+        db = make_db(logger)
+        storage = FilesystemBlobStore(FilePath(str(tmpdir)))
+        clock = Clock()
+        clock.advance(time.time())
+        now = datetime.datetime.utcfromtimestamp(clock.seconds())
+        old = now - datetime.timedelta(days=2)
+
+        add_download(logger, db, storage, "old-1", old, ["{A}", "{B}"])
+        add_download(logger, db, storage, "old-2", old, ["{C}"])
+        # Shares {A} with old-1, so that blob is kept.
+        add_download(logger, db, storage, "new", now, ["{A}"])
+        success_result_of(db.set_manifest(logger, "123", [], old))
+
+        retention = Retention(
+            clock, logger, db, storage,
+            max_age=24 * 60 * 60, batch_size=1, batch_delay=5,
+        )
+        d = retention.collect()
+        clock.advance(5)
+        clock.advance(5)
+        success_result_of(d)
+
+        [event] = [msg for msg in log.msgs
+                   if msg["event"] == "retention.collected"]
+        assert event["downloads"] == 2
+        assert event["documents"] == 3
+        assert event["blobs"] == 2
+        assert event["bytes_reclaimed"] == 20
+        assert stored_keys(storage) == ["new-{A}", "old-1-{A}"]
+        assert success_result_of(db.get_manifest(logger, "123")) is None
+
+        download = success_result_of(db.get_download(logger, "new"))
+        assert download.documents[0].content_location == "old-1-{A}"
+        assert success_result_of(
+            db.get_expired_downloads(logger, now, 10)
+        ) == []
+
+    def test_check_storage(self, tmpdir):
+        log = FakeMemoryLog()
+        logger = Logger(log)
+        db = make_db(logger)
+        storage = FilesystemBlobStore(FilePath(str(tmpdir)))
+        clock = Clock()
+        clock.advance(time.time())
+        now = datetime.datetime.utcfromtimestamp(clock.seconds())
+
+        add_download(logger, db, storage, "request", now, ["{A}", "{B}"])
+        success_result_of(storage.delete("request-{B}"))
+        # Fetched before there were blobs, so only its document knows it.
+        doc = make_document("request", "{C}")
+        success_result_of(db.create_documents(logger, [doc]))
+        put_blob(storage, "no-blob", "x")
+        success_result_of(
+            db.set_document_content_location(logger, doc, "no-blob")
+        )
+        # Still being written, probably.
+        put_blob(storage, "new-orphan", "x")
+        put_blob(storage, "old-orphan", "x" * 7)
+        day_ago = clock.seconds() - 24 * 60 * 60
+        for key in ["no-blob", "old-orphan"]:
+            os.utime(storage._path(key).path, (day_ago, day_ago))
+
+        retention = Retention(
+            clock, logger, db, storage, max_age=None, batch_size=2,
+            batch_delay=5,
+        )
+        d = retention.check_storage()
+        for _ in xrange(3):
+            clock.advance(5)
+        success_result_of(d)
+
+        assert stored_keys(storage) == [
+            "new-orphan", "no-blob", "request-{A}"
+        ]
+        assert success_result_of(
+            db.get_blob_locations(logger, None, 10)
+        ) == ["request-{A}"]
+        assert [
+            (msg["event"], msg["key"]) for msg in log.msgs
+            if msg["event"] in [
+                "retention.orphan_file", "retention.missing_file"
+            ]
+        ] == [
+            ("retention.orphan_file", "old-orphan"),
+            ("retention.missing_file", "request-{B}"),
+        ]
+        [event] = [msg for msg in log.msgs
+                   if msg["event"] == "retention.storage_checked"]
+        assert event == {
+            "event": "retention.storage_checked",
+            "orphans": 1,
+            "missing": 1,
+            "bytes_reclaimed": 7,
+        }
+
+    def test_survives_database_error(self, tmpdir):
+        log = FakeMemoryLog()
+        logger = Logger(log)
+        db = make_db(logger)
+        db.get_expired_downloads = db.get_referenced_locations = (
+            lambda *args: fail(
+                sqlalchemy.exc.OperationalError("SELECT", {}, "locked")
+            )
+        )
+        storage = FilesystemBlobStore(FilePath(str(tmpdir)))
+        put_blob(storage, "key", "x")
+        clock = Clock()
+        retention = Retention(clock, logger, db, storage, max_age=60)
+
+        loops = [
+            LoopingCall(retention.collect),
+            LoopingCall(retention.check_storage),
+        ]
+        for loop in loops:
+            loop.clock = clock
+            loop.start(10)
+        clock.advance(10)
+
+        assert all(loop.running for loop in loops)
+        assert sorted(
+            msg["event"] for msg in log.msgs if msg["event"].endswith("_error")
+        ) == ["retention.check_storage_error"] * 2 + [
+            "retention.collect_error"
+        ] * 2
+        for loop in loops:
+            loop.stop()
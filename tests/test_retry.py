@@ -0,0 +1,173 @@
+import pytest
+
+from twisted.internet.defer import fail, succeed
+from twisted.internet.task import Clock
+
+from efolder_express.log import Logger
+from efolder_express.retry import (
+    CircuitBreaker, CircuitOpenError, RetryBudget, RetryPolicy, is_retryable
+)
+from efolder_express.vbms import VBMSError
+
+from .utils import FakeMemoryLog, no_result, success_result_of
+
+
+def transient_error():
+    return VBMSError("", "Net::ReadTimeout", 1)
+
+
+def fatal_error():
+    return VBMSError("", "VBMS::ClientError: Document not found", 1)
+
+
+class FlakyCall(object):
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            return fail(self.errors.pop(0))
+        return succeed("result")
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def policy(clock):
+    return RetryPolicy(
+        clock, max_attempts=3, base_delay=1, max_delay=10, random=lambda: 1
+    )
+
+
+class TestIsRetryable(object):
+    def test_transient(self):
+        assert is_retryable(transient_error())
+        assert is_retryable(VBMSError("", "Errno::ECONNRESET", 1))
+        assert is_retryable(CircuitOpenError())
+
+    def test_killed(self):
+        assert is_retryable(VBMSError("", "", None))
+
+    def test_fatal(self):
+        assert not is_retryable(fatal_error())
+        assert not is_retryable(VBMSError("", "NoMethodError", 1))
+        assert not is_retryable(ZeroDivisionError())
+
+
+class TestRetryPolicy(object):
+    def test_delay(self, policy):
+        assert [policy.delay(i) for i in xrange(5)] == [1, 2, 4, 8, 10]
+
+    def test_retries_on_clock(self, clock, policy):
+        logger = Logger(FakeMemoryLog())
+        f = FlakyCall([transient_error(), transient_error()])
+        d = policy.run(logger, None, f)
+        assert f.calls == 1
+
+        clock.advance(2)
+        assert f.calls == 2
+        no_result(d)
+
+        clock.advance(4)
+        assert success_result_of(d) == "result"
+        assert [msg["event"] for msg in logger._log.msgs] == [
+            "vbms.retry", "vbms.retry"
+        ]
+
+    def test_fatal_not_retried(self, policy):
+        f = FlakyCall([fatal_error()])
+        with pytest.raises(VBMSError):
+            success_result_of(policy.run(Logger(FakeMemoryLog()), None, f))
+        assert f.calls == 1
+
+    def test_max_attempts(self, clock, policy):
+        f = FlakyCall([transient_error()] * 3)
+        d = policy.run(Logger(FakeMemoryLog()), None, f)
+        clock.advance(2)
+        clock.advance(4)
+        with pytest.raises(VBMSError):
+            success_result_of(d)
+        assert f.calls == 3
+
+    def test_budget(self, clock, policy):
+        budget = RetryBudget(1)
+        f = FlakyCall([transient_error()] * 2)
+        d = policy.run(Logger(FakeMemoryLog()), budget, f)
+        clock.advance(2)
+        with pytest.raises(VBMSError):
+            success_result_of(d)
+        assert f.calls == 2
+        assert budget.remaining == 0
+
+    def test_before_retry(self, clock, policy):
+        resets = []
+        f = FlakyCall([transient_error()])
+        d = policy.run(
+            Logger(FakeMemoryLog()), None, f, lambda: resets.append(f.calls)
+        )
+        clock.advance(2)
+        success_result_of(d)
+        assert resets == [1]
+
+
+class TestCircuitBreaker(object):
+    def make_breaker(self, clock):
+        return CircuitBreaker(
+            clock,
+            Logger(FakeMemoryLog()),
+            failure_threshold=2,
+            reset_timeout=30,
+        )
+
+    def fail_call(self, breaker, error):
+        d = breaker.call(fail, error)
+        d.addErrback(lambda f: None)
+
+    def test_opens(self, clock):
+        breaker = self.make_breaker(clock)
+        self.fail_call(breaker, transient_error())
+        assert breaker.state == CircuitBreaker.CLOSED
+        self.fail_call(breaker, transient_error())
+        assert breaker.state == CircuitBreaker.OPEN
+
+        calls = []
+        d = breaker.call(lambda: calls.append(1))
+        with pytest.raises(CircuitOpenError):
+            success_result_of(d)
+        assert calls == []
+
+    def test_fatal_errors_dont_open(self, clock):
+        breaker = self.make_breaker(clock)
+        for _ in xrange(3):
+            self.fail_call(breaker, fatal_error())
+        assert breaker.state == CircuitBreaker.CLOSED
+
+    def test_half_open_probe(self, clock):
+        breaker = self.make_breaker(clock)
+        self.fail_call(breaker, transient_error())
+        self.fail_call(breaker, transient_error())
+        clock.advance(30)
+
+        probe = FlakyCall([])
+        d = breaker.call(lambda: probe().addCallback(lambda r: r))
+        assert success_result_of(d) == "result"
+        assert breaker.state == CircuitBreaker.CLOSED
+
+        states = [msg["state"] for msg in breaker._logger._log.msgs]
+        assert states == ["open", "half_open", "closed"]
+
+    def test_half_open_failure_reopens(self, clock):
+        breaker = self.make_breaker(clock)
+        self.fail_call(breaker, transient_error())
+        self.fail_call(breaker, transient_error())
+        clock.advance(30)
+
+        self.fail_call(breaker, transient_error())
+        assert breaker.state == CircuitBreaker.OPEN
+        with pytest.raises(CircuitOpenError):
+            success_result_of(breaker.call(succeed, None))
@@ -0,0 +1,119 @@
+from twisted.internet.task import Clock
+
+from efolder_express.log import Logger
+from efolder_express.scheduler import (
+    BACKGROUND, DOCUMENTS, MANIFEST, SHORTEST_FIRST, Scheduler
+)
+
+from .utils import FakeMemoryLog, no_result, success_result_of
+
+
+def drain(scheduler):
+    items = []
+    while any(
+        scheduler.depth(p) for p in [MANIFEST, DOCUMENTS, BACKGROUND]
+    ):
+        items.append(success_result_of(scheduler.get()))
+    return items
+
+
+class TestScheduler(object):
+    def test_priority(self):
+        scheduler = Scheduler(Clock(), Logger(FakeMemoryLog()))
+        scheduler.put("fetch-1", DOCUMENTS, "request-1")
+        scheduler.put("list-2", MANIFEST, "request-2")
+        scheduler.put("fetch-2", DOCUMENTS, "request-1")
+
+        assert drain(scheduler) == ["list-2", "fetch-1", "fetch-2"]
+
+    def test_round_robin(self):
+        scheduler = Scheduler(Clock(), Logger(FakeMemoryLog()))
+        for i in xrange(3):
+            scheduler.put("big-{}".format(i), DOCUMENTS, "big")
+        for i in xrange(2):
+            scheduler.put("small-{}".format(i), DOCUMENTS, "small")
+
+        assert drain(scheduler) == [
+            "big-0", "small-0", "big-1", "small-1", "big-2"
+        ]
+
+    def test_shortest_first(self):
+        scheduler = Scheduler(
+            Clock(), Logger(FakeMemoryLog()), policy=SHORTEST_FIRST
+        )
+        for i in xrange(3):
+            scheduler.put("big-{}".format(i), DOCUMENTS, "big")
+        for i in xrange(2):
+            scheduler.put("small-{}".format(i), DOCUMENTS, "small")
+
+        assert drain(scheduler) == [
+            "small-0", "small-1", "big-0", "big-1", "big-2"
+        ]
+
+    def test_get_waits(self):
+        scheduler = Scheduler(Clock(), Logger(FakeMemoryLog()))
+        d = scheduler.get()
+        no_result(d)
+
+        scheduler.put("item", DOCUMENTS, "request-1")
+        assert success_result_of(d) == "item"
+
+    def test_metrics(self):
+        clock = Clock()
+        logger = Logger(FakeMemoryLog())
+        scheduler = Scheduler(clock, logger)
+        scheduler.put("fetch-1", DOCUMENTS, "request-1")
+        scheduler.put("fetch-2", DOCUMENTS, "request-1")
+        clock.advance(5)
+
+        success_result_of(scheduler.get())
+        assert logger._log.msgs == [{
+            "event": "scheduler.dequeue",
+            "priority": DOCUMENTS,
+            "wait": 5,
+            "depth": 1,
+        }]
+
+    def test_oldest_wait(self):
+        clock = Clock()
+        scheduler = Scheduler(clock, Logger(FakeMemoryLog()))
+        assert scheduler.oldest_wait() == 0
+
+        scheduler.put("fetch-1", DOCUMENTS, "request-1")
+        clock.advance(3)
+        scheduler.put("list-2", MANIFEST, "request-2")
+        clock.advance(2)
+        assert scheduler.oldest_wait() == 5
+
+    def test_cancel_get(self):
+        scheduler = Scheduler(Clock(), Logger(FakeMemoryLog()))
+        d = scheduler.get()
+        d.addErrback(lambda failure: None)
+        d.cancel()
+
+        scheduler.put("item", DOCUMENTS, "request-1")
+        assert success_result_of(scheduler.get()) == "item"
+
+    def test_deprioritize(self):
+        scheduler = Scheduler(Clock(), Logger(FakeMemoryLog()))
+        scheduler.put("abandoned-1", DOCUMENTS, "abandoned")
+        scheduler.put("abandoned-2", DOCUMENTS, "abandoned")
+        scheduler.put("watched-1", DOCUMENTS, "watched")
+
+        scheduler.deprioritize("abandoned")
+        scheduler.put("watched-2", DOCUMENTS, "watched")
+
+        assert scheduler.depth(BACKGROUND) == 2
+        assert drain(scheduler) == [
+            "watched-1", "watched-2", "abandoned-1", "abandoned-2"
+        ]
+
+    def test_cancel(self):
+        scheduler = Scheduler(Clock(), Logger(FakeMemoryLog()))
+        scheduler.put("list", MANIFEST, "cancelled")
+        scheduler.put("fetch", DOCUMENTS, "cancelled")
+        scheduler.put("other", DOCUMENTS, "other")
+
+        assert scheduler.cancel("cancelled") == 2
+        assert scheduler.cancel("cancelled") == 0
+        assert drain(scheduler) == ["other"]
@@ -0,0 +1,102 @@
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.task import Clock
+
+from efolder_express.db import DownloadStatus
+from efolder_express.log import Logger
+from efolder_express.status_cache import StatusCache
+
+from .utils import FakeMemoryLog, no_result, success_result_of
+
+
+def make_status(request_id, state="MANIFEST_DOWNLOADED", total=2,
+                completed=0):
+    return DownloadStatus(
+        request_id, "123", state, None,
+        total_documents=total,
+        completed_documents=completed,
+        errored_documents=0,
+    )
+
+
+class TestStatusCache(object):
+    def test_get(self):
+        cache = StatusCache(Clock(), Logger(FakeMemoryLog()), size=10)
+        status = make_status("request-1")
+
+        assert success_result_of(
+            cache.get("request-1", lambda: succeed(status))
+        ) is status
+        assert success_result_of(cache.get("request-1", None)) is status
+        assert (cache.hits, cache.misses) == (1, 1)
+
+        cache.update("request-1", completed=1)
+        cache.update("request-1", state="ERRORED", errored=1)
+        status = success_result_of(cache.get("request-1", None))
+        assert status.state == "ERRORED"
+        assert status.completed
+        assert status.completed_documents == 1
+        assert status.errored_documents == 1
+
+    def test_lru(self):
+        cache = StatusCache(Clock(), Logger(FakeMemoryLog()), size=2)
+        for request_id in ["request-1", "request-2"]:
+            cache.get(request_id, lambda: succeed(make_status(request_id)))
+        cache.get("request-1", None)
+        cache.get("request-3", lambda: succeed(make_status("request-3")))
+        assert cache.evictions == 1
+
+        loads = []
+        cache.get("request-2", lambda: loads.append(1) or succeed(
+            make_status("request-2")
+        ))
+        assert loads == [1]
+
+    def test_ttl(self):
+        clock = Clock()
+        cache = StatusCache(clock, Logger(FakeMemoryLog()), size=10, ttl=5)
+        cache.get("request-1", lambda: succeed(make_status("request-1")))
+        cache.get("request-2", lambda: succeed(
+            make_status("request-2", state="CANCELLED")
+        ))
+        cache.get("request-3", lambda: succeed(
+            make_status("request-3", completed=2)
+        ))
+        clock.advance(5)
+
+        loads = []
+
+        def load(request_id):
+            loads.append(request_id)
+            return succeed(make_status(request_id))
+        for request_id in ["request-1", "request-2", "request-3"]:
+            cache.get(request_id, lambda: load(request_id))
+        # Finished downloads are kept.
+        assert loads == ["request-1"]
+
+    def test_write_during_load(self):
+        cache = StatusCache(Clock(), Logger(FakeMemoryLog()), size=10)
+        loaded = Deferred()
+        d = cache.get("request-1", lambda: loaded)
+        no_result(d)
+        cache.update("request-1", completed=1)
+        loaded.callback(make_status("request-1"))
+        success_result_of(d)
+
+        # The load may have missed the write, so it wasn't cached.
+        status = make_status("request-1", completed=1)
+        assert success_result_of(
+            cache.get("request-1", lambda: succeed(status))
+        ) is status
+
+    def test_emit_gauges(self):
+        log = FakeMemoryLog()
+        cache = StatusCache(Clock(), Logger(log), size=10)
+        cache.get("request-1", lambda: succeed(make_status("request-1")))
+        cache.get("request-1", None)
+        cache.get("request-1", None)
+        cache.emit_gauges()
+        cache.emit_gauges()
+        assert [
+            (msg["size"], msg["hits"], msg["misses"], msg["hit_rate"])
+            for msg in log.msgs
+        ] == [(1, 2, 1, 2.0 / 3), (1, 0, 0, 0.0)]
@@ -0,0 +1,78 @@
+import hashlib
+
+from cryptography.fernet import Fernet
+
+from twisted.python.filepath import FilePath
+
+from efolder_express.blob_store import FilesystemBlobStore
+from efolder_express.storage import EncryptingWriter, decrypt_file
+
+from .utils import success_result_of
+
+
+def read_blob(fernet, store, key):
+    with success_result_of(store.open(key)) as f:
+        return list(decrypt_file(fernet, f))
+
+
+class TestEncryptingWriter(object):
+    def test_round_trip(self, tmpdir):
+        fernet = Fernet(Fernet.generate_key())
+        store = FilesystemBlobStore(FilePath(str(tmpdir)))
+
+        writer = EncryptingWriter(fernet, store, "blob", chunk_size=4)
+        writer.write("abc")
+        writer.write("defghij")
+        writer.write("k")
+        success_result_of(writer.close())
+
+        assert read_blob(fernet, store, "blob") == ["abcd", "efgh", "ijk"]
+
+    def test_content_hash(self, tmpdir):
+        fernet = Fernet(Fernet.generate_key())
+        store = FilesystemBlobStore(FilePath(str(tmpdir)))
+        writer = EncryptingWriter(fernet, store, "blob")
+        writer.write("garbage")
+        writer.reset()
+        writer.write("abc")
+        writer.close()
+
+        assert writer.content_hash == hashlib.sha256("abc").hexdigest()
+
+    def test_empty(self, tmpdir):
+        fernet = Fernet(Fernet.generate_key())
+        store = FilesystemBlobStore(FilePath(str(tmpdir)))
+
+        EncryptingWriter(fernet, store, "blob").close()
+
+        assert "".join(read_blob(fernet, store, "blob")) == ""
+
+    def test_abort(self, tmpdir):
+        fernet = Fernet(Fernet.generate_key())
+        store = FilesystemBlobStore(FilePath(str(tmpdir)))
+
+        writer = EncryptingWriter(fernet, store, "blob")
+        writer.write("abc")
+        success_result_of(writer.abort())
+
+        assert success_result_of(store.stat("blob")) is None
+
+    def test_decrypt_single_token(self, tmpdir):
+        fernet = Fernet(Fernet.generate_key())
+        path = FilePath(str(tmpdir)).child("blob")
+        path.setContent(fernet.encrypt("abc"))
+
+        with path.open() as f:
+            assert list(decrypt_file(fernet, f)) == ["abc"]
+
+    def test_reset(self, tmpdir):
+        fernet = Fernet(Fernet.generate_key())
+        store = FilesystemBlobStore(FilePath(str(tmpdir)))
+
+        writer = EncryptingWriter(fernet, store, "blob", chunk_size=4)
+        writer.write("partial data")
+        writer.reset()
+        writer.write("abc")
+        writer.close()
+
+        assert "".join(read_blob(fernet, store, "blob")) == "abc"
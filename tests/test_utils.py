@@ -1,8 +1,8 @@
 import pytest
 
-from twisted.internet.defer import fail, succeed
+from twisted.internet.defer import Deferred, fail, succeed
 
-from efolder_express.utils import DeferredValue
+from efolder_express.utils import DeferredValue, SingleFlight
 
 from .utils import no_result, success_result_of
 
@@ -27,3 +27,40 @@ class TestDeferredValue(object):
         assert success_result_of(d) == 12
 
         assert success_result_of(v.wait()) == 12
+
+
+class TestSingleFlight(object):
+    def test_coalesces(self):
+        single_flight = SingleFlight()
+        calls = []
+        d = Deferred()
+
+        def f(arg):
+            calls.append(arg)
+            return d
+
+        d1 = single_flight.run("key", f, 1)
+        d2 = single_flight.run("key", f, 2)
+        assert "key" in single_flight
+        assert calls == [1]
+        assert single_flight.coalesced == 1
+
+        d.callback(12)
+        assert success_result_of(d1) == 12
+        assert success_result_of(d2) == 12
+        assert "key" not in single_flight
+
+        success_result_of(single_flight.run("key", succeed, 13))
+        assert single_flight.coalesced == 1
+
+    def test_failure(self):
+        single_flight = SingleFlight()
+        d = Deferred()
+
+        d1 = single_flight.run("key", lambda: d)
+        d2 = single_flight.run("key", lambda: d)
+        d.errback(ZeroDivisionError())
+
+        for d in [d1, d2]:
+            with pytest.raises(ZeroDivisionError):
+                success_result_of(d)
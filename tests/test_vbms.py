@@ -0,0 +1,167 @@
+import sys
+
+import pytest
+
+from twisted.internet.defer import fail
+from twisted.internet.task import Clock, deferLater
+from twisted.python.filepath import FilePath
+
+from efolder_express.log import Logger
+from efolder_express.retry import CircuitBreaker, CircuitOpenError
+from efolder_express.utils import encode_frame
+from efolder_express.vbms import (
+    ResponseReader, VBMSClient, VBMSError, VBMSTimeoutError,
+    _signal_process_group
+)
+
+from .utils import FakeMemoryLog, no_result, success_result_of
+
+
+FAKE_BUNDLE = FilePath(__file__).sibling("fake_connect_vbms.py").path
+
+
+class TestResponseReader(object):
+    def test_responses(self):
+        reader = ResponseReader()
+        chunks1 = []
+        chunks2 = []
+        d1 = reader.expect(chunks1.append)
+        d2 = reader.expect(chunks2.append)
+
+        data = (
+            encode_frame('{"status": "ok"}') +
+            encode_frame("abc") +
+            encode_frame("def") +
+            encode_frame("") +
+            encode_frame('{"status": "error", "error": "Not found"}')
+        )
+        # Deliver the data in small pieces, as a pipe might.
+        for i in xrange(0, len(data), 3):
+            reader.data_received(data[i:i + 3])
+
+        success_result_of(d1)
+        assert chunks1 == ["abc", "def"]
+        with pytest.raises(VBMSError) as exc_info:
+            success_result_of(d2)
+        assert exc_info.value.stderr == "Not found"
+        assert chunks2 == []
+        assert reader.pending == 0
+
+    def test_fail_all(self):
+        reader = ResponseReader()
+        d1 = reader.expect(lambda data: None)
+        d2 = reader.expect(lambda data: None)
+        reader.data_received(encode_frame('{"status": "ok"}'))
+        no_result(d1)
+
+        reader.fail_all(VBMSError("", "Crashed", 1))
+        for d in [d1, d2]:
+            with pytest.raises(VBMSError):
+                success_result_of(d)
+
+
+@pytest.fixture
+def reactor():
+    from twisted.internet import reactor
+    return reactor
+
+
+def make_vbms_client(reactor, **kwargs):
+    return VBMSClient(
+        reactor,
+        endpoint_url="https://vbms.example.com/",
+        keyfile=None,
+        samlfile=None,
+        key=None,
+        keypass="secret",
+        ca_cert=None,
+        client_cert=None,
+        **kwargs
+    )
+
+
+class TestVBMSClient(object):
+    def test_scripts(self, reactor, tmpdir):
+        vbms_client = make_vbms_client(
+            reactor, connect_vbms_path=str(tmpdir), bundle_path="bundle"
+        )
+        script_dir = FilePath(vbms_client._script_dir)
+        assert sorted(script_dir.listdir()) == [
+            "FetchDocumentById.rb",
+            "FetchDocumentsById.rb",
+            "GetDocumentTypes.rb",
+            "ListDocuments.rb",
+        ]
+        script = script_dir.child("ListDocuments.rb")
+        assert script.getPermissions().shorthand() == "rwx------"
+        assert "VBMS::Requests::ListDocuments.new(ARGV[0])" in (
+            script.getContent()
+        )
+
+        vbms_client.stop()
+        assert not script_dir.exists()
+
+    @pytest.inlineCallbacks
+    def test_timeout_kills_process_group(self, reactor, tmpdir):
+        marker = tmpdir.join("marker")
+        vbms_client = make_vbms_client(
+            reactor,
+            connect_vbms_path=str(tmpdir),
+            # Stands in for a connect_vbms process which hangs, in a
+            # grandchild process of the one that's spawned.
+            bundle_path="sh -c 'sleep 2 && touch {}';".format(marker),
+            timeouts={"FetchDocumentById": 0.5},
+            kill_grace_period=0.5,
+        )
+        logger = Logger(FakeMemoryLog())
+        with pytest.raises(VBMSTimeoutError):
+            yield vbms_client.fetch_document_contents(logger, "{ABC}")
+        assert vbms_client.timeout_counts == {"FetchDocumentById": 1}
+        # The group has exited, so its SIGKILL was cancelled.
+        assert not [
+            call for call in reactor.getDelayedCalls()
+            if call.func is _signal_process_group
+        ]
+
+        yield deferLater(reactor, 2, lambda: None)
+        assert not marker.check()
+        vbms_client.stop()
+
+    @pytest.inlineCallbacks
+    def test_fetch_documents_batch_in_process(self, reactor, tmpdir):
+        vbms_client = make_vbms_client(
+            reactor,
+            connect_vbms_path=str(tmpdir),
+            bundle_path="{} {}".format(sys.executable, FAKE_BUNDLE),
+        )
+        logger = Logger(FakeMemoryLog())
+
+        ds = vbms_client.fetch_documents_batch(logger, ["1", "error", "2"])
+        assert (yield ds[0]) == b"contents of 1"
+        with pytest.raises(VBMSError) as exc_info:
+            yield ds[1]
+        # From the batch's error frame, rather than a single fetch's stderr.
+        assert exc_info.value.stderr == "Document not found"
+        assert (yield ds[2]) == b"contents of 2"
+        vbms_client.stop()
+
+    def test_fetch_documents_batch_circuit_open(self, reactor, tmpdir):
+        logger = Logger(FakeMemoryLog())
+        breaker = CircuitBreaker(
+            Clock(), logger, failure_threshold=1, reset_timeout=60
+        )
+        breaker.call(
+            lambda: fail(VBMSTimeoutError("", "", None, 1))
+        ).addErrback(lambda _: None)
+        vbms_client = make_vbms_client(
+            reactor,
+            connect_vbms_path=str(tmpdir),
+            bundle_path="bundle",
+            circuit_breaker=breaker,
+        )
+
+        ds = vbms_client.fetch_documents_batch(logger, ["1", "2"])
+        for d in ds:
+            with pytest.raises(CircuitOpenError):
+                success_result_of(d)
+        vbms_client.stop()
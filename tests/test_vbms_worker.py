@@ -0,0 +1,218 @@
+import sys
+
+import pytest
+
+from twisted.python.filepath import FilePath
+
+from efolder_express.log import Logger
+from efolder_express.vbms import (
+    VBMSAbortedError, VBMSClient, VBMSError, VBMSTimeoutError
+)
+from efolder_express.vbms_worker import ConnectVBMSWorkerPool
+
+from .utils import FakeMemoryLog
+
+
+FAKE_WORKER = FilePath(__file__).sibling("fake_connect_vbms_worker.py").path
+
+
+@pytest.fixture
+def reactor():
+    from twisted.internet import reactor
+    return reactor
+
+
+@pytest.fixture
+def pool(request, reactor):
+    pool = ConnectVBMSWorkerPool(
+        reactor,
+        [sys.executable, FAKE_WORKER],
+        path=None,
+        config={},
+        size=2,
+        max_requests=3,
+        kill_grace_period=0.5,
+    )
+    request.addfinalizer(lambda: pytest.blockon(pool.stop()))
+    return pool
+
+
+@pytest.fixture
+def vbms_client(request, reactor, pool):
+    vbms_client = VBMSClient(
+        reactor,
+        connect_vbms_path=None,
+        bundle_path=None,
+        endpoint_url=None,
+        keyfile=None,
+        samlfile=None,
+        key=None,
+        keypass=None,
+        ca_cert=None,
+        client_cert=None,
+        worker_pool=pool,
+        timeouts={"FetchDocumentById": 1},
+    )
+    request.addfinalizer(lambda: pytest.blockon(vbms_client.stop()))
+    return vbms_client
+
+
+class ListSink(object):
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    def reset(self):
+        del self.chunks[:]
+
+
+class TestConnectVBMSWorkerPool(object):
+    @pytest.inlineCallbacks
+    def test_requests(self, vbms_client):
+        logger = Logger(FakeMemoryLog())
+
+        document_types = yield vbms_client.get_document_types(logger)
+        assert document_types == [{"type_id": "1", "description": "Test!"}]
+
+        [document] = yield vbms_client.list_documents(logger, "123456789")
+        assert document["document_id"] == "123456789-1"
+
+        contents = yield vbms_client.fetch_document_contents(logger, "{ABC}")
+        assert contents == b"contents of {ABC}"
+
+    @pytest.inlineCallbacks
+    def test_error(self, vbms_client):
+        logger = Logger(FakeMemoryLog())
+
+        pid = yield vbms_client.fetch_document_contents(logger, "pid")
+        with pytest.raises(VBMSError) as exc_info:
+            yield vbms_client.fetch_document_contents(logger, "error")
+        assert "Document not found" in exc_info.value.stderr
+
+        # The worker survives a failed request.
+        new_pid = yield vbms_client.fetch_document_contents(logger, "pid")
+        assert new_pid == pid
+
+    @pytest.inlineCallbacks
+    def test_crash_restarts_worker(self, vbms_client):
+        logger = Logger(FakeMemoryLog())
+
+        pid = yield vbms_client.fetch_document_contents(logger, "pid")
+        with pytest.raises(VBMSError) as exc_info:
+            yield vbms_client.fetch_document_contents(logger, "crash")
+        assert exc_info.value.exit_code == 3
+        assert exc_info.value.stderr == "Crashing!\n"
+        assert [msg["event"] for msg in logger._log.msgs].count(
+            "connect_vbms_worker.crashed"
+        ) == 1
+
+        new_pid = yield vbms_client.fetch_document_contents(logger, "pid")
+        assert new_pid != pid
+
+    @pytest.inlineCallbacks
+    def test_recycle_after_max_requests(self, vbms_client):
+        logger = Logger(FakeMemoryLog())
+
+        pids = []
+        for _ in xrange(4):
+            pids.append((yield vbms_client.fetch_document_contents(
+                logger, "pid"
+            )))
+        assert pids[0] == pids[1] == pids[2]
+        assert pids[3] != pids[0]
+
+    @pytest.inlineCallbacks
+    def test_concurrent_requests(self, vbms_client, pool):
+        logger = Logger(FakeMemoryLog())
+
+        ds = [
+            vbms_client.fetch_document_contents(logger, str(i))
+            for i in xrange(5)
+        ]
+        assert len(pool._workers) == 2
+        results = []
+        for d in ds:
+            results.append((yield d))
+        assert results == [
+            "contents of {}".format(i).encode() for i in xrange(5)
+        ]
+
+    @pytest.inlineCallbacks
+    def test_coalesces_identical_requests(self, vbms_client, pool):
+        logger = Logger(FakeMemoryLog())
+
+        ds = [
+            vbms_client.fetch_document_contents(logger, "pid")
+            for _ in xrange(3)
+        ]
+        assert len(pool._workers) == 1
+        pids = []
+        for d in ds:
+            pids.append((yield d))
+        assert pids[0] == pids[1] == pids[2]
+        assert [msg["coalesced"] for msg in logger._log.msgs if (
+            msg["event"] == "vbms.coalesced"
+        )] == [1, 2]
+
+    @pytest.inlineCallbacks
+    def test_fetch_documents_batch(self, vbms_client):
+        logger = Logger(FakeMemoryLog())
+
+        ds = vbms_client.fetch_documents_batch(logger, ["1", "error", "2"])
+        assert (yield ds[0]) == b"contents of 1"
+        with pytest.raises(VBMSError):
+            yield ds[1]
+        assert (yield ds[2]) == b"contents of 2"
+
+    @pytest.inlineCallbacks
+    def test_timeout(self, vbms_client):
+        logger = Logger(FakeMemoryLog())
+
+        pid = yield vbms_client.fetch_document_contents(logger, "pid")
+        with pytest.raises(VBMSTimeoutError):
+            yield vbms_client.fetch_document_contents(logger, "hang")
+        assert vbms_client.timeout_counts == {"FetchDocumentById": 1}
+        [msg] = [
+            msg for msg in logger._log.msgs
+            if msg["event"] == "process.timeout"
+        ]
+        assert msg["timeouts"] == 1
+
+        new_pid = yield vbms_client.fetch_document_contents(logger, "pid")
+        assert new_pid != pid
+
+    @pytest.inlineCallbacks
+    def test_abort(self, reactor, vbms_client):
+        logger = Logger(FakeMemoryLog())
+        sink = ListSink()
+
+        d = vbms_client.stream_document_contents(logger, "hang", sink)
+        reactor.callLater(0.1, vbms_client.abort, [sink])
+        with pytest.raises(VBMSAbortedError):
+            yield d
+        assert vbms_client.timeout_counts == {}
+
+        # An aborted sink is never fetched into again.
+        with pytest.raises(VBMSAbortedError):
+            yield vbms_client.stream_document_contents(logger, "1", sink)
+
+    @pytest.inlineCallbacks
+    def test_abort_while_waiting_for_worker(self, reactor, vbms_client):
+        logger = Logger(FakeMemoryLog())
+        sink = ListSink()
+
+        # Both workers are busy until their requests time out.
+        hung = [
+            vbms_client.stream_document_contents(logger, "hang", ListSink())
+            for _ in xrange(2)
+        ]
+        d = vbms_client.stream_document_contents(logger, "1", sink)
+        reactor.callLater(0.1, vbms_client.abort, [sink])
+        with pytest.raises(VBMSAbortedError):
+            yield d
+        assert sink.chunks == []
+        for hung_d in hung:
+            with pytest.raises(VBMSTimeoutError):
+                yield hung_d
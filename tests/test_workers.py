@@ -0,0 +1,125 @@
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
+
+from efolder_express.log import Logger
+from efolder_express.scheduler import DOCUMENTS, Scheduler
+from efolder_express.workers import WorkerPool
+
+from .utils import FakeMemoryLog
+
+
+class BrokenQueue(object):
+    """
+    Fails the first ``get``.
+    """
+
+    def __init__(self, queue):
+        self._queue = queue
+        self._broken = True
+
+    def get(self):
+        if self._broken:
+            self._broken = False
+            raise ZeroDivisionError()
+        return self._queue.get()
+
+
+def make_pool(size, task_deadline=None):
+    clock = Clock()
+    logger = Logger(FakeMemoryLog())
+    queue = Scheduler(clock, logger)
+    pool = WorkerPool(
+        clock, logger, queue, size, task_deadline=task_deadline,
+        gauge_interval=10,
+    )
+    return clock, queue, pool
+
+
+def events(pool, event):
+    return [msg for msg in pool._logger._log.msgs if msg["event"] == event]
+
+
+class TestWorkerPool(object):
+    def test_failures_dont_kill_workers(self):
+        clock, queue, pool = make_pool(1)
+        pool.start()
+        ran = []
+
+        def fail():
+            raise ZeroDivisionError()
+        queue.put(fail, DOCUMENTS, "request-1")
+        queue.put(lambda: ran.append(True), DOCUMENTS, "request-1")
+
+        assert ran == [True]
+        assert pool.live == 1
+        assert len(events(pool, "worker_pool.task_error")) == 1
+
+    def test_task_deadline(self):
+        clock, queue, pool = make_pool(1, task_deadline=5)
+        pool.start()
+        d = Deferred()
+        queue.put(lambda: d, DOCUMENTS, "request-1")
+        assert pool.busy == 1
+
+        clock.advance(5)
+        assert pool.busy == 0
+        assert len(events(pool, "worker_pool.deadline_exceeded")) == 1
+
+    def test_dead_worker_replaced(self):
+        clock, queue, pool = make_pool(1)
+        pool._queue = BrokenQueue(queue)
+        pool.start()
+
+        assert pool.live == 1
+        assert len(events(pool, "worker_pool.worker_died")) == 1
+        ran = []
+        queue.put(lambda: ran.append(True), DOCUMENTS, "request-1")
+        assert ran == [True]
+
+    def test_gauges(self):
+        clock, queue, pool = make_pool(2)
+        pool.start()
+        d = Deferred()
+        queue.put(lambda: d, DOCUMENTS, "request-1")
+        queue.put(lambda: None, DOCUMENTS, "request-1")
+
+        def fail():
+            raise ZeroDivisionError()
+        queue.put(fail, DOCUMENTS, "request-1")
+
+        clock.advance(10)
+        [gauges] = events(pool, "worker_pool.gauges")
+        assert gauges["live"] == 2
+        assert gauges["busy"] == 1
+        assert gauges["completed"] == 1
+        assert gauges["failed"] == 1
+        assert gauges["failure_rate"] == 0.5
+
+    def test_autoscale(self):
+        clock, queue, pool = make_pool(1)
+        pool.autoscale(minimum=1, maximum=2, wait_target=5, interval=10)
+        pool.start()
+        d = Deferred()
+        queue.put(lambda: d, DOCUMENTS, "request-1")
+        queue.put(lambda: None, DOCUMENTS, "request-1")
+        queue.put(lambda: None, DOCUMENTS, "request-1")
+
+        # The second item has waited for longer than the target.
+        clock.advance(10)
+        assert pool.live == 2
+        assert queue.oldest_wait() == 0
+
+        # At the maximum, no more are added.
+        queue.put(lambda: Deferred(), DOCUMENTS, "request-1")
+        queue.put(lambda: None, DOCUMENTS, "request-1")
+        clock.advance(10)
+        assert pool.live == 2
+
+        d.callback(None)
+        clock.advance(10)
+        assert pool.live == 1
+        clock.advance(10)
+        assert pool.live == 1
+        assert [msg["live"] for msg in events(pool, "worker_pool.scaled")] == [
+            2, 1
+        ]
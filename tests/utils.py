@@ -1,5 +1,6 @@
 import json
 
+from twisted.internet.defer import fail, succeed
 from twisted.python.failure import Failure
 
 
@@ -28,6 +29,9 @@ class FakeReactor(object):
 
 
 class FakeThreadPool(object):
+    def pin(self):
+        return self
+
     def callInThreadWithCallback(self, cb, f, *args, **kwargs):
         try:
             result = f(*args, **kwargs)
@@ -46,7 +50,43 @@ class FakeMemoryLog(object):
 
 
 class FakeVBMSClient(object):
+    def __init__(self):
+        self.document_types_calls = 0
+        self.document_types_error = None
+        self.list_documents_calls = 0
+        self.documents = []
+
     def get_document_types(self, logger):
-        return [
+        self.document_types_calls += 1
+        if self.document_types_error is not None:
+            return fail(self.document_types_error)
+        return succeed([
             {"type_id": "1", "description": "Test!"}
+        ])
+
+    def list_documents(self, logger, file_number, retry_budget=None):
+        self.list_documents_calls += 1
+        return succeed(self.documents)
+
+    def fetch_documents_batch(self, logger, document_ids):
+        return [
+            succeed("contents of {}".format(document_id))
+            for document_id in document_ids
         ]
+
+    def stream_documents_batch(self, logger, document_ids, sinks,
+                               retry_budget=None):
+        results = []
+        for document_id, sink in zip(document_ids, sinks):
+            sink.write("contents of {}".format(document_id))
+            results.append(succeed(None))
+        return results
+
+
+class FakeJobQueue(object):
+    def __init__(self):
+        self.jobs = []
+
+    def put(self, logger, jobs):
+        self.jobs.extend(jobs)
+        return succeed(None)